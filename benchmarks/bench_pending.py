@@ -0,0 +1,133 @@
+"""
+Stress benchmark for the pending connections, with writers in parallel processes.
+
+    python3 benchmarks/bench_pending.py [--writers 8] [--adds 50] [--unlocked]
+
+Every writer adds its own pending connections (and removes every fifth one
+again) through var_io.pendingTransaction, like `pifi add` and `pifi remove`
+running at the same time. Afterwards the pending connections are checked,
+and the benchmark fails if any change was lost. Prints how long it took and
+how many times the journal was synced.
+
+With --unlocked, writers read and write the store without a transaction,
+like pifi did before, to show the changes that get lost.
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pifi.var_io as var_io
+
+
+def wifi_connection(ssid):
+    return {
+        "connection": {"id": ssid, "type": "802-11-wireless", "uuid": "uuid-%s" % ssid},
+        "802-11-wireless": {"ssid": ssid, "mode": "infrastructure"},
+    }
+
+
+def redirect_paths(directory):
+    for name in ("pending_path", "pending_journal_path", "pending_lock_path"):
+        setattr(
+            var_io,
+            name,
+            os.path.join(directory, os.path.basename(getattr(var_io, name))),
+        )
+
+
+def writer(number, args, directory, start, results):
+    redirect_paths(directory)
+    syncs = [0]
+
+    def fsync(fd):
+        syncs[0] += 1
+        os.fsync(fd)
+
+    def change(operation):
+        if args.unlocked:
+            store = var_io.readPendingStore()
+            operation(store)
+            var_io.writePendingStore(store, fsync=fsync)
+        else:
+            with var_io.pendingTransaction(fsync=fsync) as store:
+                operation(store)
+
+    start.wait()
+    for n in range(args.adds):
+        ssid = "writer%d-%d" % (number, n)
+        change(lambda store: store.add(wifi_connection(ssid)))
+        if n % 5 == 4:
+            change(lambda store: store.remove_ssid(ssid))
+    results.put(syncs[0])
+
+
+def expected(args):
+    return set(
+        "writer%d-%d" % (number, n)
+        for number in range(args.writers)
+        for n in range(args.adds)
+        if n % 5 != 4
+    )
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--writers", type=int, default=8, help="parallel processes")
+    parser.add_argument("--adds", type=int, default=50, help="adds per writer")
+    parser.add_argument(
+        "--unlocked", action="store_true", help="read and write without transactions"
+    )
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix="pifi-bench-")
+    try:
+        redirect_paths(directory)
+        start = multiprocessing.Barrier(args.writers + 1)
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=writer, args=(number, args, directory, start, results)
+            )
+            for number in range(args.writers)
+        ]
+        for process in processes:
+            process.start()
+        start.wait()
+        began = time.perf_counter()
+        syncs = sum(results.get() for process in processes)
+        for process in processes:
+            process.join()
+        duration = time.perf_counter() - began
+
+        found = set(con["802-11-wireless"]["ssid"] for con in var_io.readPendingStore())
+    finally:
+        shutil.rmtree(directory)
+
+    transactions = args.writers * (args.adds + args.adds // 5)
+    lost = expected(args) - found
+    extra = found - expected(args)
+    print(
+        "%d writers, %d transactions in %.2fs (%.2fms each), %d journal fsyncs"
+        % (
+            args.writers,
+            transactions,
+            duration,
+            duration * 1000 / transactions,
+            syncs,
+        )
+    )
+    if lost or extra:
+        print("LOST %d adds and %d removes" % (len(lost), len(extra)))
+        sys.exit(1)
+    print("Nothing lost, %d pending connections" % len(found))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Scale benchmarks for pifi, run against the fake NetworkManager in pifi.fake_nm.
+
+    python3 benchmarks/bench_scale.py [--max 10000] [--repeat 3] [--call-latency 0.0005]
+
+For every size the world has that many access points, saved connections and
+pending connections. Prints the best time of each operation, and how many
+D-Bus calls (and property reads) it made.
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pifi.fake_nm as fake_nm
+import pifi.var_io as var_io
+import pifi.etc_io as etc_io
+
+sizes = [1, 10, 100, 1000, 10000]
+
+
+def wifi_connection(ssid, psk):
+    return {
+        "connection": {
+            "id": ssid,
+            "type": "802-11-wireless",
+            "uuid": "uuid-%s" % ssid,
+        },
+        "802-11-wireless": {"ssid": ssid, "mode": "infrastructure"},
+        "802-11-wireless-security": {"key-mgmt": "wpa-psk", "psk": psk},
+    }
+
+
+def make_world(size, args):
+    """
+    A world with an AP capable device, a client device that sees size access
+    points, size saved connections and size pending connections.
+
+    Only the last pending connection has the right password.
+    """
+    world = fake_nm.World(
+        call_latency=args.call_latency, property_latency=args.property_latency
+    )
+    world.add_device("wlan0")
+    client = world.add_device("wlan1", ap_capable=False)
+    for i in range(size):
+        world.add_access_point(
+            client, "net%d" % i, psk="password%d" % i, strength=i % 100
+        )
+        world.add_connection(wifi_connection("saved%d" % i, "password%d" % i))
+    pending = [wifi_connection("net%d" % i, "wrong") for i in range(size - 1)]
+    pending.append(wifi_connection("net%d" % (size - 1), "password%d" % (size - 1)))
+    return world, client, pending
+
+
+def redirect_paths(directory):
+    """
+    Point the files pifi reads and writes into directory.
+    """
+    for name in (
+        "seen_SSIDs_path",
+        "scan_table_path",
+        "scan_history_path",
+        "pending_path",
+        "pending_journal_path",
+        "pending_lock_path",
+        "devices_path",
+        "last_network_path",
+        "connection_history_path",
+        "ap_profile_path",
+        "boot_trace_path",
+        "conf_cache_path",
+    ):
+        setattr(
+            var_io,
+            name,
+            os.path.join(directory, os.path.basename(getattr(var_io, name))),
+        )
+    etc_io.conf_path = os.path.join(directory, "pifi.conf")
+    etc_io.default_ap_path = os.path.join(directory, "default_ap.em")
+
+
+def run(operation, size, args):
+    """
+    Returns (best time, calls, property reads) of operation over args.repeat runs.
+    """
+    best = None
+    for _ in range(args.repeat):
+        world, client, pending = make_world(size, args)
+        fake_nm.install(world)
+        import pifi.nm_helper as nm
+        import pifi.startup as startup
+
+        directory = tempfile.mkdtemp(prefix="pifi-bench-")
+        try:
+            redirect_paths(directory)
+            conf = dict(etc_io.default_conf)
+            if operation == "select_devices":
+                measured = lambda: nm.select_devices(conf)
+            elif operation == "availibleConnections":
+                measured = lambda: list(nm.availibleConnections(client, pending))
+            elif operation == "selectConnection":
+                measured = lambda: nm.selectConnection(
+                    nm.availibleConnections(client, pending)
+                )
+            elif operation == "existingConnections":
+                measured = lambda: list(nm.existingConnections())
+            else:
+                var_io.writePendingConnections(pending)
+                startup.wait_for_boot = lambda: None
+                measured = startup.main
+
+            world.calls.clear()
+            start = time.perf_counter()
+            if operation == "startup.main":
+                with open(os.devnull, "w") as devnull:
+                    stdout, sys.stdout = sys.stdout, devnull
+                    try:
+                        measured()
+                    finally:
+                        sys.stdout = stdout
+            else:
+                measured()
+            duration = time.perf_counter() - start
+        finally:
+            fake_nm.uninstall()
+            shutil.rmtree(directory)
+
+        calls = sum(world.calls.values()) - world.calls["Get"]
+        if best is None or duration < best[0]:
+            best = (duration, calls, world.calls["Get"])
+    return best
+
+
+operations = [
+    "select_devices",
+    "availibleConnections",
+    "selectConnection",
+    "existingConnections",
+    "startup.main",
+]
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--max", type=int, default=sizes[-1], help="largest size to run"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement")
+    parser.add_argument(
+        "--call-latency", type=float, default=0.0, help="seconds per D-Bus call"
+    )
+    parser.add_argument(
+        "--property-latency", type=float, default=0.0, help="seconds per property read"
+    )
+    parser.add_argument(
+        "--operation", choices=operations, action="append", help="only run these"
+    )
+    args = parser.parse_args(argv)
+
+    print("%-22s %6s %12s %8s %8s" % ("operation", "size", "best", "calls", "props"))
+    for operation in args.operation or operations:
+        for size in sizes:
+            if size > args.max:
+                continue
+            duration, calls, properties = run(operation, size, args)
+            print(
+                "%-22s %6d %10.2fms %8d %8d"
+                % (operation, size, duration * 1000, calls, properties)
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+This module watches for the configuration button being pressed.
+
+The watcher sleeps in epoll until something happens, there are no periodic
+wakeups. Only the input devices with the configured name are kept open, and
+inotify on /dev/input picks up button devices that show up after boot.
+"""
+
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+import evdev
+
+input_dir = "/dev/input"
+
+# From linux/inotify.h
+IN_ATTRIB = 0x00000004
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+_event_header = struct.Struct("iIII")
+
+
+def parse_inotify_events(buf):
+    """
+    Returns a list of (mask, name) for the inotify events in buf.
+    """
+    events = []
+    offset = 0
+    while offset + _event_header.size <= len(buf):
+        wd, mask, cookie, length = _event_header.unpack_from(buf, offset)
+        offset += _event_header.size
+        name = buf[offset : offset + length].split(b"\0", 1)[0]
+        offset += length
+        events.append((mask, os.fsdecode(name)))
+    return events
+
+
+class Inotify(object):
+    """
+    Minimal inotify wrapper, python has no binding for it in the standard library.
+    """
+
+    def __init__(self, libc=None):
+        if libc is None:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def read(self):
+        """
+        Returns the pending events, see parse_inotify_events.
+        """
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 4096)
+            except BlockingIOError:
+                return events
+            if not buf:
+                return events
+            events.extend(parse_inotify_events(buf))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ButtonWatcher(object):
+    """
+    Waits for key to be pressed on any input device named device_name.
+    """
+
+    def __init__(
+        self,
+        device_name,
+        key=evdev.ecodes.KEY_CONFIG,
+        input_dir=input_dir,
+        InputDevice=evdev.InputDevice,
+        list_devices=evdev.list_devices,
+        Inotify=Inotify,
+        epoll=select.epoll,
+    ):
+        self.device_name = device_name
+        self.key = key
+        self.input_dir = input_dir
+        self._InputDevice = InputDevice
+        self._list_devices = list_devices
+        self._epoll = epoll()
+        # path -> open, grabbed, matching device
+        self.devices = {}
+        self._by_fd = {}
+
+        # Watch before listing, so that no device slips through in between
+        self._inotify = Inotify()
+        self._inotify.add_watch(input_dir, IN_CREATE | IN_ATTRIB)
+        self._epoll.register(self._inotify.fd, select.EPOLLIN)
+        self.scan()
+
+    def scan(self):
+        """
+        Open all matching input devices that are not open yet.
+        """
+        for path in self._list_devices(self.input_dir):
+            self.try_open(path)
+
+    def try_open(self, path):
+        """
+        Open the input device at path and keep it if it is the button,
+        close it again if it is not.
+        """
+        if path in self.devices:
+            return
+        try:
+            device = self._InputDevice(path)
+        except OSError:
+            # Gone again, or udev has not given us permission yet (IN_ATTRIB follows)
+            return
+
+        if device.name != self.device_name:
+            device.close()
+            return
+
+        print("Using %s" % path)
+        try:
+            device.grab()
+        except OSError as e:
+            print("WARN could not grab %s: %s" % (path, e))
+        self.devices[path] = device
+        self._by_fd[device.fd] = path
+        self._epoll.register(device.fd, select.EPOLLIN)
+
+    def drop(self, path):
+        """
+        Stop watching the input device at path, it was unplugged.
+        """
+        device = self.devices.pop(path)
+        del self._by_fd[device.fd]
+        self._epoll.unregister(device.fd)
+        try:
+            device.close()
+        except OSError:
+            pass
+
+    def _hotplug(self):
+        for mask, name in self._inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                self.scan()
+            elif name.startswith("event"):
+                self.try_open(os.path.join(self.input_dir, name))
+
+    def _pressed(self, path):
+        device = self.devices[path]
+        try:
+            for event in device.read():
+                if event.type == evdev.ecodes.EV_KEY and event.code == self.key:
+                    return True
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            if e.errno != errno.ENODEV:
+                raise
+            print("Button device %s was removed" % path)
+            self.drop(path)
+        return False
+
+    def wait(self):
+        """
+        Block until the button is pressed.
+        """
+        while True:
+            for fd, mask in self._epoll.poll():
+                if fd == self._inotify.fd:
+                    self._hotplug()
+                elif fd in self._by_fd:
+                    if self._pressed(self._by_fd[fd]):
+                        return
+
+    def close(self):
+        for path in list(self.devices):
+            self.drop(path)
+        self._epoll.close()
+        self._inotify.close()
@@ -0,0 +1,111 @@
+"""
+This module holds the pifi configuration (see etc_io.conf_path) as a Config,
+that is validated once when the file is read, and can't be changed after.
+"""
+
+import types
+import collections
+import collections.abc
+
+# Every setting pifi knows -> its default, in the order of pifi.conf
+defaults = collections.OrderedDict(
+    [
+        ("delete_existing_ap_connections", True),
+        ("ap_device", "any"),
+        ("client_device", "any"),
+        ("status_led", None),
+        ("button_device_name", None),
+        ("scan_timeout", 30),
+        ("connect_timeout", 30),
+    ]
+)
+
+
+def _bool(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    raise ValueError("not true or false")
+
+
+def _device(value):
+    if not isinstance(value, str) or value == "":
+        raise ValueError("not a device name")
+    return value
+
+
+def _optional_str(value):
+    # The commented out examples in pifi.conf say None, which YAML reads as a str
+    if value is None or value in ("", "None", "none"):
+        return None
+    if not isinstance(value, str):
+        raise ValueError("not a string")
+    return value
+
+
+def _timeout(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        raise ValueError("not a number of seconds")
+    return value
+
+
+_validators = {
+    "delete_existing_ap_connections": _bool,
+    "ap_device": _device,
+    "client_device": _device,
+    "status_led": _optional_str,
+    "button_device_name": _optional_str,
+    "scan_timeout": _timeout,
+    "connect_timeout": _timeout,
+}
+
+
+class Config(collections.abc.Mapping):
+    """
+    The pifi settings, as attributes or keys (conf.scan_timeout or
+    conf["scan_timeout"]).
+
+    Settings missing from values get their default, invalid ones too, with a
+    warning. Settings pifi does not know are kept as they are.
+    """
+
+    __slots__ = tuple(defaults) + ("_extra",)
+
+    def __init__(self, values=None, warn=print):
+        values = dict(values or {})
+        for name, default in defaults.items():
+            value = values.pop(name, default)
+            try:
+                value = _validators[name](value)
+            except ValueError as e:
+                warn(
+                    "WARN %s: %r in /etc/pifi/pifi.conf is %s, using %r"
+                    % (name, value, e, default)
+                )
+                value = default
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, "_extra", types.MappingProxyType(values))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Config can't be changed, read it again instead")
+
+    def __delattr__(self, name):
+        raise AttributeError("Config can't be changed, read it again instead")
+
+    def __getitem__(self, name):
+        if name in defaults:
+            return getattr(self, name)
+        return self._extra[name]
+
+    def __iter__(self):
+        for name in defaults:
+            yield name
+        for name in self._extra:
+            yield name
+
+    def __len__(self):
+        return len(defaults) + len(self._extra)
+
+    def __repr__(self):
+        return "Config(%r)" % dict(self)
@@ -0,0 +1,283 @@
+"""
+This module counts the D-Bus round-trips pifi makes to NetworkManager, so
+that chatty code shows up before it slows down robots.
+
+Calls are counted per phase (a boot phase from pifi.trace, or a pifi
+command) and per kind: "call" for method calls, "property" for property reads.
+Set PIFI_DBUS_STATS=1 to have pifi_startup and pifi print the counts.
+
+There are two ways to count:
+  * Stats.install() counts every method call python-dbus makes, property
+    reads are the Get and GetAll calls.
+  * Stats.wrap(obj) returns a stand-in for a NetworkManager like object
+    (or a mock of one), that counts attribute reads and method calls made
+    through it, and wraps everything it returns. The tests use this to check
+    call budgets.
+"""
+
+import os
+import math
+import time
+import collections
+
+env_var = "PIFI_DBUS_STATS"
+
+PROPERTIES_INTERFACE = "org.freedesktop.DBus.Properties"
+
+# Methods of python-networkmanager objects that don't talk to NetworkManager
+local_methods = frozenset(["SpecificDevice"])
+
+# Attributes that are plain python attributes of python-networkmanager objects
+local_attributes = frozenset(["object_path", "interface_names", "proxy"])
+
+
+def enabled(environ=os.environ):
+    """
+    Returns True if the stats should be collected and printed
+    """
+    return environ.get(env_var, "") not in ("", "0")
+
+
+class Histogram(object):
+    """
+    Count and timing of one kind of call, buckets are powers of 2 milliseconds
+    """
+
+    __slots__ = ("count", "total", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        # upper bound (ms) -> count
+        self.buckets = {}
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        ms = duration * 1000.0
+        bound = 1 if ms <= 1 else 2 ** int(math.ceil(math.log(ms, 2)))
+        self.buckets[bound] = self.buckets.get(bound, 0) + 1
+
+
+class Stats(object):
+    """
+    Collects Histograms by (phase, kind, name).
+
+    phase is a function that returns the name of the current phase, for
+    example lambda: tracer.current
+    """
+
+    def __init__(self, phase=None, clock=time.monotonic):
+        self._phase = phase
+        self._clock = clock
+        self.histograms = collections.OrderedDict()
+        self._wrappers = {}
+
+    def current_phase(self):
+        if self._phase is None:
+            return "main"
+        return self._phase() or "main"
+
+    def record(self, kind, name, duration):
+        key = (self.current_phase(), kind, name)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.add(duration)
+
+    def count(self, kind=None, name=None, phase=None):
+        """
+        Returns the number of calls recorded, of kind, name and in phase if given.
+        """
+        total = 0
+        for (key_phase, key_kind, key_name), histogram in self.histograms.items():
+            if kind is not None and key_kind != kind:
+                continue
+            if name is not None and key_name != name:
+                continue
+            if phase is not None and key_phase != phase:
+                continue
+            total += histogram.count
+        return total
+
+    def reset(self):
+        self.histograms.clear()
+
+    def timed(self, kind, name, func, *args, **kwargs):
+        start = self._clock()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.record(kind, name, self._clock() - start)
+
+    def property_read(self, obj, name, value, duration):
+        """
+        Called by wrapped objects when property name of obj was read.
+        """
+        self.record("property", name, duration)
+
+    def property_failed(self, obj, name, error, duration):
+        """
+        Called by wrapped objects when reading property name of obj raised error.
+        """
+        self.record("property", name, duration)
+
+    def method_call(self, obj, name, method, args, kwargs):
+        """
+        Called by wrapped objects to call method name of obj, returns what it returns.
+        """
+        return self.timed("call", name, method, *args, **kwargs)
+
+    def install(self, dbus=None):
+        """
+        Count every method call python-dbus makes through a proxy object.
+
+        Returns a function that undoes this.
+        """
+        if dbus is None:
+            import dbus.proxies
+        method_class = dbus.proxies._ProxyMethod
+        original = method_class.__call__
+        stats = self
+
+        def counted_call(method, *args, **keywords):
+            interface = keywords.get("dbus_interface", method._dbus_interface)
+            name = method._method_name
+            kind = "call"
+            if interface == PROPERTIES_INTERFACE and name in ("Get", "GetAll"):
+                kind = "property"
+                if len(args) > 1:
+                    name = "%s(%s)" % (name, args[1])
+            return stats.timed(kind, name, original, method, *args, **keywords)
+
+        method_class.__call__ = counted_call
+
+        def uninstall():
+            method_class.__call__ = original
+
+        return uninstall
+
+    def wrap(self, obj):
+        """
+        Returns obj wrapped so that the calls made through it are counted.
+
+        Lists and tuples are wrapped item by item, plain values are returned as is.
+        """
+        if obj is None or isinstance(obj, (bool, int, float, str, bytes, dict)):
+            return obj
+        if isinstance(obj, (type, _Counted)):
+            return obj
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.wrap(item) for item in obj)
+
+        # The same object always gets the same wrapper, so `is` still works
+        wrapper = self._wrappers.get(id(obj))
+        if wrapper is None or object.__getattribute__(wrapper, "_target") is not obj:
+            wrapper = self._wrappers[id(obj)] = _Counted(obj, self)
+        return wrapper
+
+    def summary(self):
+        """
+        Returns a json serializable list of dicts, one per (phase, kind, name).
+        """
+        return [
+            {
+                "phase": phase,
+                "kind": kind,
+                "name": name,
+                "count": histogram.count,
+                "total": histogram.total,
+                "buckets": dict((str(k), v) for k, v in histogram.buckets.items()),
+            }
+            for (phase, kind, name), histogram in self.histograms.items()
+        ]
+
+    def report(self):
+        """
+        Returns a human readable table of the counts.
+        """
+        lines = [
+            "%-14s %-9s %-32s %6s %9s" % ("phase", "kind", "name", "count", "total")
+        ]
+        for (phase, kind, name), histogram in self.histograms.items():
+            lines.append(
+                "%-14s %-9s %-32s %6d %8.1fms"
+                % (phase, kind, name, histogram.count, histogram.total * 1000)
+            )
+        lines.append(
+            "%d calls, %d property reads" % (self.count("call"), self.count("property"))
+        )
+        return "\n".join(lines)
+
+
+def _unwrap(value):
+    if isinstance(value, _Counted):
+        return object.__getattribute__(value, "_target")
+    if isinstance(value, (list, tuple)):
+        return type(value)(_unwrap(item) for item in value)
+    return value
+
+
+class _Counted(object):
+    """
+    Stand-in for an object that counts what is done through it, see Stats.wrap
+
+    name is set for methods, calling them is counted as a call of name, owner
+    is the object the method belongs to.
+    """
+
+    __slots__ = ("_target", "_stats", "_name", "_owner")
+
+    def __init__(self, target, stats, name=None, owner=None):
+        object.__setattr__(self, "_target", target)
+        object.__setattr__(self, "_stats", stats)
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_owner", owner)
+
+    def __getattr__(self, name):
+        target = object.__getattribute__(self, "_target")
+        stats = object.__getattribute__(self, "_stats")
+        start = stats._clock()
+        try:
+            value = getattr(target, name)
+        except Exception as e:
+            if not name.startswith("_"):
+                stats.property_failed(target, name, e, stats._clock() - start)
+            raise
+        if name.startswith("_") or name.isupper() or isinstance(value, type):
+            # Constants, exception classes and the like
+            return value
+        if name in local_attributes:
+            return stats.wrap(value)
+        if callable(value):
+            # Counted when it is called
+            return _Counted(value, stats, name, owner=target)
+
+        stats.property_read(target, name, value, stats._clock() - start)
+        return stats.wrap(value)
+
+    def __setattr__(self, name, value):
+        setattr(object.__getattribute__(self, "_target"), name, _unwrap(value))
+
+    def __call__(self, *args, **kwargs):
+        target = object.__getattribute__(self, "_target")
+        stats = object.__getattribute__(self, "_stats")
+        name = object.__getattribute__(self, "_name")
+        args = _unwrap(args)
+        kwargs = dict((k, _unwrap(v)) for k, v in kwargs.items())
+        if name is None or name in local_methods:
+            return stats.wrap(target(*args, **kwargs))
+        owner = object.__getattribute__(self, "_owner")
+        return stats.wrap(stats.method_call(owner, name, target, args, kwargs))
+
+    def __eq__(self, other):
+        return object.__getattribute__(self, "_target") == _unwrap(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(object.__getattribute__(self, "_target"))
+
+    def __repr__(self):
+        return "Counted(%r)" % (object.__getattribute__(self, "_target"),)
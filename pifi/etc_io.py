@@ -1,7 +1,8 @@
 """
 This module handles all of the pifi files in /etc
 
-For now this is just the default AP configuration
+These are the default AP configuration, the pifi configuration, and the
+system files pifi changes (hostname, hosts and the wifi country)
 """
 
 default_ap_path = "/etc/pifi/default_ap.em"
@@ -13,11 +14,17 @@ hosts_path = "/etc/hosts"
 crda_path = "/etc/default/crda"
 
 import os, sys
-import em
-import json, yaml
+import json
 import uuid
+import hashlib
 import re
 import ctypes
+import signal
+import collections.abc
+
+import pifi.template as template
+import pifi.config as config
+import pifi.var_io as var_io
 
 JSONDecodeError = ValueError
 if sys.version_info[0] >= 3.5:
@@ -50,9 +57,12 @@ def get_default_ap_conf(mac, open=open):
     try:
         with open(default_ap_path) as ap_conf_file:
             ap_conf = ap_conf_file.read()
-            expanded_ap_conf = em.expand(
+            # Compiled once, only a new uuid_str is rendered every time
+            expanded_ap_conf = template.expand(
                 ap_conf,
                 {"mac": mac, "uuid_str": str(uuid.uuid4()), "hostname": hostname},
+                volatile=("uuid_str",),
+                name=default_ap_path,
             )
             ap_config = json.loads(expanded_ap_conf)
 
@@ -98,34 +108,120 @@ def get_default_ap_conf(mac, open=open):
         return fallback_ap_conf
 
 
-default_conf = {
-    "delete_existing_ap_connections": True,
-    "ap_device": "any",
-    "client_device": "any",
-    "status_led": None,
-    "button_device_name": None,
-}
+def ap_conf_digest(ap_conf):
+    """
+    Returns a hash of the contents of an AP mode configuration, so that a saved
+    connection can be checked against a newly rendered one.
 
+    The uuid is left out, it is generated again every time the configuration is rendered.
+    """
+    contents = dict(ap_conf)
+    if "connection" in contents:
+        contents["connection"] = dict(contents["connection"])
+        contents["connection"].pop("uuid", None)
+    serialized = json.dumps(contents, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+# Every setting with its default value
+default_conf = config.Config()
+
+# (key, Config) of the configuration file last read
+_conf_cache = None
+
+
+def _conf_key(stat):
+    # Editing the file changes its mtime or size, replacing it changes its inode
+    return [stat.st_mtime_ns, stat.st_size, stat.st_ino]
 
-def get_conf(open=open):
-    try:
-        with open(conf_path) as conf_file:
-            conf = yaml.load(conf_file)
-            if conf is None:
-                print("WARN /etc/pifi/pifi.conf is empty, using default configuration")
-                return default_conf
 
-            for key, value in default_conf.items():
-                if key not in conf:
-                    conf[key] = value
+def _read_conf(open=open):
+    # Slow to import, only needed when the file changed
+    import yaml
 
-            return conf
+    try:
+        with open(conf_path) as conf_file:
+            values = yaml.safe_load(conf_file)
     except FileNotFoundError:
         print("WARN /etc/pifi/pifi.conf doesn't exist, using default configuration")
         return default_conf
-    except yaml.parser.ParserError:
+    except yaml.YAMLError:
+        print("WARN failed to parse /etc/pifi/pifi.conf, using default configuration")
+        return default_conf
+
+    if values is None:
+        print("WARN /etc/pifi/pifi.conf is empty, using default configuration")
+        return default_conf
+    if not isinstance(values, dict):
         print("WARN failed to parse /etc/pifi/pifi.conf, using default configuration")
         return default_conf
+    return config.Config(values)
+
+
+def get_conf(open=open, stat=os.stat, var_io=var_io):
+    """
+    Returns the pifi configuration as a pifi.config.Config, with the default
+    for every setting that is missing or invalid.
+
+    The file is only parsed again when it changed: the Config is kept for as
+    long as the file has the same mtime, size and inode, and saved to
+    var_io.conf_cache_path so that the next pifi commands don't parse it
+    (or import yaml) either.
+    """
+    global _conf_cache
+    try:
+        key = _conf_key(stat(conf_path))
+    except OSError:
+        # Can't tell if it changed, read it (or find it is not there)
+        return _read_conf(open=open)
+
+    if _conf_cache is not None and _conf_cache[0] == key:
+        return _conf_cache[1]
+
+    cached = var_io.readConfCache(conf_path, key)
+    if cached is not None:
+        conf = config.Config(cached)
+    else:
+        conf = _read_conf(open=open)
+        try:
+            var_io.writeConfCache(conf_path, key, dict(conf))
+        except (OSError, TypeError, ValueError):
+            # Not running as root, or settings that aren't json, parse it next time
+            pass
+    _conf_cache = (key, conf)
+    return conf
+
+
+class LiveConf(collections.abc.Mapping):
+    """
+    The configuration of a long running process: the settings of the Config
+    last read by reload(), which reads the file again if it changed.
+
+    Once watch() is called, SIGHUP reloads it (systemctl reload pifi).
+    """
+
+    def __init__(self):
+        self.current = get_conf()
+
+    def reload(self):
+        self.current = get_conf()
+        return self.current
+
+    def watch(self, signal=signal):
+        def reload(signum, frame):
+            print("Reloading /etc/pifi/pifi.conf")
+            self.reload()
+
+        signal.signal(signal.SIGHUP, reload)
+
+    def __getitem__(self, name):
+        return self.current[name]
+
+    def __iter__(self):
+        return iter(self.current)
+
+    def __len__(self):
+        return len(self.current)
 
 
 def get_hostname(open=open):
@@ -0,0 +1,821 @@
+"""
+An in-process stand-in for python-networkmanager, for benchmarks and tests
+that need more than a MagicMock can give: devices, access points, saved
+connections, activations that take time, D-Bus latency and signals.
+
+    world = fake_nm.World(scan_time=2, activation_time=1)
+    wlan0 = world.add_device("wlan0")
+    world.add_access_point(wlan0, "Home", psk="robotseverywhere")
+    fake_nm.install(world)
+    # pifi.nm_helper, pifi.startup and pifi.pifi now talk to world
+    fake_nm.uninstall()
+
+Time passes according to clock (time.monotonic by default). Things that
+take time (scans, activations) are settled whenever pifi talks to the
+world, and the signals NetworkManager would send are emitted on world.bus.
+"""
+
+import sys
+import copy
+import time
+import types
+import functools
+import importlib
+import collections
+
+import pifi.nm_events as nm_events
+
+# From NetworkManager.h, the ones pifi uses
+NM_DEVICE_TYPE_UNKNOWN = 0
+NM_DEVICE_TYPE_ETHERNET = 1
+NM_DEVICE_TYPE_WIFI = 2
+NM_DEVICE_TYPE_GENERIC = 14
+NM_DEVICE_TYPE_WIFI_P2P = 30
+
+NM_DEVICE_STATE_DISCONNECTED = 30
+NM_DEVICE_STATE_CONFIG = 50
+NM_DEVICE_STATE_ACTIVATED = 100
+
+NM_ACTIVE_CONNECTION_STATE_ACTIVATING = 1
+NM_ACTIVE_CONNECTION_STATE_ACTIVATED = 2
+NM_ACTIVE_CONNECTION_STATE_DEACTIVATED = 4
+
+NM_WIFI_DEVICE_CAP_AP = 64
+NM_802_11_AP_FLAGS_PRIVACY = 1
+NM_802_11_AP_SEC_PAIR_CCMP = 0x8
+NM_802_11_AP_SEC_KEY_MGMT_PSK = 0x100
+
+constants = dict(
+    (name, value) for name, value in globals().items() if name.startswith("NM_")
+)
+
+BASE_PATH = "/org/freedesktop/NetworkManager"
+PROPERTIES_INTERFACE = "org.freedesktop.DBus.Properties"
+DEVICE_INTERFACE = "org.freedesktop.NetworkManager.Device"
+WIRELESS_INTERFACE = "org.freedesktop.NetworkManager.Device.Wireless"
+ACTIVE_CONNECTION_INTERFACE = "org.freedesktop.NetworkManager.Connection.Active"
+SETTINGS_INTERFACE = "org.freedesktop.NetworkManager.Settings"
+CONNECTION_INTERFACE = "org.freedesktop.NetworkManager.Settings.Connection"
+
+
+class ObjectVanished(Exception):
+    def __init__(self, obj):
+        self.obj = obj
+        super(ObjectVanished, self).__init__(obj.object_path)
+
+
+# What NetworkManager errors look like, python-dbus' DBusException if it is installed
+DBusException = nm_events.DBusException
+
+
+def _ssid_bytes(ssid):
+    if isinstance(ssid, str):
+        return ssid.encode("utf-8")
+    if isinstance(ssid, (list, tuple)):
+        return b"".join(
+            bytes([part]) if isinstance(part, int) else part for part in ssid
+        )
+    return bytes(ssid)
+
+
+class Bus(object):
+    """
+    Delivers signals the same way python-dbus add_signal_receiver does,
+    right away when they are emitted.
+    """
+
+    def __init__(self):
+        self._receivers = []
+
+    def add_signal_receiver(
+        self,
+        handler,
+        signal_name=None,
+        dbus_interface=None,
+        bus_name=None,
+        path=None,
+        path_keyword=None,
+    ):
+        receiver = [handler, signal_name, dbus_interface, path, path_keyword]
+        self._receivers.append(receiver)
+        return _Match(self, receiver)
+
+    def emit(self, path, interface, signal_name, *args):
+        for handler, name, dbus_interface, match_path, path_keyword in list(
+            self._receivers
+        ):
+            if name is not None and name != signal_name:
+                continue
+            if dbus_interface is not None and dbus_interface != interface:
+                continue
+            if match_path is not None and match_path != path:
+                continue
+            kwargs = {}
+            if path_keyword is not None:
+                kwargs[path_keyword] = path
+            handler(*args, **kwargs)
+
+
+class _Match(object):
+    def __init__(self, bus, receiver):
+        self._bus = bus
+        self._receiver = receiver
+
+    def remove(self):
+        if self._receiver in self._bus._receivers:
+            self._bus._receivers.remove(self._receiver)
+
+
+class _Proxy(object):
+    """
+    Stands in for the python-dbus proxy python-networkmanager objects have
+    """
+
+    def __init__(self, obj):
+        self._obj = obj
+
+    @property
+    def object_path(self):
+        return self._obj.object_path
+
+    def GetAll(self, interface, dbus_interface=None):
+        self._obj._world.call("GetAll")
+        if self._obj._vanished:
+            # What python-dbus raises, python-networkmanager is not in the way
+            raise DBusException(
+                "No such interface '%s' on object at path %s"
+                % (dbus_interface, self.object_path),
+                name="org.freedesktop.DBus.Error.UnknownMethod",
+            )
+        return dict(self._obj._properties())
+
+
+class FakeObject(object):
+    """
+    Base for the fake NetworkManager objects, D-Bus properties are read with
+    attribute access, like with python-networkmanager.
+    """
+
+    interface_names = []
+    kind = "Object"
+
+    def __init__(self, world):
+        self._world = world
+        self._vanished = False
+        self.object_path = world.path(self.kind)
+        self.proxy = _Proxy(self)
+
+    def _properties(self):
+        return {}
+
+    def _check(self):
+        if self._vanished:
+            raise ObjectVanished(self)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        world = self.__dict__["_world"]
+        world.read(name)
+        self._check()
+        properties = self._properties()
+        if name not in properties:
+            raise AttributeError(name)
+        return properties[name]
+
+    def _emit_properties_changed(self, interface, changed):
+        self._world.bus.emit(
+            self.object_path,
+            PROPERTIES_INTERFACE,
+            "PropertiesChanged",
+            interface,
+            changed,
+            [],
+        )
+
+    def __repr__(self):
+        return "<%s %s>" % (type(self).__name__, self.object_path)
+
+
+class AccessPoint(FakeObject):
+    interface_names = ["org.freedesktop.NetworkManager.AccessPoint"]
+    kind = "AccessPoint"
+
+    def __init__(
+        self,
+        world,
+        ssid,
+        bssid,
+        strength=70,
+        frequency=2412,
+        max_bitrate=54000,
+        psk=None,
+        found_at=0.0,
+    ):
+        super(AccessPoint, self).__init__(world)
+        self.ssid = ssid
+        self.bssid = bssid
+        self.strength = strength
+        self.frequency = frequency
+        self.max_bitrate = max_bitrate
+        # None for an open network
+        self.psk = psk
+        # Seconds into a scan when the access point is found
+        self.found_at = found_at
+
+    def _properties(self):
+        secured = self.psk is not None
+        return {
+            "Ssid": self.ssid,
+            "HwAddress": self.bssid,
+            "Strength": self.strength,
+            "Frequency": self.frequency,
+            "MaxBitrate": self.max_bitrate,
+            "Flags": NM_802_11_AP_FLAGS_PRIVACY if secured else 0,
+            "WpaFlags": 0,
+            "RsnFlags": (
+                NM_802_11_AP_SEC_KEY_MGMT_PSK | NM_802_11_AP_SEC_PAIR_CCMP
+                if secured
+                else 0
+            ),
+        }
+
+
+class Connection(FakeObject):
+    interface_names = [CONNECTION_INTERFACE]
+    kind = "Settings"
+
+    def __init__(self, world, settings):
+        super(Connection, self).__init__(world)
+        self.settings = copy.deepcopy(settings)
+
+    def GetSettings(self):
+        self._world.call("GetSettings")
+        self._check()
+        settings = copy.deepcopy(self.settings)
+        # python-networkmanager turns the ssid into a str
+        wireless = settings.get("802-11-wireless", {})
+        if "ssid" in wireless:
+            wireless["ssid"] = _ssid_bytes(wireless["ssid"]).decode("utf-8", "replace")
+        # Secrets are not returned by GetSettings
+        settings.get("802-11-wireless-security", {}).pop("psk", None)
+        return settings
+
+    def GetSecrets(self, setting_name=None):
+        self._world.call("GetSecrets")
+        self._check()
+        if setting_name is None:
+            # Like python-networkmanager, the security setting of the connection
+            kind = self.settings["connection"]["type"]
+            setting_name = self.settings.get(kind, {}).get("security", kind)
+        return {setting_name: copy.deepcopy(self.settings.get(setting_name, {}))}
+
+    def Update(self, settings):
+        self._world.call("Update")
+        self._check()
+        self.settings = copy.deepcopy(settings)
+        self._world.bus.emit(self.object_path, CONNECTION_INTERFACE, "Updated")
+
+    def Delete(self):
+        self._world.call("Delete")
+        self._check()
+        self._world.remove_connection(self)
+
+    @property
+    def uuid(self):
+        return self.settings.get("connection", {}).get("uuid")
+
+
+class ActiveConnection(FakeObject):
+    interface_names = [ACTIVE_CONNECTION_INTERFACE]
+    kind = "ActiveConnection"
+
+    def __init__(self, world, connection, device, specific_object, ready_at):
+        super(ActiveConnection, self).__init__(world)
+        self.connection = connection
+        self.device = device
+        self.specific_object = specific_object
+        self.ready_at = ready_at
+        self.state = NM_ACTIVE_CONNECTION_STATE_ACTIVATING
+
+    def _properties(self):
+        return {
+            "State": self.state,
+            "Uuid": self.connection.uuid,
+            "Id": self.connection.settings.get("connection", {}).get("id"),
+            "Connection": self.connection,
+            "Devices": [self.device],
+            "SpecificObject": self.specific_object,
+        }
+
+    def _set_state(self, state):
+        self.state = state
+        self._world.bus.emit(
+            self.object_path, ACTIVE_CONNECTION_INTERFACE, "StateChanged", state, 0
+        )
+        self._emit_properties_changed(ACTIVE_CONNECTION_INTERFACE, {"State": state})
+
+
+class Device(FakeObject):
+    kind = "Devices"
+
+    def __init__(
+        self,
+        world,
+        interface,
+        device_type=NM_DEVICE_TYPE_WIFI,
+        ap_capable=True,
+        hw_address=None,
+    ):
+        super(Device, self).__init__(world)
+        self.interface = interface
+        self.device_type = device_type
+        self.ap_capable = ap_capable
+        self.hw_address = hw_address
+        self.access_points = []
+        self.active = None
+        self.scan_started = world.elapsed()
+        self.last_scan = -1
+        self.scanning = True
+
+    @property
+    def interface_names(self):
+        if self.device_type == NM_DEVICE_TYPE_WIFI:
+            return [DEVICE_INTERFACE, WIRELESS_INTERFACE]
+        return [DEVICE_INTERFACE]
+
+    def SpecificDevice(self):
+        return self
+
+    def visible_access_points(self):
+        elapsed = self._world.elapsed() - self.scan_started
+        if not self.scanning:
+            return list(self.access_points)
+        return [ap for ap in self.access_points if ap.found_at <= elapsed]
+
+    def state(self):
+        if self.active is None:
+            return NM_DEVICE_STATE_DISCONNECTED
+        if self.active.state == NM_ACTIVE_CONNECTION_STATE_ACTIVATED:
+            return NM_DEVICE_STATE_ACTIVATED
+        return NM_DEVICE_STATE_CONFIG
+
+    def _properties(self):
+        properties = {
+            "Interface": self.interface,
+            "DeviceType": self.device_type,
+            "State": self.state(),
+            "ActiveConnection": self.active,
+            "Managed": True,
+        }
+        if self.device_type == NM_DEVICE_TYPE_WIFI:
+            active_ap = None
+            if self.active is not None and self.active.state == (
+                NM_ACTIVE_CONNECTION_STATE_ACTIVATED
+            ):
+                active_ap = self.active.specific_object
+            properties.update(
+                {
+                    "HwAddress": self.hw_address,
+                    "PermHwAddress": self.hw_address,
+                    "WirelessCapabilities": (
+                        NM_WIFI_DEVICE_CAP_AP if self.ap_capable else 0
+                    ),
+                    "ActiveAccessPoint": active_ap,
+                    "AccessPoints": self.visible_access_points(),
+                }
+            )
+            if self._world.has_last_scan:
+                properties["LastScan"] = self.last_scan
+        return properties
+
+    def GetAccessPoints(self):
+        self._world.call("GetAccessPoints")
+        return self.visible_access_points()
+
+    def GetAllAccessPoints(self):
+        return self.GetAccessPoints()
+
+    def RequestScan(self, options):
+        self._world.call("RequestScan")
+        if self.active is not None and self.state() != NM_DEVICE_STATE_ACTIVATED:
+            raise DBusException("Scanning not allowed while activating")
+        self.scan_started = self._world.elapsed()
+        self.scanning = True
+
+    def GetAppliedConnection(self, flags):
+        self._world.call("GetAppliedConnection")
+        if self.active is None:
+            raise DBusException("Device is not activated")
+        return (self.active.connection.GetSettings(), 0)
+
+    def Disconnect(self):
+        self._world.call("Disconnect")
+        self._world.deactivate(self)
+
+
+class _NetworkManager(FakeObject):
+    interface_names = ["org.freedesktop.NetworkManager"]
+    kind = "NetworkManager"
+
+    def _properties(self):
+        return {
+            "Devices": list(self._world.devices),
+            "ActiveConnections": [
+                d.active for d in self._world.devices if d.active is not None
+            ],
+            "WirelessEnabled": True,
+            "Version": "1.22.10",
+        }
+
+    def GetDevices(self):
+        self._world.call("GetDevices")
+        return list(self._world.devices)
+
+    def GetDeviceByIpIface(self, interface):
+        self._world.call("GetDeviceByIpIface")
+        for device in self._world.devices:
+            if device.interface == interface:
+                return device
+        raise DBusException("No device found for the requested iface.")
+
+    def ActivateConnection(self, connection, device, specific_object):
+        self._world.call("ActivateConnection")
+        return self._world.activate(connection, device, specific_object)
+
+    def AddAndActivateConnection(self, settings, device, specific_object):
+        self._world.call("AddAndActivateConnection")
+        connection = self._world.add_connection(settings)
+        return (
+            connection,
+            self._world.activate(connection, device, specific_object),
+        )
+
+
+class _Settings(FakeObject):
+    interface_names = [SETTINGS_INTERFACE]
+    kind = "Settings"
+
+    def ListConnections(self):
+        self._world.call("ListConnections")
+        return list(self._world.connections.values())
+
+    def AddConnection(self, settings):
+        self._world.call("AddConnection")
+        return self._world.add_connection(settings)
+
+
+class _Fixups(object):
+    """
+    The fake objects already return python values
+    """
+
+    @staticmethod
+    def to_python(klass, method, name, value, signature):
+        return value
+
+    @staticmethod
+    def to_dbus(klass, method, name, value, signature):
+        return value
+
+
+class World(object):
+    """
+    Everything the fake NetworkManager knows about.
+
+    call_latency and property_latency are the seconds every method call and
+    property read takes, scan_time how long a scan takes (access points are
+    found during it, see add_access_point), and activation_time how long it
+    takes for a connection to activate (or fail).
+
+    has_last_scan False makes it look like NetworkManager < 1.12.
+    """
+
+    def __init__(
+        self,
+        call_latency=0.0,
+        property_latency=0.0,
+        scan_time=0.0,
+        activation_time=0.0,
+        has_last_scan=True,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.call_latency = call_latency
+        self.property_latency = property_latency
+        self.scan_time = scan_time
+        self.activation_time = activation_time
+        self.has_last_scan = has_last_scan
+        self.clock = clock
+        self.sleep = sleep
+        self._started = clock()
+        self._ids = collections.Counter()
+        # Method name (or "Get" for property reads) -> number of calls
+        self.calls = collections.Counter()
+        self.bus = Bus()
+        self.devices = []
+        # object path -> Connection, in the order they were added
+        self.connections = collections.OrderedDict()
+        self.NetworkManager = _NetworkManager(self)
+        self.Settings = _Settings(self)
+
+    def elapsed(self):
+        return self.clock() - self._started
+
+    def path(self, kind):
+        self._ids[kind] += 1
+        return "%s/%s/%d" % (BASE_PATH, kind, self._ids[kind])
+
+    def call(self, name):
+        self.calls[name] += 1
+        if self.call_latency:
+            self.sleep(self.call_latency)
+        self.settle()
+
+    def read(self, name):
+        self.calls["Get"] += 1
+        if self.property_latency:
+            self.sleep(self.property_latency)
+        self.settle()
+
+    def settle(self):
+        """
+        Finish the scans and activations that are done by now, and emit their signals.
+        """
+        elapsed = self.elapsed()
+        for device in self.devices:
+            if device.scanning and elapsed - device.scan_started >= self.scan_time:
+                device.scanning = False
+                if self.has_last_scan:
+                    device.last_scan = int((self._started + elapsed) * 1000)
+                for ap in device.access_points:
+                    self.bus.emit(
+                        device.object_path,
+                        WIRELESS_INTERFACE,
+                        "AccessPointAdded",
+                        ap.object_path,
+                    )
+                device._emit_properties_changed(
+                    WIRELESS_INTERFACE, {"LastScan": device.last_scan}
+                )
+
+            active = device.active
+            if (
+                active is not None
+                and active.state == NM_ACTIVE_CONNECTION_STATE_ACTIVATING
+                and elapsed >= active.ready_at
+            ):
+                if self.can_activate(active.connection, device, active.specific_object):
+                    active._set_state(NM_ACTIVE_CONNECTION_STATE_ACTIVATED)
+                    self.bus.emit(
+                        device.object_path,
+                        DEVICE_INTERFACE,
+                        "StateChanged",
+                        NM_DEVICE_STATE_ACTIVATED,
+                        NM_DEVICE_STATE_CONFIG,
+                        0,
+                    )
+                else:
+                    self.deactivate(device)
+
+    def add_device(
+        self,
+        interface,
+        device_type=NM_DEVICE_TYPE_WIFI,
+        ap_capable=True,
+        hw_address=None,
+    ):
+        if hw_address is None:
+            hw_address = "02:00:00:00:%02X:%02X" % divmod(len(self.devices) + 1, 256)
+        device = Device(
+            self,
+            interface,
+            device_type=device_type,
+            ap_capable=ap_capable,
+            hw_address=hw_address,
+        )
+        self.devices.append(device)
+        return device
+
+    def add_access_point(self, device, ssid, bssid=None, found_at=None, **kwargs):
+        """
+        Add an access point device can see, see AccessPoint for the other arguments.
+
+        found_at is how far into a scan (in seconds) it is found, by default
+        access points are spread out evenly over scan_time.
+        """
+        if bssid is None:
+            number = len(device.access_points) + 1
+            bssid = "0A:%02X:%02X:%02X:%02X:%02X" % (
+                (number >> 32) & 0xFF,
+                (number >> 24) & 0xFF,
+                (number >> 16) & 0xFF,
+                (number >> 8) & 0xFF,
+                number & 0xFF,
+            )
+        if found_at is None:
+            found_at = self.scan_time * (len(device.access_points) % 10) / 10.0
+        ap = AccessPoint(self, ssid, bssid, found_at=found_at, **kwargs)
+        device.access_points.append(ap)
+        return ap
+
+    def remove_access_point(self, device, ap):
+        device.access_points.remove(ap)
+        ap._vanished = True
+        self.bus.emit(
+            device.object_path, WIRELESS_INTERFACE, "AccessPointRemoved", ap.object_path
+        )
+
+    def add_connection(self, settings):
+        connection = Connection(self, settings)
+        self.connections[connection.object_path] = connection
+        self.bus.emit(
+            self.Settings.object_path,
+            SETTINGS_INTERFACE,
+            "NewConnection",
+            connection.object_path,
+        )
+        return connection
+
+    def remove_connection(self, connection):
+        for device in self.devices:
+            if device.active is not None and device.active.connection is connection:
+                self.deactivate(device)
+        del self.connections[connection.object_path]
+        connection._vanished = True
+        self.bus.emit(connection.object_path, CONNECTION_INTERFACE, "Removed")
+        self.bus.emit(
+            self.Settings.object_path,
+            SETTINGS_INTERFACE,
+            "ConnectionRemoved",
+            connection.object_path,
+        )
+
+    def get_connection(self, path):
+        if path not in self.connections:
+            raise DBusException("Object does not exist at path %s" % path)
+        return self.connections[path]
+
+    def can_activate(self, connection, device, specific_object):
+        """
+        Returns True if activating connection on device would work right now.
+        """
+        if connection._vanished:
+            return False
+        settings = connection.settings
+        wireless = settings.get("802-11-wireless")
+        if wireless is None or device.device_type != NM_DEVICE_TYPE_WIFI:
+            return False
+        if wireless.get("mode") == "ap":
+            return device.ap_capable
+
+        ssid = _ssid_bytes(wireless.get("ssid", b""))
+        candidates = device.visible_access_points()
+        if isinstance(specific_object, AccessPoint):
+            candidates = [specific_object] if specific_object in candidates else []
+        psk = settings.get("802-11-wireless-security", {}).get("psk")
+        secured = "802-11-wireless-security" in settings
+        for ap in candidates:
+            if _ssid_bytes(ap.ssid) != ssid:
+                continue
+            if (ap.psk is not None) != secured:
+                continue
+            if ap.psk is None or ap.psk == psk:
+                return True
+        return False
+
+    def activate(self, connection, device, specific_object):
+        connection._check()
+        if device.active is not None:
+            self.deactivate(device)
+        if not isinstance(specific_object, AccessPoint):
+            # Pick an access point like NetworkManager would, by SSID
+            wireless = connection.settings.get("802-11-wireless", {})
+            ssid = _ssid_bytes(wireless.get("ssid", b""))
+            specific_object = None
+            for ap in device.visible_access_points():
+                if _ssid_bytes(ap.ssid) == ssid:
+                    specific_object = ap
+                    break
+        active = ActiveConnection(
+            self,
+            connection,
+            device,
+            specific_object,
+            self.elapsed() + self.activation_time,
+        )
+        device.active = active
+        self.bus.emit(
+            device.object_path,
+            DEVICE_INTERFACE,
+            "StateChanged",
+            NM_DEVICE_STATE_CONFIG,
+            NM_DEVICE_STATE_DISCONNECTED,
+            0,
+        )
+        self.settle()
+        return active
+
+    def deactivate(self, device):
+        active = device.active
+        if active is None:
+            return
+        device.active = None
+        active._set_state(NM_ACTIVE_CONNECTION_STATE_DEACTIVATED)
+        active._vanished = True
+        self.bus.emit(
+            device.object_path,
+            DEVICE_INTERFACE,
+            "StateChanged",
+            NM_DEVICE_STATE_DISCONNECTED,
+            NM_DEVICE_STATE_ACTIVATED,
+            0,
+        )
+
+
+def module(world):
+    """
+    Returns a module that can stand in for python-networkmanager's NetworkManager.
+    """
+    fake = types.ModuleType("NetworkManager")
+    fake.__dict__.update(constants)
+    fake.NetworkManager = world.NetworkManager
+    fake.Settings = world.Settings
+    fake.Connection = world.get_connection
+    fake.ObjectVanished = ObjectVanished
+    fake.fixups = _Fixups()
+    fake.Device = fake.Wireless = fake.Generic = fake.Wired = Device
+    fake.AccessPoint = AccessPoint
+    fake.ActiveConnection = ActiveConnection
+    fake.device_class = lambda device_type: Device
+    fake.world = world
+    return fake
+
+
+# pifi modules that import NetworkManager when they are imported, reloaded so
+# they pick up the fake (the pifi commands import it when they run)
+pifi_modules = ["pifi.nm_helper", "pifi.startup"]
+
+_installed = []
+
+
+def install(world):
+    """
+    Make `import NetworkManager` return a fake module for world, and reload
+    the pifi modules that already imported the real one.
+
+    Waits in pifi.nm_events poll the world (using its clock and sleep), as
+    signals from the system bus won't come. Undo with uninstall().
+    """
+    install_module(module(world), clock=world.clock, sleep=world.sleep)
+
+
+def install_module(stand_in, poll=True, clock=time.monotonic, sleep=time.sleep):
+    """
+    Make `import NetworkManager` return stand_in, see install().
+
+    If poll is False, waits keep using signals if they can.
+    """
+    import pifi.nm_events as nm_events
+
+    _installed.append(
+        (
+            sys.modules.get("NetworkManager"),
+            nm_events.dbus,
+            nm_events.GLib,
+            nm_events.wait_until,
+        )
+    )
+    sys.modules["NetworkManager"] = stand_in
+    if poll:
+        nm_events.dbus = None
+        nm_events.GLib = None
+        # wait_until binds GLib when it is defined, and has to wait in the
+        # stand-in's time
+        nm_events.wait_until = functools.partial(
+            nm_events.wait_until, GLib=None, clock=clock, sleep=sleep
+        )
+    _reload()
+
+
+def uninstall():
+    """
+    Undo the last install() or install_module()
+    """
+    import pifi.nm_events as nm_events
+
+    original, nm_events.dbus, nm_events.GLib, nm_events.wait_until = _installed.pop()
+    if original is None:
+        # Nothing to reload them with, they are imported again when needed
+        del sys.modules["NetworkManager"]
+        for name in pifi_modules:
+            sys.modules.pop(name, None)
+    else:
+        sys.modules["NetworkManager"] = original
+        _reload()
+
+
+def _reload():
+    for name in pifi_modules:
+        if name in sys.modules:
+            importlib.reload(sys.modules[name])
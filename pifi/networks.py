@@ -0,0 +1,221 @@
+"""
+This module reads and writes lists of networks, for `pifi import` and
+`pifi export` to provision many networks at once.
+
+A network is a dict with its "ssid", and optionally a "password" (WPA2-PSK)
+and a "priority" (autoconnect-priority). When importing, a whole connection
+like the ones in the pending file (see var_io.pending_path) is accepted too.
+
+The formats are:
+
+    json  a JSON array of networks, or one JSON network per line
+    yaml  YAML documents that are networks, or lists of networks
+    csv   a header line naming the ssid, password and priority columns,
+          then one network per line
+
+Networks are read and written one at a time, so files of any size can be
+imported without holding the whole file in memory.
+"""
+
+import os
+import csv
+import json
+import uuid
+import fnmatch
+
+import pifi.pending as pending
+
+formats = ("json", "yaml", "csv")
+
+_extensions = {".json": "json", ".yaml": "yaml", ".yml": "yaml", ".csv": "csv"}
+
+csv_columns = ("ssid", "password", "priority")
+
+# Characters read from the stream at a time when reading JSON
+json_chunk_size = 64 * 1024
+
+
+def guess_format(path, default="json"):
+    """
+    Returns the format of the file at path from its extension, or default.
+    """
+    return _extensions.get(os.path.splitext(path)[1].lower(), default)
+
+
+def to_connection(network):
+    """
+    Returns the pending connection for a network, see the module docstring.
+
+    Raises ValueError if it is neither a network nor a wifi connection.
+    """
+    if not isinstance(network, dict):
+        raise ValueError("Expected a network, got %r" % (network,))
+    if "802-11-wireless" in network:
+        if pending.connection_ssid(network) is None:
+            raise ValueError("Connection without an SSID: %r" % (network,))
+        if pending.connection_uuid(network) is None:
+            # Give it one, so that it can be found in the pending journal
+            network.setdefault("connection", {})["uuid"] = str(uuid.uuid4())
+        return network
+
+    ssid = network.get("ssid")
+    if ssid is None or ssid == "":
+        raise ValueError("Network without an SSID: %r" % (network,))
+    # Empty cells of a CSV file are empty strings
+    password = network.get("password")
+    if password == "":
+        password = None
+    elif password is not None and not isinstance(password, str):
+        # YAML reads password: 12345678 as a number (and 01234567 as octal),
+        # str() of it is not necessarily what was written
+        raise ValueError(
+            "Password of %s is not a string, put it in quotes: %r" % (ssid, password)
+        )
+    priority = network.get("priority")
+    if priority == "" or priority is None:
+        priority = None
+    else:
+        try:
+            priority = int(priority)
+        except (TypeError, ValueError):
+            raise ValueError("Priority of %s is not a number: %r" % (ssid, priority))
+    return pending.wifi_connection(str(ssid), password, priority)
+
+
+def from_connection(con):
+    """
+    Returns the network for a connection, without the keys that are not set.
+    """
+    network = {"ssid": pending.connection_ssid(con)}
+    if pending.connection_password(con) is not None:
+        network["password"] = pending.connection_password(con)
+    if pending.connection_priority(con) != 0:
+        network["priority"] = pending.connection_priority(con)
+    return network
+
+
+def same_network(con, other):
+    """
+    Returns True if both connections connect to the same SSID the same way.
+    """
+    return from_connection(con) == from_connection(other)
+
+
+def ssid_matcher(ssids=(), patterns=()):
+    """
+    Returns a function that tells if an SSID is one of ssids, or matches one
+    of the shell style patterns (see fnmatch).
+    """
+    ssids = set(ssids)
+    patterns = list(patterns)
+
+    def matches(ssid):
+        if ssid is None:
+            return False
+        if ssid in ssids:
+            return True
+        return any(fnmatch.fnmatchcase(ssid, pattern) for pattern in patterns)
+
+    return matches
+
+
+def _read_json(stream):
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    end_of_file = False
+    while True:
+        # The array brackets, the commas and the newlines between networks
+        while position < len(buffer) and buffer[position] in "[], \t\r\n":
+            position += 1
+        if position == len(buffer):
+            if end_of_file:
+                return
+            buffer = stream.read(json_chunk_size)
+            position = 0
+            end_of_file = buffer == ""
+            continue
+        try:
+            network, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            # Most likely cut off at the end of the buffer, read some more
+            if end_of_file:
+                raise
+            more = stream.read(json_chunk_size)
+            end_of_file = more == ""
+            buffer = buffer[position:] + more
+            position = 0
+            continue
+        yield network
+
+
+def _read_yaml(stream):
+    import yaml
+
+    for document in yaml.safe_load_all(stream):
+        if isinstance(document, list):
+            for network in document:
+                yield network
+        elif document is not None:
+            yield document
+
+
+def _read_csv(stream):
+    reader = csv.DictReader(stream)
+    if reader.fieldnames is None:
+        return
+    reader.fieldnames = [name.strip().lower() for name in reader.fieldnames]
+    if "ssid" not in reader.fieldnames:
+        raise ValueError("CSV file without an ssid column")
+    for row in reader:
+        if any(value for value in row.values() if value):
+            yield row
+
+
+_readers = {"json": _read_json, "yaml": _read_yaml, "csv": _read_csv}
+
+
+def read_networks(stream, format="json"):
+    """
+    Generator of the pending connections for the networks read from stream,
+    a text file in format (see the module docstring).
+
+    Raises ValueError on networks that can't be read.
+    """
+    for network in _readers[format](stream):
+        yield to_connection(network)
+
+
+def write_networks(connections, stream, format="json"):
+    """
+    Writes the networks of connections to stream, a text file, in format (see
+    the module docstring). Returns the number of networks written.
+    """
+    written = 0
+    if format == "json":
+        for con in connections:
+            stream.write(",\n" if written > 0 else "[\n")
+            stream.write(json.dumps(from_connection(con)))
+            written += 1
+        stream.write("\n]\n" if written > 0 else "[]\n")
+    elif format == "yaml":
+        import yaml
+
+        for con in connections:
+            yaml.safe_dump(
+                from_connection(con),
+                stream,
+                explicit_start=True,
+                default_flow_style=False,
+                allow_unicode=True,
+            )
+            written += 1
+    elif format == "csv":
+        writer = csv.DictWriter(stream, csv_columns, lineterminator="\n")
+        writer.writeheader()
+        for con in connections:
+            writer.writerow(from_connection(con))
+            written += 1
+    else:
+        raise ValueError("Unknown format %r" % format)
+    return written
@@ -0,0 +1,141 @@
+"""
+This module lets pifi wait on NetworkManager D-Bus signals, so that it can
+move on as soon as NetworkManager is done with something, instead of sleeping
+for a fixed amount of time.
+
+Signals are only delivered while a GLib main loop is running. If GLib (or
+python-dbus) is not availible, waiting falls back to polling.
+"""
+
+import time
+
+try:
+    import dbus
+    import dbus.mainloop.glib
+    from gi.repository import GLib
+except ImportError:
+    dbus = None
+    GLib = None
+
+try:
+    from dbus.exceptions import DBusException
+except ImportError:
+
+    class DBusException(Exception):
+        """
+        Stands in for python-dbus' DBusException when it is not installed, it
+        is what pifi.fake_nm raises for NetworkManager errors.
+        """
+
+        def __init__(self, *args, **kwargs):
+            super(DBusException, self).__init__(*args)
+            self._dbus_error_name = kwargs.get("name")
+
+        def get_dbus_name(self):
+            return self._dbus_error_name
+
+
+NM_BUS_NAME = "org.freedesktop.NetworkManager"
+PROPERTIES_INTERFACE = "org.freedesktop.DBus.Properties"
+DEVICE_INTERFACE = "org.freedesktop.NetworkManager.Device"
+WIRELESS_INTERFACE = "org.freedesktop.NetworkManager.Device.Wireless"
+ACTIVE_CONNECTION_INTERFACE = "org.freedesktop.NetworkManager.Connection.Active"
+SETTINGS_INTERFACE = "org.freedesktop.NetworkManager.Settings"
+CONNECTION_INTERFACE = "org.freedesktop.NetworkManager.Settings.Connection"
+
+# How often to re-check the condition when we have to poll (seconds)
+poll_interval = 0.5
+
+
+def use_glib_mainloop(GLib=GLib):
+    """
+    Make python-dbus deliver signals through the GLib main loop.
+
+    This has to be called before the first NetworkManager property is read,
+    python-dbus binds the main loop when the system bus is first connected.
+
+    Returns False if GLib is not availible, and waits will poll instead.
+    """
+    if GLib is None:
+        return False
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    return True
+
+
+def signal(obj, signal_name, dbus_interface):
+    """
+    Returns a function that connects a callback to signal_name on obj.
+
+    The returned function is meant to be passed to wait_until in subscribe.
+    """
+
+    def connect(callback):
+        return dbus.SystemBus().add_signal_receiver(
+            callback,
+            signal_name=signal_name,
+            dbus_interface=dbus_interface,
+            bus_name=NM_BUS_NAME,
+            path=obj.object_path,
+        )
+
+    return connect
+
+
+def wait_until(
+    condition,
+    subscribe=(),
+    timeout=30,
+    GLib=GLib,
+    clock=time.monotonic,
+    sleep=time.sleep,
+):
+    """
+    Block until condition() returns True, or until timeout seconds have passed.
+
+    subscribe is a list of functions that take a callback and connect it to a
+    signal (see signal()), condition() is re-checked every time one of them fires.
+    If there is nothing to subscribe to, or GLib is not availible, condition()
+    is polled every poll_interval seconds instead.
+
+    Returns True if the condition was met, False if we timed out.
+    """
+    if GLib is None or len(subscribe) == 0:
+        deadline = clock() + timeout
+        while not condition():
+            remaining = deadline - clock()
+            if remaining <= 0:
+                return False
+            sleep(min(poll_interval, remaining))
+        return True
+
+    loop = GLib.MainLoop()
+    state = {"met": False, "done": False}
+
+    def check(*args, **kwargs):
+        # Signal matches can outlive the wait, ignore anything after we are done
+        if state["done"]:
+            return
+        if condition():
+            state["met"] = True
+            loop.quit()
+
+    def expire():
+        loop.quit()
+        return False  # Don't repeat the timer
+
+    # Subscribe before the first check, so that nothing happens unnoticed
+    # between checking and starting the loop
+    matches = [connect(check) for connect in subscribe]
+    try:
+        if condition():
+            return True
+        timer = GLib.timeout_add(int(timeout * 1000), expire)
+        loop.run()
+        if state["met"]:
+            GLib.source_remove(timer)
+        return state["met"]
+    finally:
+        state["done"] = True
+        for match in matches:
+            if match is not None:
+                match.remove()
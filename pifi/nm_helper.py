@@ -5,8 +5,15 @@ keep the rest of the code simpler.
 It wraps python-networkmanager.
 """
 
+import collections
+import time
+
 import NetworkManager
 
+import pifi.nm_events as nm_events
+import pifi.scoring as scoring
+from pifi.scan_table import ScanTable
+
 # This *very ugly hack* works around https://github.com/rohbotics/pifi/issues/30
 # The version of python3-networkmanager in Ubuntu 20.04 craps out with unknown device types
 # including Wifi-P2P which the DBus API reports on the Raspberry Pi. This monkey patch
@@ -51,18 +58,137 @@ except:
     pass
 
 
+# D-Bus errors for objects that are gone, python-networkmanager turns these
+# into ObjectVanished
+vanished_errors = (
+    "org.freedesktop.DBus.Error.UnknownMethod",
+    "org.freedesktop.DBus.Error.UnknownObject",
+)
+
+
+class PropertyCache(object):
+    """
+    Caches the D-Bus properties of NetworkManager objects.
+
+    The first time a property of an object is read, all of its properties are
+    fetched with one GetAll call per interface, instead of one Get call per
+    property read. Values are kept until a PropertiesChanged signal updates
+    them, or invalidate() is called.
+
+    Signals are only delivered while a main loop runs, so unless watch() has
+    been called call invalidate() after waiting for NetworkManager to change.
+
+    Objects without a D-Bus object path (like test doubles) are passed through.
+    """
+
+    def __init__(self, NetworkManager=NetworkManager, nm_events=nm_events):
+        self.NetworkManager = NetworkManager
+        self.nm_events = nm_events
+        self.watching = False
+        # object path -> {property name: raw dbus value}
+        self._snapshots = {}
+
+    def watch(self):
+        """
+        Keep cached values up to date using PropertiesChanged signals.
+
+        Returns False if signals can not be delivered (no GLib main loop).
+        """
+        if self.watching:
+            return True
+        if self.nm_events.GLib is None or self.nm_events.dbus is None:
+            return False
+        self.nm_events.dbus.SystemBus().add_signal_receiver(
+            self._properties_changed,
+            signal_name="PropertiesChanged",
+            dbus_interface=self.nm_events.PROPERTIES_INTERFACE,
+            bus_name=self.nm_events.NM_BUS_NAME,
+            path_keyword="path",
+        )
+        self.watching = True
+        return True
+
+    def invalidate(self, obj=None):
+        """
+        Forget the cached properties of obj, or of all objects if obj is None.
+        """
+        if obj is None:
+            self._snapshots.clear()
+        else:
+            self._snapshots.pop(getattr(obj, "object_path", None), None)
+
+    def snapshot(self, obj):
+        """
+        Returns the raw property values of obj, fetching them if needed.
+
+        Returns None if obj is not something we can fetch properties for.
+        Raises NetworkManager.ObjectVanished if obj is gone, like reading its
+        properties through python-networkmanager does.
+        """
+        path = getattr(obj, "object_path", None)
+        if not isinstance(path, str):
+            return None
+        snapshot = self._snapshots.get(path)
+        if snapshot is None:
+            snapshot = {}
+            try:
+                for interface in obj.interface_names:
+                    values = obj.proxy.GetAll(
+                        interface, dbus_interface=self.nm_events.PROPERTIES_INTERFACE
+                    )
+                    for name, value in values.items():
+                        snapshot[str(name)] = value
+            except AttributeError:
+                return None
+            except self.nm_events.DBusException as e:
+                # GetAll is called on the proxy, so python-networkmanager
+                # does not get to translate this
+                if e.get_dbus_name() in vanished_errors:
+                    raise self.NetworkManager.ObjectVanished(obj)
+                raise
+            self._snapshots[path] = snapshot
+        return snapshot
+
+    def get(self, obj, name):
+        """
+        Read property name of obj, the same as getattr(obj, name) but cached.
+        """
+        snapshot = self.snapshot(obj)
+        if snapshot is None or name not in snapshot:
+            return getattr(obj, name)
+        # Converting is done on read, so that object paths are only turned into
+        # objects (which can mean more D-Bus calls) if they are actually used
+        return self.NetworkManager.fixups.to_python(
+            type(obj).__name__, "Get", name, snapshot[name], None
+        )
+
+    def _properties_changed(self, interface, changed, invalidated, path=None):
+        snapshot = self._snapshots.get(path)
+        if snapshot is None:
+            return
+        for name, value in changed.items():
+            snapshot[str(name)] = value
+        for name in invalidated:
+            snapshot.pop(str(name), None)
+
+
+properties = PropertyCache()
+
+
 def checkCapablities(device_capabilities, capability):
     return device_capabilities & capability == capability
 
 
 def is_wireless_device(device, NetworkManager=NetworkManager):
-    return device.DeviceType == NetworkManager.NM_DEVICE_TYPE_WIFI
+    device_type = properties.get(device, "DeviceType")
+    return device_type == NetworkManager.NM_DEVICE_TYPE_WIFI
 
 
 def is_ap_capable(device, NetworkManager=NetworkManager):
     wi_device = device.SpecificDevice()
     supports_ap = checkCapablities(
-        wi_device.WirelessCapabilities, NetworkManager.NM_WIFI_DEVICE_CAP_AP
+        properties.get(wi_device, "WirelessCapabilities"),
+        NetworkManager.NM_WIFI_DEVICE_CAP_AP,
     )
     return supports_ap
 
@@ -101,62 +227,784 @@ def managedAPCapableDevices(NetworkManager=NetworkManager):
 def seenSSIDs(devices):
     for device in devices:
         for ap in device.SpecificDevice().GetAccessPoints():
-            yield ap.Ssid
+            yield properties.get(ap, "Ssid")
+
 
+def normalize_ssid(ssid):
+    """
+    Returns the SSID as bytes, so that SSIDs from NetworkManager and from
+    pending connections compare the same no matter how they were decoded.
+    """
+    if isinstance(ssid, str):
+        return ssid.encode("utf-8")
+    if isinstance(ssid, (list, tuple)):
+        # GetAppliedConnection returns the SSID as a list of bytes
+        return b"".join(ssid)
+    return bytes(ssid)
+
+
+def ssid_index(connections):
+    """
+    Returns a dict of normalized SSID -> list of connections with that SSID.
+
+    Connections keep their relative order, non wireless connections are skipped.
+    """
+    index = {}
+    for con in connections:
+        try:
+            ssid = normalize_ssid(con["802-11-wireless"]["ssid"])
+        except KeyError:
+            continue
+        index.setdefault(ssid, []).append(con)
+    return index
+
+
+def availibleConnections(device, connections, table=None):
+    """
+    Generator that yields (AccessPoint, Connection) for every access point the
+    device sees that has the SSID of one of the connections.
+
+    The SSID of each access point is read once, and looked up in an index of
+    the connections, instead of comparing every access point with every connection.
+    If a ScanTable of the device is given (see scan_table), the access points
+    are taken from it, and nothing has to be read from NetworkManager.
+    """
+    index = ssid_index(connections)
+    if len(index) == 0:
+        return
+
+    if table is not None:
+        for entry in table.entries():
+            for con in index.get(normalize_ssid(entry.ssid), ()):
+                for ap in entry.access_points:
+                    yield (ap, con)
+        return
 
-def availibleConnections(device, connections):
     access_points = device.SpecificDevice().GetAccessPoints()
     for ap in access_points:
-        for con in connections:
-            if ap.Ssid == con["802-11-wireless"]["ssid"]:
-                yield (ap, con)
+        for con in index.get(normalize_ssid(properties.get(ap, "Ssid")), ()):
+            yield (ap, con)
+
+
+def scan_table(devices, NetworkManager=NetworkManager):
+    """
+    Returns a ScanTable (see pifi.scan_table) of the access points the devices
+    see, built in one pass over them.
+    """
+    table = ScanTable()
+    for device in devices:
+        for ap in device.SpecificDevice().GetAccessPoints():
+            try:
+                features = candidate(ap, None, NetworkManager=NetworkManager)
+                table.add(
+                    properties.get(ap, "Ssid"),
+                    properties.get(ap, "HwAddress"),
+                    strength=features.strength,
+                    frequency=features.frequency,
+                    secured=features.ap_secured,
+                    last_seen=_read_number(ap, "LastSeen"),
+                    ap=ap,
+                )
+            except NetworkManager.ObjectVanished:
+                # Went out of range since we listed it
+                continue
+    return table
+
+
+def _number(value):
+    """
+    Returns value if it is a number, None if it is missing or something else.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return value
+
+
+def _read_number(obj, name):
+    try:
+        return _number(properties.get(obj, name))
+    except AttributeError:
+        return None
 
 
-def selectConnection(availible_connections):
+def candidate(ap, con, history=None, NetworkManager=NetworkManager):
     """
-    Select the best Access Point and connection based on signal strength
+    Collect the features of an (AccessPoint, Connection) pair for scoring.
+
+    history is a dict of normalized SSID -> (successes, failures), or None.
+    """
+    flags = [_read_number(ap, name) for name in ("Flags", "WpaFlags", "RsnFlags")]
+    ap_secured = None
+    if flags != [None, None, None]:
+        flags = [flag or 0 for flag in flags]
+        ap_secured = bool(
+            flags[0] & NetworkManager.NM_802_11_AP_FLAGS_PRIVACY or flags[1] or flags[2]
+        )
+
+    con_secured = None
+    priority = 0
+    con_history = None
+    if isinstance(con, dict):
+        con_secured = "802-11-wireless-security" in con
+        priority = _number(con.get("connection", {}).get("autoconnect-priority")) or 0
+        if history is not None and "802-11-wireless" in con:
+            con_history = history.get(normalize_ssid(con["802-11-wireless"]["ssid"]))
+
+    return scoring.Candidate(
+        ap,
+        con,
+        strength=_read_number(ap, "Strength"),
+        frequency=_read_number(ap, "Frequency"),
+        max_bitrate=_read_number(ap, "MaxBitrate"),
+        ap_secured=ap_secured,
+        con_secured=con_secured,
+        priority=priority,
+        history=con_history,
+    )
+
+
+def rankConnections(availible_connections, history=None, NetworkManager=NetworkManager):
+    """
+    Rank (AccessPoint, Connection) pairs from best to worst, see pifi.scoring.
+
+    history is a dict of normalized SSID -> (successes, failures), or None.
+
+    Return a list of (AccessPoint, Connection) tuples
+    """
+    candidates = [
+        candidate(ap, con, history=history, NetworkManager=NetworkManager)
+        for ap, con in availible_connections
+    ]
+    return [(c.ap, c.con) for c in scoring.rank(candidates)]
+
+
+def selectConnection(
+    availible_connections, history=None, NetworkManager=NetworkManager
+):
+    """
+    Select the best Access Point and connection, see rankConnections
 
     Return a tuple of (AccessPoint, Connection)
     """
-    max_strength = 0
-    best = None
-    for ap, con in availible_connections:
-        if ap.Strength > max_strength:
-            max_strength = ap.Strength
-            best = (ap, con)
+    ranked = rankConnections(
+        availible_connections, history=history, NetworkManager=NetworkManager
+    )
 
-    if best is not None:
-        return best
+    if len(ranked) > 0:
+        return ranked[0]
     else:
         raise ValueError("No connections in availible_connections could be found")
 
 
-def existingAPConnections(NetworkManager=NetworkManager):
-    for connection in NetworkManager.Settings.ListConnections():
-        settings = connection.GetSettings()
+def last_scan(device):
+    """
+    Returns when the device last finished a wifi scan, in CLOCK_BOOTTIME milliseconds.
+
+    This is -1 if the device has not finished a scan yet, and None if
+    NetworkManager is too old (< 1.12) to report it.
+    """
+    try:
+        return device.SpecificDevice().LastScan
+    except AttributeError:
+        return None
+
+
+def scan_done(device, since=-1, NetworkManager=NetworkManager):
+    """
+    Returns a function that checks if device finished a scan newer than since,
+    or got activated (at which point there is nothing left to wait for).
+    """
+    wi_device = device.SpecificDevice()
+
+    def done():
+        if device.State == NetworkManager.NM_DEVICE_STATE_ACTIVATED:
+            return True
+        return wi_device.LastScan > since
+
+    return done
+
+
+def access_points_settled(
+    device, settle_time=3, clock=time.monotonic, NetworkManager=NetworkManager
+):
+    """
+    Returns a function that checks if device got activated, or the list of access
+    points the device sees has stopped changing for settle_time seconds.
+
+    Used to decide when a scan is done on NetworkManager versions without LastScan.
+    """
+    wi_device = device.SpecificDevice()
+    seen = {"count": -1, "since": clock()}
+
+    def settled():
+        if device.State == NetworkManager.NM_DEVICE_STATE_ACTIVATED:
+            return True
+        count = len(wi_device.GetAccessPoints())
+        now = clock()
+        if count != seen["count"]:
+            seen["count"] = count
+            seen["since"] = now
+            return False
+        return count > 0 and now - seen["since"] >= settle_time
+
+    return settled
+
+
+def report_new_access_points(device, condition, on_access_point):
+    """
+    Wraps condition, so that every time it is checked on_access_point is called
+    with each access point that the device did not see at an earlier check.
+    """
+    wi_device = device.SpecificDevice()
+    reported = set()
+
+    def check():
+        for ap in wi_device.GetAccessPoints():
+            if ap.object_path not in reported:
+                reported.add(ap.object_path)
+                on_access_point(ap)
+        return condition()
+
+    return check
+
+
+def request_scan(device):
+    """
+    Ask NetworkManager to scan for access points on device.
+
+    Returns the LastScan value from before the request, pass it to wait_for_scan
+    to wait for this scan in particular. NetworkManager errors (for example if
+    the device is busy activating) are raised to the caller.
+    """
+    since = last_scan(device)
+    device.SpecificDevice().RequestScan({})
+    return since
+
+
+def wait_for_scan(
+    device,
+    timeout,
+    since=-1,
+    on_access_point=None,
+    NetworkManager=NetworkManager,
+    nm_events=nm_events,
+):
+    """
+    Block until device finishes a wifi scan newer than since, or gets activated.
+
+    By default any finished scan will do, pass the LastScan value from before
+    requesting a scan to wait for that scan in particular. If on_access_point
+    is given, it is called with each access point as it shows up.
+
+    Returns True if that happened before timeout seconds, False otherwise.
+    """
+    if last_scan(device) is None:
+        # No LastScan, so there are no signals that tell us a scan is done, poll
+        settled = access_points_settled(device, NetworkManager=NetworkManager)
+        if on_access_point is not None:
+            settled = report_new_access_points(device, settled, on_access_point)
+        return nm_events.wait_until(settled, timeout=timeout)
+
+    done = scan_done(device, since=since, NetworkManager=NetworkManager)
+    if on_access_point is not None:
+        done = report_new_access_points(device, done, on_access_point)
+
+    wi_device = device.SpecificDevice()
+    return nm_events.wait_until(
+        done,
+        subscribe=[
+            nm_events.signal(device, "StateChanged", nm_events.DEVICE_INTERFACE),
+            nm_events.signal(
+                wi_device, "AccessPointAdded", nm_events.WIRELESS_INTERFACE
+            ),
+            nm_events.signal(
+                wi_device, "PropertiesChanged", nm_events.PROPERTIES_INTERFACE
+            ),
+        ],
+        timeout=timeout,
+    )
+
+
+def wait_for_activation(
+    active_connection, timeout, NetworkManager=NetworkManager, nm_events=nm_events
+):
+    """
+    Block until active_connection is activated, or has failed to activate.
+
+    Returns True if it got activated within timeout seconds, False otherwise.
+    """
+    activated = NetworkManager.NM_ACTIVE_CONNECTION_STATE_ACTIVATED
+    deactivated = NetworkManager.NM_ACTIVE_CONNECTION_STATE_DEACTIVATED
+
+    def state():
+        try:
+            return active_connection.State
+        except Exception:
+            # NetworkManager removes the active connection object when it fails
+            return deactivated
+
+    nm_events.wait_until(
+        lambda: state() in (activated, deactivated),
+        subscribe=[
+            nm_events.signal(
+                active_connection,
+                "StateChanged",
+                nm_events.ACTIVE_CONNECTION_INTERFACE,
+            ),
+            nm_events.signal(
+                active_connection,
+                "PropertiesChanged",
+                nm_events.PROPERTIES_INTERFACE,
+            ),
+        ],
+        timeout=timeout,
+    )
+    return state() == activated
+
+
+def wait_for_network(
+    device,
+    active_connection,
+    ssid,
+    timeout,
+    NetworkManager=NetworkManager,
+    nm_events=nm_events,
+):
+    """
+    Block until active_connection is activated or has failed to activate, or
+    until device finished a scan that did not find ssid.
+
+    This is for activations started before the scan is done (see
+    activate_network), so that a network that is not around takes no longer
+    than the scan to give up on.
+
+    Returns True if it got activated within timeout seconds, None if the scan
+    finished without ssid in it, and False otherwise.
+    """
+    activated = NetworkManager.NM_ACTIVE_CONNECTION_STATE_ACTIVATED
+    deactivated = NetworkManager.NM_ACTIVE_CONNECTION_STATE_DEACTIVATED
+    ssid = normalize_ssid(ssid)
+    wi_device = device.SpecificDevice()
+    if last_scan(device) is None:
+        scanned = access_points_settled(device, NetworkManager=NetworkManager)
+    else:
+        scanned = scan_done(device, NetworkManager=NetworkManager)
+    # Once the scan found ssid, only the activation is left to wait for
+    seen = {"visible": False, "missing": False}
+
+    def state():
+        try:
+            return active_connection.State
+        except Exception:
+            # NetworkManager removes the active connection object when it fails
+            return deactivated
+
+    def done():
+        if state() in (activated, deactivated):
+            return True
+        if seen["visible"] or not scanned():
+            return False
+        seen["visible"] = any(
+            normalize_ssid(properties.get(ap, "Ssid")) == ssid
+            for ap in wi_device.GetAccessPoints()
+        )
+        seen["missing"] = not seen["visible"]
+        return seen["missing"]
+
+    nm_events.wait_until(
+        done,
+        subscribe=[
+            nm_events.signal(
+                active_connection,
+                "StateChanged",
+                nm_events.ACTIVE_CONNECTION_INTERFACE,
+            ),
+            nm_events.signal(
+                active_connection,
+                "PropertiesChanged",
+                nm_events.PROPERTIES_INTERFACE,
+            ),
+            nm_events.signal(device, "StateChanged", nm_events.DEVICE_INTERFACE),
+            nm_events.signal(
+                wi_device, "PropertiesChanged", nm_events.PROPERTIES_INTERFACE
+            ),
+        ],
+        timeout=timeout,
+    )
+    if state() == activated:
+        return True
+    if seen["missing"]:
+        return None
+    return False
+
+
+class SettingsIndex(object):
+    """
+    Index of the connections saved in NetworkManager, by SSID, mode and UUID.
+
+    It is built with one GetSettings call per saved connection the first time
+    it is used. After that watch() keeps it up to date from the Settings
+    NewConnection/ConnectionRemoved and Connection Updated signals, and callers
+    that change connections themselves can use add() and forget().
+    """
+
+    def __init__(self, NetworkManager=NetworkManager, nm_events=nm_events):
+        self.NetworkManager = NetworkManager
+        self.nm_events = nm_events
+        self.watching = False
+        # object path -> (connection, settings), in the order NetworkManager lists them
+        self._connections = None
+        self._by_uuid = {}
+        self._by_ssid = {}
+        self._by_mode = {}
+
+    def _key(self, connection):
+        return getattr(connection, "object_path", connection)
+
+    def _build(self):
+        if self._connections is None:
+            self._connections = collections.OrderedDict()
+            for connection in self.NetworkManager.Settings.ListConnections():
+                self.add(connection)
+        return self._connections
+
+    def refresh(self):
+        """
+        Rebuild the index from scratch.
+        """
+        self._connections = None
+        self._by_uuid = {}
+        self._by_ssid = {}
+        self._by_mode = {}
+        self._build()
+
+    def add(self, connection, settings=None):
+        """
+        Add (or update) a saved connection, reading its settings if not given.
+        """
+        if settings is None:
+            settings = connection.GetSettings()
+        if self._connections is None:
+            self._connections = collections.OrderedDict()
+        key = self._key(connection)
+        self.forget(connection)
+        self._connections[key] = (connection, settings)
+
+        uuid = settings.get("connection", {}).get("uuid")
+        if uuid is not None:
+            self._by_uuid[uuid] = key
         if "802-11-wireless" in settings:
-            if settings["802-11-wireless"]["mode"] == "ap":
-                yield connection
+            wireless = settings["802-11-wireless"]
+            if "ssid" in wireless:
+                ssid = normalize_ssid(wireless["ssid"])
+                self._by_ssid.setdefault(ssid, []).append(key)
+            mode = wireless.get("mode", "infrastructure")
+            self._by_mode.setdefault(mode, []).append(key)
+
+    def forget(self, connection):
+        """
+        Remove a connection from the index, for example after deleting it.
+        """
+        key = self._key(connection)
+        if self._connections is None or key not in self._connections:
+            return
+        del self._connections[key]
+        for index in (self._by_ssid, self._by_mode):
+            for value, keys in list(index.items()):
+                if key in keys:
+                    keys.remove(key)
+                    if len(keys) == 0:
+                        del index[value]
+        for uuid, value in list(self._by_uuid.items()):
+            if value == key:
+                del self._by_uuid[uuid]
+
+    def all(self):
+        """
+        Returns a list of (connection, settings) for every saved connection.
+        """
+        return list(self._build().values())
+
+    def by_uuid(self, uuid):
+        """
+        Returns (connection, settings) of the connection with uuid, or None.
+        """
+        connections = self._build()
+        key = self._by_uuid.get(uuid)
+        if key is None:
+            return None
+        return connections[key]
+
+    def by_ssid(self, ssid, ap=None):
+        """
+        Returns a list of (connection, settings) of the wifi connections to ssid.
+
+        If ap is True, only AP mode connections are returned, if False only
+        connections that are not AP mode.
+        """
+        connections = self._build()
+        found = [
+            connections[key] for key in self._by_ssid.get(normalize_ssid(ssid), ())
+        ]
+        if ap is None:
+            return found
+        return [
+            (connection, settings)
+            for connection, settings in found
+            if (settings["802-11-wireless"].get("mode") == "ap") == ap
+        ]
+
+    def by_mode(self, mode):
+        """
+        Returns a list of (connection, settings) of the wifi connections in mode.
+        """
+        connections = self._build()
+        return [connections[key] for key in self._by_mode.get(mode, ())]
+
+    def wireless(self, ap):
+        """
+        Returns a list of (connection, settings) of the AP mode wifi connections
+        if ap is True, or of the other wifi connections if ap is False.
+        """
+        connections = self._build()
+        keys = set()
+        for mode, mode_keys in self._by_mode.items():
+            if (mode == "ap") == ap:
+                keys.update(mode_keys)
+        # Keep the order NetworkManager listed them in
+        return [value for key, value in connections.items() if key in keys]
+
+    def watch(self):
+        """
+        Keep the index up to date using signals from NetworkManager.
+
+        Returns False if signals can not be delivered (no GLib main loop).
+        """
+        if self.watching:
+            return True
+        if self.nm_events.GLib is None or self.nm_events.dbus is None:
+            return False
+        bus = self.nm_events.dbus.SystemBus()
+        bus.add_signal_receiver(
+            self._connection_added,
+            signal_name="NewConnection",
+            dbus_interface=self.nm_events.SETTINGS_INTERFACE,
+            bus_name=self.nm_events.NM_BUS_NAME,
+        )
+        bus.add_signal_receiver(
+            self._connection_removed,
+            signal_name="ConnectionRemoved",
+            dbus_interface=self.nm_events.SETTINGS_INTERFACE,
+            bus_name=self.nm_events.NM_BUS_NAME,
+        )
+        bus.add_signal_receiver(
+            self._connection_updated,
+            signal_name="Updated",
+            dbus_interface=self.nm_events.CONNECTION_INTERFACE,
+            bus_name=self.nm_events.NM_BUS_NAME,
+            path_keyword="path",
+        )
+        self.watching = True
+        return True
+
+    def _connection_added(self, path):
+        if self._connections is not None:
+            self.add(self.NetworkManager.Connection(path))
+
+    def _connection_removed(self, path):
+        if self._connections is not None and path in self._connections:
+            self.forget(self._connections[path][0])
+
+    def _connection_updated(self, path=None):
+        if self._connections is not None and path in self._connections:
+            self.add(self._connections[path][0])
+
+
+_saved_connections = None
+
+
+def saved_connections(NetworkManager=NetworkManager):
+    """
+    Returns the SettingsIndex of the connections saved in NetworkManager.
+
+    The same index is returned every time, so it is only built once.
+    """
+    global _saved_connections
+    if (
+        _saved_connections is None
+        or _saved_connections.NetworkManager is not NetworkManager
+    ):
+        _saved_connections = SettingsIndex(NetworkManager=NetworkManager)
+    return _saved_connections
+
+
+def existingAPConnections(NetworkManager=NetworkManager):
+    for connection, settings in saved_connections(NetworkManager).wireless(ap=True):
+        yield connection
 
 
 def existingConnections(NetworkManager=NetworkManager):
-    for connection in NetworkManager.Settings.ListConnections():
-        settings = connection.GetSettings()
-        if "802-11-wireless" in settings:
-            if settings["802-11-wireless"]["mode"] != "ap":
-                yield connection
+    for connection, settings in saved_connections(NetworkManager).wireless(ap=False):
+        yield connection
+
+
+def active_network(device):
+    """
+    Returns a dict describing the network the wifi device is connected to, with
+    the keys ssid, bssid, frequency and uuid (of the NetworkManager connection).
+
+    Returns None if the device is not connected to an access point.
+    """
+    active_connection = properties.get(device, "ActiveConnection")
+    ap = properties.get(device.SpecificDevice(), "ActiveAccessPoint")
+    if active_connection is None or ap is None:
+        return None
+
+    return {
+        "ssid": properties.get(ap, "Ssid"),
+        "bssid": properties.get(ap, "HwAddress"),
+        "frequency": properties.get(ap, "Frequency"),
+        "uuid": properties.get(active_connection, "Uuid"),
+    }
+
+
+def activate_network(device, network, NetworkManager=NetworkManager):
+    """
+    Start activating the saved connection of a network from active_network on
+    device, without waiting for a scan. If the device already sees the access
+    point it was connected through (same BSSID), NetworkManager is asked to use it.
+
+    Returns the active connection (see wait_for_activation), or None if there
+    is no saved connection for the network anymore.
+    """
+    saved = saved_connections(NetworkManager=NetworkManager).by_uuid(network["uuid"])
+    if saved is None:
+        return None
+    connection, settings = saved
+
+    # NetworkManager may already be autoconnecting to it, don't start over
+    active_connection = properties.get(device, "ActiveConnection")
+    if (
+        active_connection is not None
+        and properties.get(active_connection, "Uuid") == network["uuid"]
+    ):
+        return active_connection
+
+    specific_object = "/"
+    for ap in device.SpecificDevice().GetAccessPoints():
+        if properties.get(ap, "HwAddress") == network["bssid"]:
+            specific_object = ap
+            break
+
+    return NetworkManager.NetworkManager.ActivateConnection(
+        connection, device, specific_object
+    )
+
+
+class DeviceRecord(object):
+    """
+    What select_devices needs to know about one NetworkManager device.
+    """
+
+    __slots__ = (
+        "device",
+        "interface",
+        "device_type",
+        "capabilities",
+        "state",
+        "hw_address",
+        "mac",
+        "is_wireless",
+        "is_ap_capable",
+    )
+
+    def __init__(self, device, NetworkManager=NetworkManager):
+        self.device = device
+        self.interface = properties.get(device, "Interface")
+        self.device_type = properties.get(device, "DeviceType")
+        self.state = properties.get(device, "State")
+        self.is_wireless = self.device_type == NetworkManager.NM_DEVICE_TYPE_WIFI
+        self.capabilities = None
+        self.hw_address = None
+        self.mac = None
+        self.is_ap_capable = False
+        if self.is_wireless:
+            wi_device = device.SpecificDevice()
+            self.capabilities = properties.get(wi_device, "WirelessCapabilities")
+            self.hw_address = properties.get(wi_device, "HwAddress")
+            # HwAddress can be randomized while scanning, prefer the permanent one
+            try:
+                self.mac = properties.get(wi_device, "PermHwAddress") or self.hw_address
+            except AttributeError:
+                self.mac = self.hw_address
+            self.is_ap_capable = checkCapablities(
+                self.capabilities, NetworkManager.NM_WIFI_DEVICE_CAP_AP
+            )
+
+
+class DeviceInventory(object):
+    """
+    All devices managed by NetworkManager, with their interface, type,
+    capabilities and state, gathered in one pass over GetDevices.
+    """
+
+    def __init__(self, NetworkManager=NetworkManager):
+        self.NetworkManager = NetworkManager
+        self.records = [
+            DeviceRecord(device, NetworkManager=NetworkManager)
+            for device in NetworkManager.NetworkManager.GetDevices()
+        ]
+
+    def wifi(self):
+        """
+        Returns the records of the wifi devices.
+        """
+        return [record for record in self.records if record.is_wireless]
+
+    def ap_capable(self):
+        """
+        Returns the records of the AP capable wifi devices.
+        """
+        return [record for record in self.records if record.is_ap_capable]
+
+    def find_by_mac(self, mac):
+        """
+        Returns the record of the wifi device with the (permanent) MAC address, or None.
+        """
+        for record in self.wifi():
+            if record.mac == mac:
+                return record
+        return None
+
+    def find(self, name):
+        """
+        Returns the record of the device with interface name.
+
+        Devices that were not enumerated are looked up in NetworkManager, so
+        an unknown name raises whatever GetDeviceByIpIface raises.
+        """
+        for record in self.records:
+            if record.interface == name:
+                return record
+        device = get_device_by_name(name, NetworkManager=self.NetworkManager)
+        return DeviceRecord(device, NetworkManager=self.NetworkManager)
 
 
-def select_devices(pifi_conf, NetworkManager=NetworkManager):
+def select_devices(pifi_conf, NetworkManager=NetworkManager, inventory=None):
     """
     Select the ap mode device and client mode devices to use
 
+    All the decisions are made from a DeviceInventory, pass one in if you
+    already have it.
+
     returns a tuple of (ap_device, client_device)
     """
-    devices = list(managedWifiDevices(NetworkManager=NetworkManager))
+    if inventory is None:
+        inventory = DeviceInventory(NetworkManager=NetworkManager)
+    devices = inventory.wifi()
 
-    ap_device = None
-    client_device = None
+    ap_record = None
+    client_record = None
 
     # Fail immediately if no devices
     if len(devices) == 0:
@@ -164,30 +1012,26 @@ def select_devices(pifi_conf, NetworkManager=NetworkManager):
 
     # If a specific ap_device is specified, use it if it is ap capable
     if pifi_conf["ap_device"] != "any":
-        ap_device = get_device_by_name(
-            pifi_conf["ap_device"], NetworkManager=NetworkManager
-        )
+        ap_record = inventory.find(pifi_conf["ap_device"])
 
-        assert is_ap_capable(ap_device, NetworkManager=NetworkManager), (
+        assert ap_record.is_ap_capable, (
             "Specified ap_device %s is not ap capable" % pifi_conf["ap_device"]
         )
 
     # If a specific client_device is specified, use it if it is wireless
     if pifi_conf["client_device"] != "any":
-        client_device = get_device_by_name(
-            pifi_conf["client_device"], NetworkManager=NetworkManager
-        )
+        client_record = inventory.find(pifi_conf["client_device"])
 
-        assert is_wireless_device(client_device, NetworkManager=NetworkManager), (
+        assert client_record.is_wireless, (
             "Specified client_device %s is not wireless" % pifi_conf["client_device"]
         )
 
     # If ap_device can be any, use the first one that isn't the same as client_device
     if pifi_conf["ap_device"] == "any":
-        for device in managedAPCapableDevices(NetworkManager=NetworkManager):
-            ap_device = device
-            if client_device is not None and (
-                client_device.Interface == ap_device.Interface
+        for record in inventory.ap_capable():
+            ap_record = record
+            if client_record is not None and (
+                client_record.interface == ap_record.interface
             ):
                 continue
             else:
@@ -196,12 +1040,123 @@ def select_devices(pifi_conf, NetworkManager=NetworkManager):
     # If client_device can be any, use the first one that isn't the same as ap_device
     # If all are the same, use ay of them
     if pifi_conf["client_device"] == "any":
-        for device in devices:
-            client_device = device
-            if client_device.Interface == ap_device.Interface:
+        for record in devices:
+            client_record = record
+            if ap_record is not None and client_record.interface == ap_record.interface:
                 continue
             else:
                 break
 
-    if (ap_device is not None) and (client_device is not None):
-        return (ap_device, client_device)
+    if (ap_record is not None) and (client_record is not None):
+        return (ap_record.device, client_record.device)
+
+
+def device_selection(
+    pifi_conf, ap_device, client_device, NetworkManager=NetworkManager
+):
+    """
+    Returns a json serializable description of the selected devices, that
+    select_devices_cached can validate on the next boot.
+
+    The devices are identified by MAC address, interface names can change.
+    """
+    selection = {
+        "ap_device": pifi_conf["ap_device"],
+        "client_device": pifi_conf["client_device"],
+    }
+    for role, device in (("ap", ap_device), ("client", client_device)):
+        record = DeviceRecord(device, NetworkManager=NetworkManager)
+        selection[role] = {"mac": record.mac, "interface": record.interface}
+    return selection
+
+
+def _cached_record(
+    selection, role, configured="any", inventory=None, NetworkManager=NetworkManager
+):
+    """
+    Find the device selection says was used for role, and check it still can be.
+
+    Without an inventory this is the fast path, the device is looked up by its
+    interface name, and only used if its MAC address still matches. With one,
+    it is looked up by MAC address, in case its interface was renamed, but
+    only if the interface configured for role is "any".
+    """
+    cached = selection[role]
+    if inventory is not None:
+        record = inventory.find_by_mac(cached["mac"])
+        if record is not None and configured not in ("any", record.interface):
+            # The user asked for an interface, not for this device
+            return None
+    else:
+        device = get_device_by_name(cached["interface"], NetworkManager=NetworkManager)
+        record = DeviceRecord(device, NetworkManager=NetworkManager)
+        if record.mac != cached["mac"]:
+            return None
+
+    if record is None or not record.is_wireless:
+        return None
+    if role == "ap" and not record.is_ap_capable:
+        return None
+    return record
+
+
+def select_devices_cached(pifi_conf, selection, NetworkManager=NetworkManager):
+    """
+    Select the ap mode device and client mode devices, reusing the selection
+    from the previous boot (see device_selection) if it is still valid.
+
+    Validating the cached selection takes a couple of D-Bus calls, only if it
+    fails are all devices enumerated. Even then the same physical devices are
+    picked if they are still there, in case their interfaces were renamed.
+
+    returns a tuple of (ap_device, client_device, new_selection), where
+    new_selection is None if the cached selection can be kept as it is.
+    """
+    usable = (
+        selection is not None
+        and selection.get("ap_device") == pifi_conf["ap_device"]
+        and selection.get("client_device") == pifi_conf["client_device"]
+        and "ap" in selection
+        and "client" in selection
+    )
+
+    if usable:
+        try:
+            ap_record = _cached_record(
+                selection,
+                "ap",
+                pifi_conf["ap_device"],
+                NetworkManager=NetworkManager,
+            )
+            client_record = _cached_record(
+                selection,
+                "client",
+                pifi_conf["client_device"],
+                NetworkManager=NetworkManager,
+            )
+        except Exception:
+            # The interface is gone (NetworkManager raises UnknownDevice)
+            ap_record = client_record = None
+        if ap_record is not None and client_record is not None:
+            return (ap_record.device, client_record.device, None)
+
+    inventory = DeviceInventory(NetworkManager=NetworkManager)
+    devices = None
+    if usable:
+        ap_record = _cached_record(
+            selection, "ap", pifi_conf["ap_device"], inventory=inventory
+        )
+        client_record = _cached_record(
+            selection, "client", pifi_conf["client_device"], inventory=inventory
+        )
+        if ap_record is not None and client_record is not None:
+            devices = (ap_record.device, client_record.device)
+    if devices is None:
+        devices = select_devices(
+            pifi_conf, NetworkManager=NetworkManager, inventory=inventory
+        )
+    ap_device, client_device = devices
+    new_selection = device_selection(
+        pifi_conf, ap_device, client_device, NetworkManager=NetworkManager
+    )
+    return (ap_device, client_device, new_selection)
@@ -0,0 +1,222 @@
+"""
+This module keeps the pending connections (see var_io.pending_path) indexed
+by UUID and SSID, so that looking one up does not go through all of them, and
+there is only ever one pending connection per network.
+
+Changes are kept as operations, that var_io.pendingTransaction appends to the
+pending journal (var_io.pending_journal_path) instead of writing the whole
+pending file. Once it holds var_io.pending_journal_keep operations, and
+whenever a boot looks for pending connections, the journal is folded back
+into the pending file, which is all other programs have to read or write.
+
+An operation is a dict, one of:
+
+    {"op": "add", "connection": {...}}
+    {"op": "remove", "uuid": "...", "ssid": "..."}
+"""
+
+import uuid
+import collections
+
+
+def connection_uuid(con):
+    """
+    Returns the UUID of the connection, or None if it does not have one.
+    """
+    try:
+        return con["connection"]["uuid"] or None
+    except (KeyError, TypeError):
+        return None
+
+
+def connection_ssid(con):
+    """
+    Returns the SSID of a wifi connection as a str, or None if it is not a wifi
+    connection.
+    """
+    try:
+        ssid = con["802-11-wireless"]["ssid"]
+    except (KeyError, TypeError):
+        return None
+    if isinstance(ssid, list):
+        # A list of bytes (or byte values), like NetworkManager returns it
+        ssid = b"".join(
+            bytes([item]) if isinstance(item, int) else bytes(item) for item in ssid
+        )
+    if isinstance(ssid, bytes):
+        ssid = ssid.decode("utf-8", "replace")
+    return str(ssid)
+
+
+def connection_priority(con):
+    """
+    Returns the autoconnect-priority of the connection, 0 if it is not set.
+    """
+    try:
+        return int(con["connection"]["autoconnect-priority"])
+    except (KeyError, TypeError, ValueError):
+        return 0
+
+
+def wifi_connection(ssid, password=None, priority=None):
+    """
+    Returns a new connection to the wifi network ssid, secured with WPA2-PSK
+    if there is a password, with autoconnect-priority if priority is not None.
+    """
+    connection = {
+        "connection": {
+            "id": str(ssid),
+            "type": "802-11-wireless",
+            "autoconnect": True,
+            "uuid": str(uuid.uuid4()),
+        },
+        "802-11-wireless": {"mode": "infrastructure", "ssid": ssid},
+        "ipv4": {"method": "auto"},
+        "ipv6": {"method": "auto"},
+    }
+    if password is not None:
+        connection["802-11-wireless"]["security"] = "802-11-wireless-security"
+        connection["802-11-wireless-security"] = {
+            "key-mgmt": "wpa-psk",  # We only support WPA2-PSK networks for now
+            "psk": password,
+        }
+    if priority is not None:
+        connection["connection"]["autoconnect-priority"] = priority
+    return connection
+
+
+def connection_password(con):
+    """
+    Returns the WPA2-PSK password of the connection, or None if it has none.
+    """
+    try:
+        return con["802-11-wireless-security"]["psk"]
+    except (KeyError, TypeError):
+        return None
+
+
+class PendingStore(object):
+    """
+    The pending connections, and the operations that changed them since they
+    were last saved.
+
+    Adding a connection replaces the pending connections with the same UUID
+    or SSID. Iterating gives the connections with the highest
+    autoconnect-priority first, in the order they were added otherwise.
+    """
+
+    def __init__(self, connections=(), journal=()):
+        # Number of the connection -> connection, in the order they were added
+        self._connections = collections.OrderedDict()
+        self._by_uuid = {}
+        self._by_ssid = {}
+        self._added = 0
+        for con in connections:
+            self._add(con)
+        for op in journal:
+            self.apply(op)
+        # Number of operations in the journal file
+        self.journaled = len(journal)
+        # Operations not saved yet
+        self.unsaved = []
+
+    def _add(self, con):
+        removed = self._remove(connection_uuid(con), connection_ssid(con))
+        number = self._added
+        self._added += 1
+        self._connections[number] = con
+        if connection_uuid(con) is not None:
+            self._by_uuid[connection_uuid(con)] = number
+        if connection_ssid(con) is not None:
+            self._by_ssid[connection_ssid(con)] = number
+        return removed
+
+    def _remove(self, uuid, ssid):
+        removed = []
+        for number in (self._by_uuid.get(uuid), self._by_ssid.get(ssid)):
+            if number is None or number not in self._connections:
+                continue
+            con = self._connections.pop(number)
+            if self._by_uuid.get(connection_uuid(con)) == number:
+                del self._by_uuid[connection_uuid(con)]
+            if self._by_ssid.get(connection_ssid(con)) == number:
+                del self._by_ssid[connection_ssid(con)]
+            removed.append(con)
+        return removed
+
+    def apply(self, op):
+        """
+        Apply an operation (see the module docstring), without keeping it.
+
+        Returns the connections it removed.
+        """
+        if op.get("op") == "add":
+            return self._add(op["connection"])
+        if op.get("op") == "remove":
+            return self._remove(op.get("uuid"), op.get("ssid"))
+        raise ValueError("Unknown pending operation %r" % op.get("op"))
+
+    def _do(self, op):
+        self.unsaved.append(op)
+        return self.apply(op)
+
+    def add(self, con):
+        """
+        Add a pending connection, replacing the ones with the same UUID or SSID.
+
+        Returns the connections it replaced.
+        """
+        return self._do({"op": "add", "connection": con})
+
+    def remove(self, con):
+        """
+        Remove a pending connection (and any other with its UUID or SSID).
+
+        Returns True if there was one to remove.
+        """
+        uuid, ssid = connection_uuid(con), connection_ssid(con)
+        if uuid not in self._by_uuid and ssid not in self._by_ssid:
+            return False
+        self._do({"op": "remove", "uuid": uuid, "ssid": ssid})
+        return True
+
+    def remove_ssid(self, ssid):
+        """
+        Remove the pending connection for ssid.
+
+        Returns the connection removed, or None if there was none.
+        """
+        con = self.by_ssid(ssid)
+        if con is None:
+            return None
+        self.remove(con)
+        return con
+
+    def by_uuid(self, uuid):
+        number = self._by_uuid.get(uuid)
+        return None if number is None else self._connections[number]
+
+    def by_ssid(self, ssid):
+        number = self._by_ssid.get(ssid)
+        return None if number is None else self._connections[number]
+
+    def __contains__(self, con):
+        uuid, ssid = connection_uuid(con), connection_ssid(con)
+        return (uuid is not None and uuid in self._by_uuid) or (
+            ssid is not None and ssid in self._by_ssid
+        )
+
+    def __len__(self):
+        return len(self._connections)
+
+    def __iter__(self):
+        return iter(self.connections())
+
+    def connections(self):
+        """
+        Returns the list of pending connections, highest autoconnect-priority first.
+        """
+        # sorted is stable, so connections with the same priority keep their order
+        return sorted(
+            self._connections.values(), key=lambda con: -connection_priority(con)
+        )
@@ -3,12 +3,16 @@ pifi
 
 Usage:
   pifi status
-  pifi add <ssid> [<password>]
-  pifi remove [-y] <ssid>
+  pifi add [--priority <priority>] <ssid> [<password>]
+  pifi remove [-y] [--pattern <pattern>]... [<ssid>...]
+  pifi import [--format <format>] [--force] [<file>]
+  pifi export [--format <format>] [--saved] [<file>]
   pifi list seen
   pifi list pending
   pifi set-hostname <hostname>
-  pifi rescan [-y]
+  pifi rescan [-y] [--timeout <seconds>]
+  pifi boot-trace [-n <boots>]
+  pifi scan-history [-n <boots>] [<ssid>]
   pifi --version
 
 Options:
@@ -18,17 +22,15 @@ Options:
 
 """
 import argparse
-import time
-import uuid
+import collections
 import sys
 import socket
 
-import NetworkManager
-
-import pifi.nm_helper as nm
+# NetworkManager (which connects to the system bus), em, yaml and evdev are
+# slow to import, commands import what they need so that the others start fast
 import pifi.var_io as var_io
-import pifi.etc_io as etc_io
-import pifi.startup as startup
+import pifi.pending as pending
+import pifi.dbus_stats as dbus_stats
 from pifi.version import __version__
 
 
@@ -63,7 +65,10 @@ def query_yes_no(question, default="no"):
             sys.stdout.write("Please respond with 'yes' or 'no' " "(or 'y' or 'n').\n")
 
 
-def status(argv, nm=nm):
+def status(argv, nm=None):
+    if nm is None:
+        import pifi.nm_helper as nm
+
     devices = 0
 
     for ApModeDevice in nm.managedAPCapableDevices():
@@ -89,11 +94,18 @@ def status(argv, nm=nm):
 
 
 def add(argv, var_io=var_io):
+    import pifi.etc_io as etc_io
+
     parser = argparse.ArgumentParser(
         description="Add a network to connect to on the next reboot/rescan"
     )
     parser.add_argument("ssid")
     parser.add_argument("password", nargs="?")
+    parser.add_argument(
+        "--priority",
+        type=int,
+        help="autoconnect-priority, higher is preferred when several networks are visible",
+    )
     args = parser.parse_args(argv)
 
     ssid = args.ssid
@@ -104,71 +116,59 @@ def add(argv, var_io=var_io):
             "WARN: Please use `pifi set-hostname` to change the hostname before connecting"
         )
 
-    pending = var_io.readPendingConnections()
-
-    if password is not None:
-        new_connection = {
-            "connection": {
-                "id": str(ssid),
-                "type": "802-11-wireless",
-                "autoconnect": True,
-                "uuid": str(uuid.uuid4()),
-            },
-            "802-11-wireless": {
-                "mode": "infrastructure",
-                "security": "802-11-wireless-security",
-                "ssid": ssid,
-            },
-            "802-11-wireless-security": {
-                "key-mgmt": "wpa-psk",  # We only support WPA2-PSK networks for now
-                "psk": password,
-            },
-            "ipv4": {"method": "auto"},
-            "ipv6": {"method": "auto"},
-        }
-
-    else:
-        new_connection = {
-            "connection": {
-                "id": str(ssid),
-                "type": "802-11-wireless",
-                "autoconnect": True,
-                "uuid": str(uuid.uuid4()),
-            },
-            "802-11-wireless": {"mode": "infrastructure", "ssid": ssid},
-            "ipv4": {"method": "auto"},
-            "ipv6": {"method": "auto"},
-        }
-
-    print("Added connection %s, will attempt to connect to it on future reboots" % ssid)
-    pending.append(new_connection)
+    new_connection = pending.wifi_connection(ssid, password, args.priority)
 
     try:
-        var_io.writePendingConnections(pending)
+        with var_io.pendingTransaction() as store:
+            replaced = store.add(new_connection)
     except PermissionError:
         print(
             "Error writing to /var/lib/pifi/pending, make sure you are running with sudo"
         )
+        return
+
+    if len(replaced) > 0:
+        print(
+            "Updated connection %s, will attempt to connect to it on future reboots"
+            % ssid
+        )
+    else:
+        print(
+            "Added connection %s, will attempt to connect to it on future reboots"
+            % ssid
+        )
+
+
+def remove(argv, var_io=var_io, nm=None):
+    import NetworkManager
 
+    if nm is None:
+        import pifi.nm_helper as nm
+    import pifi.networks as networks
 
-def remove(argv):
     parser = argparse.ArgumentParser(
-        description="Remove a network from both pending and current connections"
+        description="Remove networks from both pending and current connections"
+    )
+    parser.add_argument("ssids", metavar="ssid", nargs="*")
+    parser.add_argument(
+        "--pattern",
+        action="append",
+        default=[],
+        help="also remove the networks whose SSID matches this shell style pattern",
     )
-    parser.add_argument("ssid")
     parser.add_argument("-y", action="store_true")
     args = parser.parse_args(argv)
 
-    ssid = args.ssid
+    if len(args.ssids) == 0 and len(args.pattern) == 0:
+        parser.error("give the SSIDs to remove, or a --pattern")
+
+    matches = networks.ssid_matcher(args.ssids, args.pattern)
     skip_prompt = args.y
 
     for device in nm.managedWifiDevices():
         if device.State == NetworkManager.NM_DEVICE_STATE_ACTIVATED:
             current_connection = device.GetAppliedConnection(0)
-            # SSID returned as list of bytes
-            if ssid == b"".join(
-                current_connection[0]["802-11-wireless"]["ssid"]
-            ).decode("utf-8"):
+            if matches(pending.connection_ssid(current_connection[0])):
                 print("WARN: Connection is currently active")
                 print("WARN: Deleting can disrupt existing SSH connetions")
 
@@ -176,24 +176,171 @@ def remove(argv):
                 if not skip_prompt and not query_yes_no("Continue Removal?"):
                     return
 
-    pending = var_io.readPendingConnections()
-    for con in pending:
-        if ssid == con["802-11-wireless"]["ssid"]:
-            pending.remove(con)
-
     try:
-        var_io.writePendingConnections(pending)
+        with var_io.pendingTransaction() as store:
+            for con in store.connections():
+                if matches(pending.connection_ssid(con)):
+                    store.remove(con)
+                    print(
+                        "Removed pending connection %s" % pending.connection_ssid(con)
+                    )
     except PermissionError:
         print(
             "Error writing to /var/lib/pifi/pending, make sure you are running with sudo"
         )
         return
 
-    for con in nm.existingConnections():
-        settings = con.GetSettings()
-        if ssid == settings["802-11-wireless"]["ssid"]:
-            pass
+    # One pass over the saved connections, whatever the number of SSIDs
+    saved_connections = nm.saved_connections()
+    for con, settings in saved_connections.wireless(ap=False):
+        if matches(pending.connection_ssid(settings)):
             con.Delete()
+            saved_connections.forget(con)
+            print("Deleted connection %s" % pending.connection_ssid(settings))
+
+
+def import_command(argv, var_io=var_io, nm=None, stdin=None):
+    import pifi.networks as networks
+
+    parser = argparse.ArgumentParser(
+        description="Add many networks to connect to on the next reboot/rescan"
+    )
+    parser.add_argument(
+        "file", nargs="?", default="-", help="file to read, - (the default) for stdin"
+    )
+    parser.add_argument(
+        "--format", choices=networks.formats, help="guessed from the file name"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="also import networks NetworkManager already has a connection to",
+    )
+    args = parser.parse_args(argv)
+
+    format = args.format or networks.guess_format(args.file)
+
+    # Read everything before taking the pending lock, a network that is in
+    # the file more than once is only kept once, the last one wins
+    imported = collections.OrderedDict()
+
+    def read(stream):
+        for con in networks.read_networks(stream, format):
+            imported.pop(pending.connection_ssid(con), None)
+            imported[pending.connection_ssid(con)] = con
+
+    try:
+        if args.file == "-":
+            read(stdin or sys.stdin)
+        else:
+            with open(args.file, newline="") as f:
+                read(f)
+    except OSError as e:
+        print("Error reading %s: %s" % (args.file, e.strerror))
+        return
+    except ValueError as e:
+        print("Error reading %s: %s" % (args.file, e))
+        return
+
+    saved = []
+    if not args.force:
+        if nm is None:
+            import pifi.nm_helper as nm
+        saved_connections = nm.saved_connections()
+        saved = [ssid for ssid in imported if saved_connections.by_ssid(ssid, ap=False)]
+        for ssid in saved:
+            del imported[ssid]
+
+    added = updated = unchanged = 0
+    try:
+        # All the networks in one transaction, saved with a single write
+        with var_io.pendingTransaction() as store:
+            for ssid, con in imported.items():
+                existing = store.by_ssid(ssid)
+                if existing is not None and networks.same_network(existing, con):
+                    unchanged += 1
+                elif len(store.add(con)) > 0:
+                    updated += 1
+                else:
+                    added += 1
+    except PermissionError:
+        print(
+            "Error writing to /var/lib/pifi/pending, make sure you are running with sudo"
+        )
+        return
+
+    print(
+        "Added %d, updated %d and kept %d pending connections"
+        % (added, updated, unchanged)
+    )
+    if len(saved) > 0:
+        print(
+            "Skipped %d networks already saved in NetworkManager (use --force to import them): %s"
+            % (len(saved), ", ".join(saved))
+        )
+
+
+def export_command(argv, var_io=var_io, nm=None, stdout=None):
+    import pifi.networks as networks
+
+    parser = argparse.ArgumentParser(
+        description="Write the pending networks, to import them on other devices"
+    )
+    parser.add_argument(
+        "file", nargs="?", default="-", help="file to write, - (the default) for stdout"
+    )
+    parser.add_argument(
+        "--format", choices=networks.formats, help="guessed from the file name"
+    )
+    parser.add_argument(
+        "--saved",
+        action="store_true",
+        help="also write the networks saved in NetworkManager (passwords need sudo)",
+    )
+    args = parser.parse_args(argv)
+
+    format = args.format or networks.guess_format(args.file)
+
+    def connections():
+        ssids = set()
+        for con in var_io.readPendingStore():
+            if pending.connection_ssid(con) is not None:
+                ssids.add(pending.connection_ssid(con))
+                yield con
+        if not args.saved:
+            return
+        for con, settings in nm.saved_connections().wireless(ap=False):
+            if pending.connection_ssid(settings) in ssids:
+                continue  # The pending connection replaces it on the next boot
+            ssids.add(pending.connection_ssid(settings))
+            settings = dict(settings)
+            if "802-11-wireless-security" in settings:
+                try:
+                    secrets = con.GetSecrets("802-11-wireless-security")
+                    settings["802-11-wireless-security"] = secrets[
+                        "802-11-wireless-security"
+                    ]
+                except nm_events.DBusException:
+                    # Only root may read the passwords
+                    pass
+            yield settings
+
+    if args.saved:
+        import pifi.nm_events as nm_events
+
+        if nm is None:
+            import pifi.nm_helper as nm
+
+    if args.file == "-":
+        networks.write_networks(connections(), stdout or sys.stdout, format)
+        return
+    try:
+        with open(args.file, "w", newline="") as f:
+            written = networks.write_networks(connections(), f, format)
+    except OSError as e:
+        print("Error writing to %s: %s" % (args.file, e.strerror))
+        return
+    print("Exported %d networks to %s" % (written, args.file))
 
 
 def list_command(argv):
@@ -204,10 +351,44 @@ def list_command(argv):
     args = list_parser.parse_args(argv)
 
     if args.list == "seen":
-        for ssid in var_io.readSeenSSIDs():
-            print(ssid)
+        table = var_io.readScanTable()
+        if table is None:
+            # Scanned by an older pifi, there are only the SSIDs
+            for ssid in var_io.readSeenSSIDs():
+                print(ssid)
+            return
+
+        import pifi.scan_table as scan_table
+
+        table = scan_table.ScanTable.from_json(table)
+        # The strengths are not in the scan table file, but in the last scan
+        # of the scan history
+        history = var_io.readScanHistory()
+        if history is not None:
+            with history:
+                records = [r for s in history.snapshots(last=1) for r in s.entries]
+            for record in records:
+                entry = table.get(record.ssid)
+                if entry is not None and entry.max_strength is None:
+                    entry.max_strength = record.max_strength
+        print(
+            "%-32s %4s %8s %12s %8s" % ("SSID", "APs", "Strength", "Bands", "Security")
+        )
+        for entry in table.entries():
+            print(
+                "%-32s %4d %8s %12s %8s"
+                % (
+                    entry.ssid,
+                    len(entry.bssids),
+                    "-" if entry.max_strength is None else entry.max_strength,
+                    ",".join(entry.bands()) or "-",
+                    {True: "secured", False: "open", None: "-"}[entry.secured],
+                )
+            )
+        if table.hidden > 0:
+            print("and %d access points of hidden networks" % table.hidden)
     if args.list == "pending":
-        for con in var_io.readPendingConnections():
+        for con in var_io.readPendingStore():
             try:
                 print(con["802-11-wireless"]["ssid"])
             except KeyError:
@@ -218,6 +399,8 @@ def list_command(argv):
 
 
 def set_hostname(argv):
+    import pifi.etc_io as etc_io
+
     parser = argparse.ArgumentParser(description="Set a new hostname")
     parser.add_argument("hostname")
     args = parser.parse_args(argv)
@@ -240,16 +423,41 @@ def set_hostname(argv):
 
 
 def rescan(argv):
+    import NetworkManager
+    import pifi.nm_helper as nm
+    import pifi.nm_events as nm_events
+    import pifi.etc_io as etc_io
+    import pifi.startup as startup
+
     parser = argparse.ArgumentParser(
         description="Stop AP mode and rescan for known networks, start AP mode again if none found"
     )
     parser.add_argument("-y", action="store_true")
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="Longest time to wait for the scan in seconds (default: scan_timeout from pifi.conf)",
+    )
     args = parser.parse_args(argv)
 
     skip_prompt = args.y
 
+    # Signals are only delivered if this is done before we first talk to NetworkManager
+    if nm_events.use_glib_mainloop():
+        nm.properties.watch()
+
     pifi_conf_settings = etc_io.get_conf()
-    ApModeDevice, ClientModeDevice = nm.select_devices(pifi_conf_settings)
+    timeout = args.timeout
+    if timeout is None:
+        timeout = pifi_conf_settings["scan_timeout"]
+    ApModeDevice, ClientModeDevice, selection = nm.select_devices_cached(
+        pifi_conf_settings, var_io.readDeviceSelection()
+    )
+    if selection is not None:
+        try:
+            var_io.writeDeviceSelection(selection)
+        except PermissionError:
+            print("Error writing to %s, continuing" % var_io.devices_path)
 
     if ApModeDevice.State != 100:
         print("AP Device is not active")
@@ -270,11 +478,33 @@ def rescan(argv):
             ApModeDevice.Disconnect()
 
     print("Waiting for wifi rescan")
-    time.sleep(30)
     try:
-        var_io.writeSeenSSIDs(nm.seenSSIDs([ClientModeDevice]))
-    except PermissionError:
-        print("Error writing to /var/lib/pifi/seen_ssids, continuing")
+        since = nm.request_scan(ClientModeDevice)
+    except Exception as e:
+        # NetworkManager refuses to scan while the device is busy, wait for its next scan
+        print("WARN could not request a scan (%s), waiting for the next one" % e)
+        since = nm.last_scan(ClientModeDevice)
+
+    found_ssids = set()
+
+    def print_ssid(ap):
+        try:
+            ssid = nm.properties.get(ap, "Ssid")
+        except NetworkManager.ObjectVanished:
+            return
+        if ssid not in found_ssids:
+            found_ssids.add(ssid)
+            print("Found %s" % ssid)
+
+    if not nm.wait_for_scan(
+        ClientModeDevice, timeout, since=since, on_access_point=print_ssid
+    ):
+        print("WARN wifi scan did not finish in %s seconds, continuing" % timeout)
+    if not nm.properties.watching:
+        # Nothing kept the cached properties up to date while we waited
+        nm.properties.invalidate()
+
+    table = startup.save_scan(ClientModeDevice)
 
     if ClientModeDevice.State == NetworkManager.NM_DEVICE_STATE_ACTIVATED:
         print(
@@ -284,32 +514,118 @@ def rescan(argv):
         return
 
     print("Device is not connected to any network, Looking for pending connections")
-    pending = var_io.readPendingConnections()
+    pending = var_io.readPendingStore()
 
-    # Try to pick a connection to use, if none found, just continue
-    try:
-        # Use the best connection
-        best_ap, best_con = nm.selectConnection(
-            nm.availibleConnections(ClientModeDevice, pending)
-        )
+    # Try the pending connections from best to worst, if none work, just continue
+    connected = startup.connect_to_pending(
+        pifi_conf_settings, ClientModeDevice, pending.connections(), table=table
+    )
+    if connected is not None:
+        # Re-read, pending connections may have been added while we connected
+        with var_io.pendingTransaction() as pending:
+            pending.remove(connected)
+        return
 
-        print("Connecting to %s" % best_con["802-11-wireless"]["ssid"])
-        NetworkManager.NetworkManager.AddAndActivateConnection(
-            best_con, ClientModeDevice, best_ap
+    # If we reach this point, we gave up on Client mode
+    startup.start_ap_mode(pifi_conf_settings, ApModeDevice, ClientModeDevice)
+
+
+def boot_trace(argv, var_io=var_io):
+    import time
+    import pifi.trace as trace
+
+    parser = argparse.ArgumentParser(
+        description="Show how long each phase of the last boots took"
+    )
+    parser.add_argument(
+        "-n", type=int, default=10, help="Number of boots to show (default: 10)"
+    )
+    args = parser.parse_args(argv)
+
+    records = var_io.readBootTraces()[-args.n :] if args.n > 0 else []
+    if len(records) == 0:
+        print("No boots recorded in %s" % var_io.boot_trace_path)
+        return
+
+    for record in records:
+        started_at = time.strftime(
+            "%Y-%m-%d %H:%M:%S", time.localtime(record.get("started_at", 0))
         )
+        phases = ", ".join(
+            "%s %.2fs" % (name, duration)
+            for name, duration in trace.phase_durations(record).items()
+        )
+        print(
+            "%s  %-12s total %6.2fs  %s"
+            % (started_at, record.get("decision"), record.get("total", 0.0), phases)
+        )
+
+    print("")
+    print("%-12s %8s %8s %8s %8s" % ("phase", "p50", "p90", "p99", "max"))
+    for phase, values, maximum in trace.summarize(records):
+        print("%-12s %7.2fs %7.2fs %7.2fs %7.2fs" % tuple([phase] + values + [maximum]))
+
+
+def scan_history(argv, var_io=var_io):
+    import time
+
+    parser = argparse.ArgumentParser(
+        description="Show how often SSIDs were seen in the last boots, and at what strength"
+    )
+    parser.add_argument(
+        "-n", type=int, default=10, help="Number of boots to look at (default: 10)"
+    )
+    parser.add_argument("ssid", nargs="?", help="Only show this SSID")
+    args = parser.parse_args(argv)
 
-        new_pending = var_io.readPendingConnections().remove(best_con)
-        var_io.writePendingConnections(new_pending)
+    history = var_io.readScanHistory()
+    if history is None:
+        print("No scans recorded in %s" % var_io.scan_history_path)
         return
-    except ValueError:
-        pass
+    with history:
+        if args.ssid is not None:
+            visibilities = [history.visibility(args.ssid, last=args.n)]
+        else:
+            visibilities = sorted(
+                history.visibilities(last=args.n).values(),
+                key=lambda visibility: (-visibility.seen, visibility.ssid),
+            )
 
-    # If we reach this point, we gave up on Client mode
-    print("No SSIDs from pending connections found")
-    startup.start_ap_mode(pifi_conf_settings, ApModeDevice, ClientModeDevice)
+    if len(visibilities) == 0 or visibilities[0].boots == 0:
+        print("No scans recorded in %s" % var_io.scan_history_path)
+        return
+
+    print("Seen in the last %d boots" % visibilities[0].boots)
+    print("%-32s %9s %8s %8s  %s" % ("SSID", "Seen", "Strength", "Range", "Last seen"))
+    for visibility in visibilities:
+        last_seen = "-"
+        if visibility.last_seen is not None:
+            last_seen = time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(visibility.last_seen)
+            )
+        strength, strength_range = "-", "-"
+        if visibility.mean_strength is not None:
+            strength = "%.0f" % visibility.mean_strength
+            strength_range = "%d-%d" % (
+                visibility.min_strength,
+                visibility.max_strength,
+            )
+        print(
+            "%-32s %4d %3d%% %8s %8s  %s"
+            % (
+                visibility.ssid,
+                visibility.seen,
+                round(visibility.ratio * 100),
+                strength,
+                strength_range,
+                last_seen,
+            )
+        )
 
 
 def set_country(argv):
+    import pifi.etc_io as etc_io
+
     parser = argparse.ArgumentParser(description="Set your country ")
     parser.add_argument("ISO_country_code")
     args = parser.parse_args(argv)
@@ -337,11 +653,23 @@ def main(argv=sys.argv[1:]):
         "status": status,
         "add": add,
         "remove": remove,
+        "import": import_command,
+        "export": export_command,
         "set-hostname": set_hostname,
         "set-country": set_country,
         "rescan": rescan,
         "list": list_command,
+        "boot-trace": boot_trace,
+        "scan-history": scan_history,
     }
 
     if args.command in commands:
-        commands[args.command](argv[1:])
+        stats = None
+        if dbus_stats.enabled():
+            stats = dbus_stats.Stats(phase=lambda: args.command)
+            stats.install()
+        try:
+            commands[args.command](argv[1:])
+        finally:
+            if stats is not None:
+                sys.stderr.write("%s\n" % stats.report())
@@ -0,0 +1,302 @@
+"""
+This module records what pifi says to NetworkManager on a real robot, so that
+the same session can be replayed later without NetworkManager (see pifi.replay).
+
+    sudo python3 -m pifi.record /tmp/boot.trace            # like pifi_startup
+    sudo python3 -m pifi.record /tmp/rescan.trace rescan   # like pifi rescan
+
+Every method call and property read pifi makes is kept with its arguments,
+reply (or error) and timing, together with the signals NetworkManager sends
+and the pifi files that decide what pifi does (pending connections, the
+configuration, ...). A trace is a file of json lines, the first one is a
+header, the others are events:
+
+    {"t": 0.52, "kind": "call", "path": "/org/freedesktop/NetworkManager",
+     "name": "GetDevices", "args": [], "kwargs": {}, "reply": [...], "duration": 0.003}
+
+NetworkManager objects are saved as {"$object": path, "$type": class name},
+raw D-Bus object paths as {"$path": path} and bytes as {"$bytes": [...]}.
+
+Recording is built on the wrappers of pifi.dbus_stats. When pifi_startup is
+recorded, it does not wait for the button afterwards.
+"""
+
+import sys
+import json
+import time
+import types
+import argparse
+
+import pifi.dbus_stats as dbus_stats
+
+trace_version = 1
+
+# Files that decide what pifi does, saved in the trace so that it can be
+# replayed with the same state, as (module, path attribute)
+state_files = [
+    ("var_io", "seen_SSIDs_path"),
+    ("var_io", "pending_path"),
+    ("var_io", "pending_journal_path"),
+    ("var_io", "devices_path"),
+    ("var_io", "last_network_path"),
+    ("var_io", "connection_history_path"),
+    ("var_io", "ap_profile_path"),
+    ("etc_io", "conf_path"),
+    ("etc_io", "default_ap_path"),
+    ("etc_io", "hostname_path"),
+]
+
+
+def object_path(obj):
+    """
+    Returns the D-Bus object path of obj, or None if it does not have one.
+    """
+    path = getattr(obj, "object_path", None)
+    if isinstance(path, str):
+        return str(path)
+    return None
+
+
+def encode(value, with_types=True):
+    """
+    Returns value as something json serializable, see the module docstring.
+
+    With with_types False, NetworkManager objects are saved without their class,
+    so that objects compare the same when recorded and when replayed.
+    """
+    if value is None or isinstance(value, bool):
+        return value
+    if type(value).__name__ == "Boolean":
+        # dbus.Boolean is an int
+        return bool(value)
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    if type(value).__name__ == "ObjectPath":
+        return {"$path": str(value)}
+    if isinstance(value, str):
+        return str(value)
+    if isinstance(value, (bytes, bytearray)):
+        return {"$bytes": list(value)}
+    if isinstance(value, dict):
+        return dict((str(k), encode(v, with_types)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [encode(item, with_types) for item in value]
+
+    path = object_path(value)
+    if path is not None:
+        if not with_types:
+            return {"$object": path}
+        return {"$object": path, "$type": type(value).__name__}
+    return {"$repr": repr(value)}
+
+
+def encode_error(error):
+    return {"type": type(error).__name__, "message": str(error)}
+
+
+def read_state_files():
+    """
+    Returns a dict of "module.attribute" -> contents of the state files, None
+    for files that don't exist.
+    """
+    import importlib
+
+    files = {}
+    for module_name, attribute in state_files:
+        module = importlib.import_module("pifi." + module_name)
+        try:
+            with open(getattr(module, attribute)) as f:
+                contents = f.read()
+        except (FileNotFoundError, PermissionError):
+            contents = None
+        files["%s.%s" % (module_name, attribute)] = contents
+    return files
+
+
+class Recorder(dbus_stats.Stats):
+    """
+    Stats that also keep every call, reply and signal, in the order they happened.
+    """
+
+    def __init__(self, clock=time.monotonic, wall_clock=time.time):
+        super(Recorder, self).__init__(clock=clock)
+        self._start = clock()
+        self.started_at = wall_clock()
+        self.events = []
+
+    def _event(self, kind, obj, name, start):
+        return {
+            "t": start - self._start,
+            "kind": kind,
+            "path": object_path(obj),
+            "name": name,
+        }
+
+    def property_read(self, obj, name, value, duration):
+        super(Recorder, self).property_read(obj, name, value, duration)
+        event = self._event("property", obj, name, self._clock() - duration)
+        event["reply"] = encode(value)
+        event["duration"] = duration
+        self.events.append(event)
+
+    def property_failed(self, obj, name, error, duration):
+        super(Recorder, self).property_failed(obj, name, error, duration)
+        event = self._event("property", obj, name, self._clock() - duration)
+        event["error"] = encode_error(error)
+        event["duration"] = duration
+        self.events.append(event)
+
+    def method_call(self, obj, name, method, args, kwargs):
+        start = self._clock()
+        event = self._event("call", obj, name, start)
+        # Without classes, so that replayed calls can be matched by their arguments
+        event["args"] = encode(list(args), with_types=False)
+        event["kwargs"] = encode(kwargs, with_types=False)
+        try:
+            reply = method(*args, **kwargs)
+        except Exception as e:
+            event["error"] = encode_error(e)
+            raise
+        else:
+            event["reply"] = encode(reply)
+            return reply
+        finally:
+            event["duration"] = self._clock() - start
+            self.record("call", name, event["duration"])
+            self.events.append(event)
+
+    def signal(self, *args, **keywords):
+        """
+        Signal handler, keeps the signal as an event.
+        """
+        event = self._event("signal", None, keywords.get("member"), self._clock())
+        event["path"] = keywords.get("path")
+        event["interface"] = keywords.get("interface")
+        event["args"] = encode(list(args))
+        self.events.append(event)
+
+    def listen(self, nm_events):
+        """
+        Keep the signals NetworkManager sends, they are only delivered while
+        pifi waits in a GLib main loop.
+
+        Returns False if signals can not be delivered (no GLib main loop).
+        """
+        if nm_events.GLib is None or nm_events.dbus is None:
+            return False
+        nm_events.dbus.SystemBus().add_signal_receiver(
+            self.signal,
+            bus_name=nm_events.NM_BUS_NAME,
+            path_keyword="path",
+            member_keyword="member",
+            interface_keyword="interface",
+        )
+        return True
+
+    def module(self, NetworkManager):
+        """
+        Returns a stand-in for the NetworkManager module, that records
+        everything done through it.
+        """
+        recording = types.ModuleType("NetworkManager")
+        recording.__dict__.update(NetworkManager.__dict__)
+        recording.NetworkManager = self.wrap(NetworkManager.NetworkManager)
+        recording.Settings = self.wrap(NetworkManager.Settings)
+        recording.Connection = lambda path: self.wrap(NetworkManager.Connection(path))
+        recording.fixups = _Fixups(NetworkManager.fixups, self)
+        return recording
+
+    def header(self, NetworkManager, command, files):
+        """
+        Returns the first line of the trace.
+        """
+        return {
+            "pifi_trace": trace_version,
+            "started_at": self.started_at,
+            "command": command,
+            "files": files,
+            "roots": {
+                "NetworkManager": object_path(NetworkManager.NetworkManager),
+                "Settings": object_path(NetworkManager.Settings),
+            },
+            "constants": dict(
+                (name, value)
+                for name, value in NetworkManager.__dict__.items()
+                if name.startswith("NM_") and isinstance(value, int)
+            ),
+        }
+
+    def save(self, path, header, open=open):
+        with open(path, "w") as trace_file:
+            trace_file.write(json.dumps(header) + "\n")
+            for event in self.events:
+                trace_file.write(json.dumps(event) + "\n")
+
+
+class _Fixups(object):
+    """
+    python-networkmanager's fixups, with the objects they make from raw
+    property values (see nm_helper.PropertyCache) recorded too.
+    """
+
+    def __init__(self, fixups, recorder):
+        self._fixups = fixups
+        self._recorder = recorder
+
+    def to_python(self, *args):
+        return self._recorder.wrap(self._fixups.to_python(*args))
+
+    def to_dbus(self, *args):
+        return self._fixups.to_dbus(*args)
+
+
+def run(command):
+    """
+    Run pifi_startup (if command is empty), or the pifi command.
+    """
+    if len(command) == 0:
+        import pifi.startup as startup
+
+        startup.handle_button = lambda *args: None
+        startup.main()
+    else:
+        import pifi.pifi as pifi
+
+        pifi.main(command)
+
+
+def main(argv=sys.argv[1:]):
+    import NetworkManager
+    import pifi.nm_events as nm_events
+    import pifi.fake_nm as fake_nm
+
+    parser = argparse.ArgumentParser(
+        description="Record the NetworkManager session of pifi_startup or a pifi command"
+    )
+    parser.add_argument("trace", help="File to save the trace to")
+    parser.add_argument(
+        "command", nargs=argparse.REMAINDER, help="pifi command (default: startup)"
+    )
+    args = parser.parse_args(argv)
+
+    recorder = Recorder()
+    files = read_state_files()
+    # Before the system bus is first connected, see use_glib_mainloop
+    if nm_events.use_glib_mainloop():
+        recorder.listen(nm_events)
+    fake_nm.install_module(recorder.module(NetworkManager), poll=False)
+    try:
+        run(args.command)
+    finally:
+        fake_nm.uninstall()
+        recorder.save(args.trace, recorder.header(NetworkManager, args.command, files))
+        print(
+            "Recorded %d events to %s" % (len(recorder.events), args.trace),
+            file=sys.stderr,
+        )
+
+
+if __name__ == "__main__":
+    main()
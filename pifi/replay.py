@@ -0,0 +1,413 @@
+"""
+This module replays a trace from pifi.record, so that a session from a robot
+can be run again on a laptop without NetworkManager, as often as needed.
+
+    python3 -m pifi.replay /tmp/boot.trace
+
+pifi runs against a stand-in for NetworkManager that answers from the trace,
+with the pifi files from the trace in a temporary directory. Time is simulated:
+every call takes as long as it took when it was recorded, and waits poll the
+trace instead of sleeping, so the same trace always gives the same decisions.
+
+Replies are matched by object, method (or property) and arguments, falling
+back to any call of the method on the object if pifi now passes different
+arguments. Property reads (and GetAll) are answered with what was recorded
+last before the current (simulated) time. A method call gets the reply of the
+next recorded call, or of a later one if the simulated time is already past it.
+Property reads are answered from recorded GetAll replies too, and GetAll from
+recorded property reads, so changes to how pifi reads properties can be
+replayed against old traces.
+"""
+
+import os
+import sys
+import json
+import types
+import bisect
+import shutil
+import argparse
+import tempfile
+import importlib
+import collections
+import functools
+
+import pifi.record as record
+import pifi.fake_nm as fake_nm
+
+default_roots = {
+    "NetworkManager": "/org/freedesktop/NetworkManager",
+    "Settings": "/org/freedesktop/NetworkManager/Settings",
+}
+
+# Files pifi writes that don't decide anything, as (module, path attribute)
+output_files = [
+    ("var_io", "boot_trace_path"),
+    ("var_io", "scan_table_path"),
+    ("var_io", "scan_history_path"),
+    ("var_io", "pending_lock_path"),
+    ("var_io", "conf_cache_path"),
+]
+
+# Kind of object by the directory of its object path
+path_types = {
+    "Devices": "Device",
+    "AccessPoint": "AccessPoint",
+    "ActiveConnection": "ActiveConnection",
+    "Settings": "Connection",
+}
+
+
+class _Recorded(object):
+    """
+    The recorded events for one key, in the order they happened.
+    """
+
+    __slots__ = ("times", "events")
+
+    def __init__(self):
+        self.times = []
+        self.events = []
+
+    def add(self, event):
+        index = bisect.bisect_right(self.times, event["t"])
+        self.times.insert(index, event["t"])
+        self.events.insert(index, event)
+
+    def latest(self, now):
+        """
+        Returns the index of the last event that happened by now, -1 if none did.
+        """
+        return bisect.bisect_right(self.times, now) - 1
+
+
+class ReplayObject(object):
+    """
+    Stand-in for a python-networkmanager object, answered from the trace.
+    """
+
+    def __init__(self, replay, path, type_name):
+        self._replay = replay
+        self.object_path = path
+        self.type_name = type_name
+        self.proxy = _ReplayProxy(self)
+
+    @property
+    def interface_names(self):
+        return self._replay.interface_names(self.object_path)
+
+    def SpecificDevice(self):
+        return self
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        replay = self.__dict__["_replay"]
+        if replay.has_call(self.object_path, name):
+            return functools.partial(replay.call, self, name)
+        return replay.read(self, name)
+
+    def __repr__(self):
+        return "<Replayed %s %s>" % (self.type_name, self.object_path)
+
+
+class _ReplayProxy(object):
+    def __init__(self, obj):
+        self._obj = obj
+
+    def GetAll(self, interface, dbus_interface=None):
+        return self._obj._replay.get_all(self._obj, interface)
+
+
+class _Fixups(object):
+    """
+    Values are decoded when they are read from the trace, raw D-Bus values
+    from GetAll need the conversions python-networkmanager would do.
+    """
+
+    @staticmethod
+    def to_python(klass, method, name, value, signature):
+        if name == "Ssid" and isinstance(value, (list, bytes)):
+            return bytes(value).decode("utf-8", "replace")
+        return value
+
+    @staticmethod
+    def to_dbus(klass, method, name, value, signature):
+        return value
+
+
+class Replay(object):
+    """
+    Answers for NetworkManager from the header and events of a trace.
+    """
+
+    def __init__(self, header, events):
+        self.header = header
+        # Simulated seconds since the recording started
+        self.now = 0.0
+        # Method name (or "Get" for property reads) -> number of calls
+        self.calls = collections.Counter()
+        # What was asked that is not in the trace, as (path, name)
+        self.missing = []
+        self.bus = fake_nm.Bus()
+        self._objects = {}
+        self._cursors = {}
+        self._recorded = collections.defaultdict(_Recorded)
+        self._interfaces = collections.defaultdict(list)
+        self._signals = []
+        for event in events:
+            if event["kind"] == "signal":
+                self._signals.append(event)
+                continue
+            path, name = event["path"], event["name"]
+            self._recorded[(event["kind"], path, name)].add(event)
+            if event["kind"] == "call":
+                self._recorded[("call", path, name, self._key(event))].add(event)
+                if name == "GetAll" and event["args"]:
+                    if event["args"][0] not in self._interfaces[path]:
+                        self._interfaces[path].append(event["args"][0])
+        self._signals.sort(key=lambda event: event["t"])
+
+    @classmethod
+    def load(cls, path, open=open):
+        """
+        Returns a Replay of the trace file at path.
+        """
+        with open(path) as trace_file:
+            lines = [json.loads(line) for line in trace_file if line.strip()]
+        if len(lines) == 0 or lines[0].get("pifi_trace") != record.trace_version:
+            raise ValueError("%s is not a pifi trace" % path)
+        return cls(lines[0], lines[1:])
+
+    def _key(self, event):
+        return json.dumps(
+            [event.get("args", []), event.get("kwargs", {})], sort_keys=True
+        )
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        """
+        Let simulated time pass, emitting the signals recorded in that time on bus.
+        """
+        self.now += seconds
+        while self._signals and self._signals[0]["t"] <= self.now:
+            event = self._signals.pop(0)
+            self.bus.emit(
+                event["path"],
+                event["interface"],
+                event["name"],
+                *self.decode(event["args"])
+            )
+
+    def object(self, path, type_name=None):
+        """
+        Returns the stand-in for the object at path, the same one every time.
+        """
+        obj = self._objects.get(path)
+        if obj is None:
+            if type_name is None:
+                directory = path.rstrip("/").split("/")[-2]
+                type_name = path_types.get(directory, "Object")
+            obj = self._objects[path] = ReplayObject(self, path, type_name)
+        return obj
+
+    def decode(self, value):
+        """
+        Returns a value from the trace as pifi would have gotten it.
+        """
+        if isinstance(value, list):
+            return [self.decode(item) for item in value]
+        if not isinstance(value, dict):
+            return value
+        if "$object" in value:
+            return self.object(value["$object"], value.get("$type"))
+        if "$path" in value:
+            if value["$path"] == "/":
+                return None
+            return self.object(value["$path"])
+        if "$bytes" in value:
+            return bytes(value["$bytes"])
+        return dict((k, self.decode(v)) for k, v in value.items())
+
+    def _pick(self, key, state=False):
+        """
+        Returns the recorded event to answer with for key, see the module docstring.
+
+        state is True for reads of state (properties), False for method calls.
+        """
+        recorded = self._recorded[key]
+        latest = recorded.latest(self.now)
+        if state:
+            return recorded.events[max(latest, 0)]
+        cursor = self._cursors.get(key, 0)
+        index = min(max(cursor, latest), len(recorded.events) - 1)
+        self._cursors[key] = index + 1
+        return recorded.events[index]
+
+    def _answer(self, obj, event):
+        self.advance(event.get("duration", 0.0))
+        error = event.get("error")
+        if error is None:
+            return self.decode(event["reply"])
+        if error["type"] == "ObjectVanished":
+            raise fake_nm.ObjectVanished(obj)
+        if error["type"] == "AttributeError":
+            raise AttributeError(error["message"])
+        raise fake_nm.DBusException("%s: %s" % (error["type"], error["message"]))
+
+    def _missing(self, path, name):
+        self.missing.append((path, name))
+        return "%s of %s is not in the trace" % (name, path)
+
+    def has_call(self, path, name):
+        return ("call", path, name) in self._recorded
+
+    def call(self, obj, name, *args, **kwargs):
+        """
+        Answer a method call, with the reply recorded for the same arguments if there is one.
+        """
+        self.calls[name] += 1
+        key = (
+            "call",
+            obj.object_path,
+            name,
+            json.dumps(
+                [record.encode(list(args), False), record.encode(kwargs, False)],
+                sort_keys=True,
+            ),
+        )
+        if key not in self._recorded:
+            key = ("call", obj.object_path, name)
+        return self._answer(obj, self._pick(key, state=name == "GetAll"))
+
+    def read(self, obj, name):
+        """
+        Answer a property read, from property reads or GetAll calls in the trace.
+        """
+        self.calls["Get"] += 1
+        key = ("property", obj.object_path, name)
+        if key in self._recorded:
+            return self._answer(obj, self._pick(key, state=True))
+
+        key = ("call", obj.object_path, "GetAll")
+        if key in self._recorded:
+            recorded = self._recorded[key]
+            for index in range(recorded.latest(self.now), -1, -1):
+                reply = recorded.events[index].get("reply") or {}
+                if name in reply:
+                    return _Fixups.to_python(
+                        None, "Get", name, self.decode(reply[name]), None
+                    )
+            for event in recorded.events:
+                reply = event.get("reply") or {}
+                if name in reply:
+                    return _Fixups.to_python(
+                        None, "Get", name, self.decode(reply[name]), None
+                    )
+        raise AttributeError(self._missing(obj.object_path, name))
+
+    def get_all(self, obj, interface):
+        """
+        Answer GetAll, from GetAll calls or property reads in the trace.
+        """
+        if interface in self._interfaces[obj.object_path]:
+            return self.call(
+                obj, "GetAll", interface, dbus_interface=fake_nm.PROPERTIES_INTERFACE
+            )
+
+        self.calls["GetAll"] += 1
+        values = {}
+        for key in self._recorded:
+            if key[0] == "property" and key[1] == obj.object_path:
+                event = self._pick(key, state=True)
+                if event.get("error") is None:
+                    values[key[2]] = self.decode(event["reply"])
+        return values
+
+    def interface_names(self, path):
+        if self._interfaces[path]:
+            return list(self._interfaces[path])
+        # GetAll of anything is answered from the recorded property reads
+        return ["org.freedesktop.NetworkManager"]
+
+    def module(self):
+        """
+        Returns a stand-in for the NetworkManager module, answered from the trace.
+        """
+        roots = dict(default_roots)
+        roots.update(self.header.get("roots") or {})
+        stand_in = types.ModuleType("NetworkManager")
+        stand_in.__dict__.update(fake_nm.constants)
+        stand_in.__dict__.update(self.header.get("constants") or {})
+        stand_in.NetworkManager = self.object(roots["NetworkManager"], "NetworkManager")
+        stand_in.Settings = self.object(roots["Settings"], "Settings")
+        stand_in.Connection = lambda path: self.object(path, "Connection")
+        stand_in.ObjectVanished = fake_nm.ObjectVanished
+        stand_in.fixups = _Fixups()
+        stand_in.device_class = lambda device_type: ReplayObject
+        stand_in.replay = self
+        return stand_in
+
+    def restore_files(self, directory):
+        """
+        Point pifi at copies of the files from the trace in directory, files
+        pifi writes (like the boot trace) end up there too.
+
+        Returns a function that points pifi back at the real files.
+        """
+        original = {}
+        files = self.header.get("files") or {}
+        for module_name, attribute in record.state_files + output_files:
+            contents = files.get("%s.%s" % (module_name, attribute))
+            module = importlib.import_module("pifi." + module_name)
+            original[(module, attribute)] = getattr(module, attribute)
+            path = os.path.join(directory, module_name, attribute)
+            setattr(module, attribute, path)
+            if contents is not None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "w") as f:
+                    f.write(contents)
+
+        def unrestore():
+            for (module, attribute), path in original.items():
+                setattr(module, attribute, path)
+
+        return unrestore
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Replay a trace from pifi.record without NetworkManager"
+    )
+    parser.add_argument("trace", help="Trace file from pifi.record")
+    args = parser.parse_args(argv)
+
+    replay = Replay.load(args.trace)
+    directory = tempfile.mkdtemp(prefix="pifi-replay-")
+    unrestore = replay.restore_files(directory)
+    fake_nm.install_module(replay.module(), clock=replay.clock, sleep=replay.sleep)
+    try:
+        record.run(replay.header.get("command") or [])
+    finally:
+        fake_nm.uninstall()
+        unrestore()
+        shutil.rmtree(directory)
+        print(
+            "Replayed %.1fs: %d calls, %d property reads"
+            % (
+                replay.now,
+                sum(replay.calls.values()) - replay.calls["Get"],
+                replay.calls["Get"],
+            ),
+            file=sys.stderr,
+        )
+        for path, name in replay.missing:
+            print("Not in the trace: %s of %s" % (name, path), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+"""
+This module keeps what was seen in the scans of the last boots, in a file of
+bounded size (see var_io.scan_history_path).
+
+The file is a ring buffer of fixed size binary records, behind a small header:
+
+    header   magic, version, record size, capacity, next slot, records, boots
+    records  capacity slots of record_size bytes
+
+Every scan is saved as a snapshot record (when it was taken, and how many
+access points of hidden networks it saw), followed by one record per SSID
+(see pifi.scan_table.ScanEntry). Once all slots are used, the oldest records
+are overwritten, so the file never grows. The file is memory mapped, saving a
+scan only writes its records and the header.
+
+Use visibility() to find out how often an SSID was seen over the last boots,
+and at what strength.
+"""
+
+import os
+import mmap
+import time
+import struct
+
+magic = b"PIFISCAN"
+version = 1
+
+# magic, version, record size, capacity, next slot, records, boots
+_header = struct.Struct("<8sHHIIII")
+header_size = 64
+
+# boot, time, kind, SSID length, SSID, max strength, mean strength,
+# access points, bands, security
+_record = struct.Struct("<IdBB32sbbHBB12x")
+record_size = _record.size
+
+# Number of records kept, 256kB worth
+default_capacity = 4096
+
+SNAPSHOT = 0
+SSID = 1
+
+# Bit of each band in the bands of a record
+band_bits = {"2.4GHz": 1, "5GHz": 2, "6GHz": 4}
+
+# security of a record
+_secured = {False: 0, True: 1, None: 2}
+
+
+class Record(object):
+    """
+    One record of the history, a snapshot or what was seen of one SSID in it.
+
+    Values that are not known are None.
+    """
+
+    __slots__ = (
+        "boot",
+        "time",
+        "kind",
+        "ssid",
+        "max_strength",
+        "mean_strength",
+        "access_points",
+        "bands",
+        "secured",
+    )
+
+    def __init__(
+        self,
+        boot,
+        time,
+        kind,
+        ssid="",
+        max_strength=None,
+        mean_strength=None,
+        access_points=0,
+        bands=(),
+        secured=None,
+    ):
+        self.boot = boot
+        self.time = time
+        self.kind = kind
+        self.ssid = ssid
+        self.max_strength = max_strength
+        self.mean_strength = mean_strength
+        # For a snapshot, the access points of hidden networks
+        self.access_points = access_points
+        self.bands = list(bands)
+        self.secured = secured
+
+    def pack(self):
+        ssid = self.ssid.encode("utf-8")[:32]
+        return _record.pack(
+            self.boot,
+            self.time,
+            self.kind,
+            len(ssid),
+            ssid,
+            -1 if self.max_strength is None else _strength(self.max_strength),
+            -1 if self.mean_strength is None else _strength(self.mean_strength),
+            min(self.access_points, 0xFFFF),
+            sum(band_bits[band] for band in self.bands),
+            _secured[self.secured],
+        )
+
+    @classmethod
+    def unpack(cls, data):
+        (
+            boot,
+            timestamp,
+            kind,
+            length,
+            ssid,
+            max_strength,
+            mean_strength,
+            access_points,
+            bands,
+            secured,
+        ) = _record.unpack(data)
+        return cls(
+            boot,
+            timestamp,
+            kind,
+            # An SSID cut at 32 bytes may end in part of a character
+            ssid[:length].decode("utf-8", "ignore"),
+            None if max_strength < 0 else max_strength,
+            None if mean_strength < 0 else mean_strength,
+            access_points,
+            [band for band, bit in sorted(band_bits.items()) if bands & bit],
+            {0: False, 1: True}.get(secured),
+        )
+
+    def __repr__(self):
+        return "Record(boot=%d, kind=%d, ssid=%r, max_strength=%s)" % (
+            self.boot,
+            self.kind,
+            self.ssid,
+            self.max_strength,
+        )
+
+
+def _strength(strength):
+    return int(round(min(max(strength, 0), 100)))
+
+
+class Snapshot(object):
+    """
+    The records of one scan.
+    """
+
+    __slots__ = ("boot", "time", "hidden", "entries")
+
+    def __init__(self, boot, time, hidden, entries):
+        self.boot = boot
+        self.time = time
+        self.hidden = hidden
+        # SSID records, strongest first
+        self.entries = entries
+
+
+class Visibility(object):
+    """
+    How often an SSID was seen over a number of boots, and at what strength.
+    """
+
+    __slots__ = ("ssid", "boots", "strengths", "last_seen")
+
+    def __init__(self, ssid, boots):
+        self.ssid = ssid
+        self.boots = boots
+        # Max strength of every boot it was seen in, None when not known
+        self.strengths = []
+        self.last_seen = None
+
+    @property
+    def seen(self):
+        return len(self.strengths)
+
+    @property
+    def ratio(self):
+        """Fraction of the boots the SSID was seen in"""
+        if self.boots == 0:
+            return 0.0
+        return float(self.seen) / self.boots
+
+    def _known(self):
+        return [strength for strength in self.strengths if strength is not None]
+
+    @property
+    def mean_strength(self):
+        known = self._known()
+        if len(known) == 0:
+            return None
+        return float(sum(known)) / len(known)
+
+    @property
+    def min_strength(self):
+        return min(self._known() or [None])
+
+    @property
+    def max_strength(self):
+        return max(self._known() or [None])
+
+    def __repr__(self):
+        return "Visibility(%r, seen=%d, boots=%d)" % (self.ssid, self.seen, self.boots)
+
+
+class ScanHistory(object):
+    """
+    The ring buffer in the file at path, see the module docstring.
+
+    The file is created (or rebuilt) with room for capacity records. Opened
+    with readonly, the file must exist and is never changed.
+    """
+
+    def __init__(
+        self, path, capacity=default_capacity, readonly=False, clock=time.time
+    ):
+        self.path = path
+        self._clock = clock
+        self._readonly = readonly
+        if readonly:
+            self._file = open(path, "rb")
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._file = os.fdopen(fd, "r+b")
+        try:
+            self._map = None
+            self._open(capacity)
+        except Exception:
+            self._file.close()
+            raise
+
+    def _open(self, capacity):
+        size = os.fstat(self._file.fileno()).st_size
+        header = None
+        if size >= header_size:
+            header = _header.unpack(self._file.read(_header.size))
+            if header[:3] != (magic, version, record_size) or size < (
+                header_size + header[3] * record_size
+            ):
+                header = None
+
+        if self._readonly:
+            if header is None:
+                raise ValueError("%s is not a pifi scan history" % self.path)
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._load_header()
+            return
+
+        if header is not None and header[3] == capacity:
+            self._map = mmap.mmap(self._file.fileno(), 0)
+            self._load_header()
+            return
+
+        # New, not a history or a different size: keep the newest records that fit
+        records = []
+        boots = 0
+        if header is not None:
+            self._map = mmap.mmap(self._file.fileno(), 0)
+            self._load_header()
+            records = list(self.records())[-capacity:]
+            boots = self.boots
+            self._map.close()
+        self._file.truncate(header_size + capacity * record_size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self.capacity = capacity
+        self.head = 0
+        self.count = 0
+        self.boots = boots
+        self._write(records)
+        self._save_header()
+        self._map.flush()
+
+    def _load_header(self):
+        header = _header.unpack_from(self._map, 0)
+        self.capacity, self.head, self.count, self.boots = header[3:]
+
+    def _save_header(self):
+        _header.pack_into(
+            self._map,
+            0,
+            magic,
+            version,
+            record_size,
+            self.capacity,
+            self.head,
+            self.count,
+            self.boots,
+        )
+
+    def _write(self, records):
+        for record in records:
+            offset = header_size + self.head * record_size
+            self._map[offset : offset + record_size] = record.pack()
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, table):
+        """
+        Save a snapshot of table (a pifi.scan_table.ScanTable).
+
+        SSIDs that don't fit in the history at all are left out, weakest first.
+        Returns the number of the boot the snapshot was saved as.
+        """
+        if self._readonly:
+            raise ValueError("%s is opened readonly" % self.path)
+        boot = self.boots + 1
+        now = self._clock()
+        records = [Record(boot, now, SNAPSHOT, access_points=table.hidden)]
+        for entry in table.entries()[: self.capacity - 1]:
+            records.append(
+                Record(
+                    boot,
+                    now,
+                    SSID,
+                    entry.ssid,
+                    entry.max_strength,
+                    entry.mean_strength,
+                    len(entry.bssids),
+                    entry.bands(),
+                    entry.secured,
+                )
+            )
+        # The records first, a history cut off while saving keeps its old header
+        self._write(records)
+        self.boots = boot
+        self._save_header()
+        self._map.flush()
+        return boot
+
+    def records(self):
+        """
+        Generator of the records, oldest first.
+        """
+        start = (self.head - self.count) % self.capacity
+        for n in range(self.count):
+            offset = header_size + ((start + n) % self.capacity) * record_size
+            yield Record.unpack(self._map[offset : offset + record_size])
+
+    def snapshots(self, last=None):
+        """
+        Returns the snapshots of the last boots (all of them if last is None),
+        oldest first.
+
+        The SSID records left of a snapshot that was partly overwritten are
+        not part of any snapshot.
+        """
+        snapshots = []
+        for record in self.records():
+            if record.kind == SNAPSHOT:
+                snapshots.append(
+                    Snapshot(record.boot, record.time, record.access_points, [])
+                )
+            elif len(snapshots) > 0 and snapshots[-1].boot == record.boot:
+                snapshots[-1].entries.append(record)
+        if last is not None:
+            snapshots = snapshots[-last:] if last > 0 else []
+        return snapshots
+
+    def visibilities(self, last=None):
+        """
+        Returns a dict of SSID -> Visibility over the last boots (all of them
+        if last is None), for every SSID seen in them.
+        """
+        snapshots = self.snapshots(last)
+        visibilities = {}
+        for snapshot in snapshots:
+            for record in snapshot.entries:
+                visibility = visibilities.get(record.ssid)
+                if visibility is None:
+                    visibility = Visibility(record.ssid, len(snapshots))
+                    visibilities[record.ssid] = visibility
+                visibility.strengths.append(record.max_strength)
+                visibility.last_seen = snapshot.time
+        return visibilities
+
+    def visibility(self, ssid, last=None):
+        """
+        Returns the Visibility of ssid over the last boots (all of them if
+        last is None), seen 0 times if it was not seen.
+        """
+        snapshots = self.snapshots(last)
+        visibility = Visibility(ssid, len(snapshots))
+        for snapshot in snapshots:
+            for record in snapshot.entries:
+                if record.ssid == ssid:
+                    visibility.strengths.append(record.max_strength)
+                    visibility.last_seen = snapshot.time
+        return visibility
@@ -0,0 +1,208 @@
+"""
+This module aggregates the access points from a wifi scan per SSID.
+
+NetworkManager reports one access point per BSSID, so a network with many
+access points (a warehouse, a campus) shows up many times. A ScanTable has
+one ScanEntry per SSID instead, with what we want to know about the network:
+its BSSIDs, the best and mean signal strength, the frequencies it is on,
+whether it is secured and when it was last seen.
+"""
+
+# Hidden networks are reported with an empty SSID
+HIDDEN_SSID = ""
+
+
+class ScanEntry(object):
+    """
+    Everything seen of one SSID during a scan.
+
+    access_points holds the NetworkManager access point objects, they are
+    not saved (see ScanTable.to_json).
+    """
+
+    __slots__ = (
+        "ssid",
+        "bssids",
+        "access_points",
+        "max_strength",
+        "total_strength",
+        "frequencies",
+        "secured",
+        "last_seen",
+    )
+
+    def __init__(self, ssid):
+        self.ssid = ssid
+        self.bssids = []
+        self.access_points = []
+        self.max_strength = None
+        self.total_strength = 0
+        self.frequencies = []
+        # None if the security of no access point is known
+        self.secured = None
+        self.last_seen = None
+
+    def add(
+        self,
+        bssid,
+        strength=None,
+        frequency=None,
+        secured=None,
+        last_seen=None,
+        ap=None,
+    ):
+        self.bssids.append(bssid)
+        if ap is not None:
+            self.access_points.append(ap)
+        if strength is not None:
+            self.total_strength += strength
+            if self.max_strength is None or strength > self.max_strength:
+                self.max_strength = strength
+        if frequency is not None and frequency not in self.frequencies:
+            self.frequencies.append(frequency)
+            self.frequencies.sort()
+        if secured is not None:
+            # If any access point is secured, connecting needs a password
+            self.secured = bool(self.secured) or secured
+        if last_seen is not None and (
+            self.last_seen is None or last_seen > self.last_seen
+        ):
+            self.last_seen = last_seen
+
+    @property
+    def mean_strength(self):
+        if len(self.bssids) == 0 or self.max_strength is None:
+            return None
+        return float(self.total_strength) / len(self.bssids)
+
+    def bands(self):
+        """
+        Returns the bands the SSID is on, as a list of "2.4GHz", "5GHz" and "6GHz".
+        """
+        bands = []
+        for frequency in self.frequencies:
+            if frequency < 3000:
+                band = "2.4GHz"
+            elif frequency < 5925:
+                band = "5GHz"
+            else:
+                band = "6GHz"
+            if band not in bands:
+                bands.append(band)
+        return bands
+
+    def to_json(self, volatile=True):
+        """
+        Returns a dict of the entry. Without volatile, only what does not
+        change from one scan of the same access points to the next: no
+        strengths and no last_seen, and the BSSIDs sorted.
+        """
+        if not volatile:
+            return {
+                "ssid": self.ssid,
+                "bssids": sorted(self.bssids),
+                "frequencies": list(self.frequencies),
+                "secured": self.secured,
+            }
+        return {
+            "ssid": self.ssid,
+            "bssids": list(self.bssids),
+            "max_strength": self.max_strength,
+            "mean_strength": self.mean_strength,
+            "frequencies": list(self.frequencies),
+            "secured": self.secured,
+            "last_seen": self.last_seen,
+        }
+
+    @classmethod
+    def from_json(cls, record):
+        entry = cls(record["ssid"])
+        entry.bssids = list(record.get("bssids", []))
+        entry.max_strength = record.get("max_strength")
+        mean = record.get("mean_strength")
+        if mean is not None:
+            entry.total_strength = mean * len(entry.bssids)
+        entry.frequencies = list(record.get("frequencies", []))
+        entry.secured = record.get("secured")
+        entry.last_seen = record.get("last_seen")
+        return entry
+
+
+class ScanTable(object):
+    """
+    The ScanEntry of every SSID seen, built one access point at a time with add().
+
+    Access points of hidden networks are only counted (in hidden).
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self.hidden = 0
+
+    def add(self, ssid, bssid, **kwargs):
+        """
+        Add an access point, see ScanEntry.add for the other arguments.
+        """
+        if ssid == HIDDEN_SSID or ssid is None:
+            self.hidden += 1
+            return
+        entry = self._entries.get(ssid)
+        if entry is None:
+            entry = self._entries[ssid] = ScanEntry(ssid)
+        entry.add(bssid, **kwargs)
+
+    def get(self, ssid):
+        """
+        Returns the ScanEntry of ssid, or None if it was not seen.
+        """
+        return self._entries.get(ssid)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, ssid):
+        return ssid in self._entries
+
+    def entries(self):
+        """
+        Returns the entries, strongest first.
+        """
+        return sorted(
+            self._entries.values(),
+            key=lambda entry: (
+                entry.max_strength is None,
+                -(entry.max_strength or 0),
+                entry.ssid,
+            ),
+        )
+
+    def ssids(self):
+        """
+        Returns the SSIDs seen, strongest first.
+        """
+        return [entry.ssid for entry in self.entries()]
+
+    def to_json(self, volatile=True):
+        """
+        Returns a dict of the table, the entries strongest first. Without
+        volatile, the entries are in SSID order and leave out what changes
+        with every scan (see ScanEntry.to_json), so that saving the same
+        networks again writes the same thing.
+        """
+        if not volatile:
+            entries = sorted(self._entries.values(), key=lambda entry: entry.ssid)
+        else:
+            entries = self.entries()
+        return {
+            "hidden": self.hidden,
+            "entries": [entry.to_json(volatile) for entry in entries],
+        }
+
+    @classmethod
+    def from_json(cls, table):
+        scan_table = cls()
+        scan_table.hidden = table.get("hidden", 0)
+        for record in table.get("entries", []):
+            entry = ScanEntry.from_json(record)
+            scan_table._entries[entry.ssid] = entry
+        return scan_table
@@ -0,0 +1,163 @@
+"""
+This module ranks candidate connections, so that pifi connects to the best
+network it can see, and not just the one with the strongest signal.
+
+Every candidate is an access point paired with a pending connection. Its score
+is the weighted sum of a set of factors, each factor looks at one feature for
+the whole candidate set at once and maps it to values between 0 and 1.
+
+Factors are plain functions, add to or replace the ones in default_factors to
+change how candidates are ranked.
+"""
+
+# Frequencies (in MHz) at or above this are considered 5GHz (or higher) band
+five_ghz_band = 4900
+
+
+class Candidate(object):
+    """
+    Features of one (AccessPoint, Connection) pair that factors can look at.
+
+    Features that are not known are None.
+    """
+
+    __slots__ = (
+        "ap",
+        "con",
+        "strength",
+        "frequency",
+        "max_bitrate",
+        "ap_secured",
+        "con_secured",
+        "priority",
+        "history",
+        "score",
+    )
+
+    def __init__(
+        self,
+        ap,
+        con,
+        strength=None,
+        frequency=None,
+        max_bitrate=None,
+        ap_secured=None,
+        con_secured=None,
+        priority=0,
+        history=None,
+    ):
+        self.ap = ap
+        self.con = con
+        self.strength = strength
+        self.frequency = frequency
+        self.max_bitrate = max_bitrate
+        self.ap_secured = ap_secured
+        self.con_secured = con_secured
+        self.priority = priority
+        # (successes, failures) connecting to this network before
+        self.history = history
+        self.score = 0.0
+
+    def __repr__(self):
+        return "Candidate(score=%.3f, strength=%s, frequency=%s, max_bitrate=%s)" % (
+            self.score,
+            self.strength,
+            self.frequency,
+            self.max_bitrate,
+        )
+
+
+def strength_factor(candidates):
+    """Signal strength, as reported by NetworkManager (0-100)"""
+    return [
+        0.0 if c.strength is None else min(max(c.strength, 0), 100) / 100.0
+        for c in candidates
+    ]
+
+
+def band_factor(candidates):
+    """Prefer the 5GHz band, it is usually less crowded"""
+    return [
+        1.0 if c.frequency is not None and c.frequency >= five_ghz_band else 0.0
+        for c in candidates
+    ]
+
+
+def bitrate_factor(candidates):
+    """Maximum bitrate, relative to the fastest candidate"""
+    fastest = max([c.max_bitrate or 0 for c in candidates])
+    if fastest <= 0:
+        return [0.0] * len(candidates)
+    return [(c.max_bitrate or 0) / float(fastest) for c in candidates]
+
+
+def security_factor(candidates):
+    """
+    Penalize candidates where the access point security does not match the
+    connection, connecting to those will fail (or worse, is an impostor).
+    """
+    values = []
+    for c in candidates:
+        if c.ap_secured is None or c.con_secured is None:
+            values.append(0.5)
+        elif c.ap_secured == c.con_secured:
+            values.append(1.0)
+        else:
+            values.append(0.0)
+    return values
+
+
+def priority_factor(candidates):
+    """The autoconnect-priority the user set on the connection, relative to the others"""
+    priorities = [c.priority or 0 for c in candidates]
+    lowest = min(priorities)
+    spread = max(priorities) - lowest
+    if spread == 0:
+        return [0.0] * len(candidates)
+    return [(p - lowest) / float(spread) for p in priorities]
+
+
+def history_factor(candidates):
+    """How often connecting to this network worked before, 0.5 if we don't know"""
+    values = []
+    for c in candidates:
+        if c.history is None:
+            values.append(0.5)
+        else:
+            successes, failures = c.history
+            values.append((successes + 1.0) / (successes + failures + 2.0))
+    return values
+
+
+# List of (weight, factor)
+default_factors = [
+    (1.0, strength_factor),
+    (0.3, band_factor),
+    (0.3, bitrate_factor),
+    (2.0, security_factor),
+    (4.0, priority_factor),
+    (0.5, history_factor),
+]
+
+
+def rank(candidates, factors=None):
+    """
+    Score the candidates and return them as a new list, best first.
+
+    Candidates with the same score keep their relative order.
+    """
+    if factors is None:
+        factors = default_factors
+    candidates = list(candidates)
+    if len(candidates) == 0:
+        return candidates
+
+    scores = [0.0] * len(candidates)
+    for weight, factor in factors:
+        scores = [
+            score + weight * value for score, value in zip(scores, factor(candidates))
+        ]
+    for candidate, score in zip(candidates, scores):
+        candidate.score = score
+
+    return sorted(candidates, key=lambda c: -c.score)
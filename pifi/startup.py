@@ -1,53 +1,39 @@
 import time
-
-# Wait a bit before starting if we are early in boot
-with open("/proc/uptime", "r") as f:
-    uptime = float(f.readline().split()[0])
-    if uptime < 5:
-        time.sleep(3)
-
+import signal
 import NetworkManager
 
 import uuid
 import json
-import evdev
-from select import select
 
 import pifi.nm_helper as nm
+import pifi.nm_events as nm_events
 import pifi.var_io as var_io
 import pifi.etc_io as etc_io
 import pifi.leds as leds
+import pifi.button as button
+import pifi.trace as trace
+import pifi.dbus_stats as dbus_stats
 
 # LED Animation patterns (ms on, ms off)
 initializing_led = (100, 300)
 ap_led = (100, 1000)
 connected_led = (100, 2000)
 
+# How many access points to try for the same pending connection before giving up on it
+attempts_per_connection = 2
 
-def handle_button(pifi_conf_settings, ApModeDevice, ClientModeDevice):
-    button = None
 
-    input_devices = [evdev.InputDevice(fn) for fn in evdev.list_devices()]
-    for device in input_devices:
-        print(device.fn, device.name, device.phys)
-        if device.name == pifi_conf_settings["button_device_name"]:
-            print("Using %s" % device.fn)
-            button = device
-            button.grab()
-
-    if button is None:
+def handle_button(pifi_conf_settings, ApModeDevice, ClientModeDevice):
+    if pifi_conf_settings["button_device_name"] is None:
         return
 
-    while 1:
-        r, w, x = select([button.fd], [], [], 10)
-        if r:
-            for event in button.read():
-                if event.code == evdev.ecodes.KEY_CONFIG:
-                    break
-            # Construct to be able to break out of outer loop from inner loop
-            else:
-                continue
-            break
+    # Waits for the button device to be plugged in if it isn't yet
+    watcher = button.ButtonWatcher(pifi_conf_settings["button_device_name"])
+    try:
+        watcher.wait()
+    finally:
+        watcher.close()
+
     # Button was pressed, start AP mode
     start_ap_mode(pifi_conf_settings, ApModeDevice, ClientModeDevice)
 
@@ -58,95 +44,358 @@ def start_ap_mode(pifi_conf_settings, ApModeDevice, ClientModeDevice):
     if pifi_conf_settings["delete_existing_ap_connections"] == False:
         print("Looking for existing AP mode connection")
 
-        for connection in nm.existingAPConnections():
+        for connection, settings in nm.saved_connections().wireless(ap=True):
             print(
                 "Found existing AP mode connection, SSID: %s"
-                % connection.GetSettings()["802-11-wireless"]["ssid"]
+                % settings["802-11-wireless"]["ssid"]
             )
             print("Initializing AP Mode")
             NetworkManager.NetworkManager.ActivateConnection(
                 connection, ApModeDevice, "/"
             )
             return  # We don't acutally want to loop, just use the first iter
-    else:
-        for connection in nm.existingAPConnections():
+        print("No existing AP mode connections found")
+
+    # Default AP mode connection
+    settings = etc_io.get_default_ap_conf(ApModeDevice.HwAddress)
+    digest = etc_io.ap_conf_digest(settings)
+
+    # Reuse the connection we created last time if the configuration is the
+    # same, instead of writing a new one to disk every time
+    saved_connections = nm.saved_connections()
+    reused = None
+    profile = var_io.readAPProfile()
+    if profile is not None and profile.get("hash") == digest:
+        reused = saved_connections.by_uuid(profile.get("uuid"))
+
+    if pifi_conf_settings["delete_existing_ap_connections"] != False:
+        for connection, existing in saved_connections.wireless(ap=True):
+            if reused is not None and connection is reused[0]:
+                continue
             print(
                 "Deleting existing AP mode connection, SSID: %s"
-                % connection.GetSettings()["802-11-wireless"]["ssid"]
+                % existing["802-11-wireless"]["ssid"]
             )
             connection.Delete()
+            saved_connections.forget(connection)
 
-    print("No existing AP mode connections found")
-    print("Creating new default AP mode connection with config:")
-
-    # Default AP mode connection
-    settings = etc_io.get_default_ap_conf(ApModeDevice.HwAddress)
-    print(json.dumps(settings, indent=1))  ## Pretty Print settings
+    if reused is not None:
+        print(
+            "Reusing unchanged AP mode connection, SSID: %s"
+            % settings["802-11-wireless"]["ssid"]
+        )
+        print("Initializing AP Mode")
+        NetworkManager.NetworkManager.ActivateConnection(reused[0], ApModeDevice, "/")
+    else:
+        print("Creating new default AP mode connection with config:")
+        print(json.dumps(settings, indent=1))  ## Pretty Print settings
 
-    print("Initializing AP Mode")
-    NetworkManager.NetworkManager.AddAndActivateConnection(settings, ApModeDevice, "/")
+        print("Initializing AP Mode")
+        NetworkManager.NetworkManager.AddAndActivateConnection(
+            settings, ApModeDevice, "/"
+        )
+        # default_ap.em may leave the uuid out, then there is nothing to reuse
+        ap_uuid = settings.get("connection", {}).get("uuid")
+        if ap_uuid is not None:
+            try:
+                var_io.writeAPProfile({"uuid": ap_uuid, "hash": digest})
+            except PermissionError:
+                print("Error writing to %s, continuing" % var_io.ap_profile_path)
 
     status_led = pifi_conf_settings["status_led"]
     leds.try_blink(status_led, delay_on=ap_led[0], delay_off=ap_led[1])
 
 
+def save_scan(ClientModeDevice):
+    """
+    Save what the client device sees, one line per SSID in the seen SSIDs
+    file, the details in the scan table file, and a snapshot in the scan history.
+
+    Returns the ScanTable, see connect_to_pending.
+    """
+    table = nm.scan_table([ClientModeDevice])
+    try:
+        # Only what doesn't change from boot to boot, so that the files are
+        # not written again when the same networks are around, the
+        # strengths are in the scan history
+        var_io.writeSeenSSIDs(sorted(table.ssids()))
+        var_io.writeScanTable(table.to_json(volatile=False))
+        var_io.appendScanHistory(table)
+    except PermissionError as e:
+        print("Error writing to %s, continuing" % e.filename)
+    return table
+
+
+def connect_to_pending(pifi_conf_settings, ClientModeDevice, pending, table=None):
+    """
+    Try the pending connections that the client device can see, best ranked
+    first, until one of them activates. Connections that fail to activate
+    within connect_timeout seconds are deleted again, and the next one is tried.
+
+    If a ScanTable of the client device is given (see save_scan), the access
+    points are taken from it.
+
+    Returns the pending connection that got activated, or None if none did.
+    """
+    ranked = nm.rankConnections(
+        nm.availibleConnections(ClientModeDevice, pending, table=table),
+        history=connection_history(),
+    )
+    if len(ranked) == 0:
+        print("No SSIDs from pending connections found")
+        return None
+
+    attempts = {}
+    for ap, con in ranked:
+        ssid = con["802-11-wireless"]["ssid"]
+        # The same network can be seen through several access points, but
+        # don't spend forever on a network with a wrong password
+        if attempts.get(id(con), 0) >= attempts_per_connection:
+            continue
+        attempts[id(con)] = attempts.get(id(con), 0) + 1
+
+        print("Connecting to %s" % ssid)
+        try:
+            connection, active_connection = (
+                NetworkManager.NetworkManager.AddAndActivateConnection(
+                    con, ClientModeDevice, ap
+                )
+            )
+        except Exception as e:
+            print("WARN failed to add connection to %s: %s" % (ssid, e))
+            continue
+
+        if nm.wait_for_activation(
+            active_connection, pifi_conf_settings["connect_timeout"]
+        ):
+            print("Connected to %s" % ssid)
+            record_connection_result(ssid, True)
+            remember_network(ClientModeDevice)
+            return con
+
+        print("WARN connecting to %s failed, trying the next network" % ssid)
+        record_connection_result(ssid, False)
+        try:
+            connection.Delete()
+        except Exception as e:
+            print("WARN failed to delete connection to %s: %s" % (ssid, e))
+
+    print("Could not connect to any pending connection")
+    return None
+
+
+def connection_history():
+    """
+    Returns how often connecting to each SSID worked before, as
+    nm.rankConnections takes it.
+    """
+    return {
+        nm.normalize_ssid(ssid): counts
+        for ssid, counts in var_io.readConnectionHistory().items()
+    }
+
+
+def record_connection_result(ssid, success):
+    """
+    Count a success or failure connecting to ssid, for the ranking of the
+    next boots (see connection_history).
+    """
+    try:
+        var_io.recordConnectionResult(ssid, success)
+    except PermissionError:
+        print("Error writing to %s, continuing" % var_io.connection_history_path)
+
+
+def remember_network(ClientModeDevice):
+    """
+    Save the network the client device is connected to, so that the next boot
+    can try it first (see connect_to_last_network).
+    """
+    if not nm.properties.watching:
+        nm.properties.invalidate()
+    network = nm.active_network(ClientModeDevice)
+    if network is None or network == var_io.readLastNetwork():
+        return
+
+    try:
+        var_io.writeLastNetwork(network)
+    except PermissionError:
+        print("Error writing to %s, continuing" % var_io.last_network_path)
+
+
+def connect_to_last_network(pifi_conf_settings, ClientModeDevice):
+    """
+    Try to connect to the network we were last connected to, without waiting
+    for a scan to finish. NetworkManager keeps scanning while it activates,
+    and if the scan finishes without the network in it we stop waiting then.
+
+    Returns True if it got activated within connect_timeout seconds.
+    """
+    network = var_io.readLastNetwork()
+    if network is None:
+        return False
+
+    print("Connecting to the last network, %s" % network["ssid"])
+    try:
+        active_connection = nm.activate_network(ClientModeDevice, network)
+    except Exception as e:
+        print("WARN failed to activate %s: %s" % (network["ssid"], e))
+        return False
+    if active_connection is None:
+        print("WARN %s is not a saved connection anymore" % network["ssid"])
+        return False
+
+    activated = nm.wait_for_network(
+        ClientModeDevice,
+        active_connection,
+        network["ssid"],
+        pifi_conf_settings["connect_timeout"],
+    )
+    if activated:
+        print("Connected to %s" % network["ssid"])
+        record_connection_result(network["ssid"], True)
+        return True
+    if activated is None:
+        # Not around, that says nothing about connecting to it
+        print("%s was not found in the scan" % network["ssid"])
+        return False
+
+    print("WARN connecting to %s failed" % network["ssid"])
+    record_connection_result(network["ssid"], False)
+    return False
+
+
+def wait_for_boot(open=open, sleep=time.sleep):
+    """
+    Wait a bit before starting if we are early in boot
+    """
+    with open("/proc/uptime", "r") as f:
+        uptime = float(f.readline().split()[0])
+        if uptime < 5:
+            sleep(3)
+
+
+def save_trace(tracer, stats=None):
+    """
+    Save the timing of this boot, see `pifi boot-trace`
+    """
+    record = tracer.record()
+    if stats is not None:
+        print(stats.report())
+        record["dbus"] = stats.summary()
+    try:
+        var_io.appendBootTrace(record)
+    except PermissionError:
+        print("Error writing to %s, continuing" % var_io.boot_trace_path)
+
+
 def main():
-    pifi_conf_settings = etc_io.get_conf()
+    # systemctl reload pifi sends SIGHUP, which would kill us until the conf
+    # is watched below, and there is nothing to reload before it is read
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    tracer = trace.Tracer()
+    stats = None
+    if dbus_stats.enabled():
+        stats = dbus_stats.Stats(phase=lambda: tracer.current)
+        stats.install()
 
-    ApModeDevice, ClientModeDevice = nm.select_devices(pifi_conf_settings)
+    with tracer.span("boot_wait"):
+        wait_for_boot()
+    with tracer.span("config"):
+        # Reloaded on SIGHUP, the button may wait for a long time
+        pifi_conf_settings = etc_io.LiveConf()
+        pifi_conf_settings.watch()
+
+        # Signals are only delivered if this is done before we first talk to NetworkManager
+        if nm_events.use_glib_mainloop():
+            nm.properties.watch()
+            nm.saved_connections().watch()
+
+    with tracer.span("devices"):
+        ApModeDevice, ClientModeDevice, selection = nm.select_devices_cached(
+            pifi_conf_settings, var_io.readDeviceSelection()
+        )
+        if selection is not None:
+            try:
+                var_io.writeDeviceSelection(selection)
+            except PermissionError:
+                print("Error writing to %s, continuing" % var_io.devices_path)
 
     print("Using %s for AP mode support" % ApModeDevice.Interface)
     print("Using %s for wifi client mode" % ClientModeDevice.Interface)
 
     status_led = pifi_conf_settings["status_led"]
-    leds.try_blink(
-        status_led, delay_on=initializing_led[0], delay_off=initializing_led[1]
-    )
+    with tracer.span("leds"):
+        leds.try_blink(
+            status_led, delay_on=initializing_led[0], delay_off=initializing_led[1]
+        )
 
-    # Allow 30 seconds for network manager to sort itself out
-    time.sleep(30)
-    var_io.writeSeenSSIDs(nm.seenSSIDs([ClientModeDevice]))
+    # Most of the time we boot up where we shut down, so try the last network
+    # right away, instead of waiting for the scan below
+    decision = "connected"
+    if ClientModeDevice.State != NetworkManager.NM_DEVICE_STATE_ACTIVATED:
+        with tracer.span("last_network"):
+            if connect_to_last_network(pifi_conf_settings, ClientModeDevice):
+                decision = "last_network"
+
+    # Wait for network manager to finish scanning (or connect on its own),
+    # but not longer than scan_timeout
+    with tracer.span("scan"):
+        if not nm.wait_for_scan(ClientModeDevice, pifi_conf_settings["scan_timeout"]):
+            print(
+                "WARN wifi scan did not finish in %s seconds, continuing"
+                % pifi_conf_settings["scan_timeout"]
+            )
+        if not nm.properties.watching:
+            # Nothing kept the cached properties up to date while we waited
+            nm.properties.invalidate()
+        table = save_scan(ClientModeDevice)
 
     if ClientModeDevice.State == NetworkManager.NM_DEVICE_STATE_ACTIVATED:
         print(
             "Client Device currently connected to: %s"
             % ClientModeDevice.SpecificDevice().ActiveAccessPoint.Ssid
         )
+        remember_network(ClientModeDevice)
         leds.try_blink(
             status_led, delay_on=connected_led[0], delay_off=connected_led[1]
         )
+        tracer.decide(decision)
+        save_trace(tracer, stats)
         # Run button handler, and when that is done, exit
         handle_button(pifi_conf_settings, ApModeDevice, ClientModeDevice)
         return
     else:
         print("Device is not connected to any network, Looking for pending connections")
 
-        pending = var_io.readPendingConnections()
+        with tracer.span("pending"):
+            pending = var_io.readPendingStore()
 
-        # Try to pick a connection to use, if none found, just continue
-        try:
-            # Use the best connection
-            best_ap, best_con = nm.selectConnection(
-                nm.availibleConnections(ClientModeDevice, pending)
+            # Try the pending connections from best to worst, if none work, just continue
+            connected = connect_to_pending(
+                pifi_conf_settings, ClientModeDevice, pending.connections(), table=table
             )
-
-            print("Connecting to %s" % best_con["802-11-wireless"]["ssid"])
-            NetworkManager.NetworkManager.AddAndActivateConnection(
-                best_con, ClientModeDevice, best_ap
-            )
-
-            new_pending = var_io.readPendingConnections().remove(best_con)
-            var_io.writePendingConnections(new_pending)
-
+            # Fold the journal back into the pending file, re-read as pending
+            # connections may have been added while we connected
+            try:
+                with var_io.pendingTransaction(compact=True) as pending:
+                    if connected is not None:
+                        pending.remove(connected)
+            except PermissionError as e:
+                print("Error writing to %s, continuing" % e.filename)
+        if connected is not None:
             leds.try_blink(
                 status_led, delay_on=connected_led[0], delay_off=connected_led[1]
             )
+            tracer.decide("pending")
+            save_trace(tracer, stats)
             # Run button handler, and when that is done, exit
             handle_button(pifi_conf_settings, ApModeDevice, ClientModeDevice)
             return
-        except ValueError:
-            pass
 
         # If we reach this point, we gave up on Client mode
-        print("No SSIDs from pending connections found")
-        start_ap_mode(pifi_conf_settings, ApModeDevice, ClientModeDevice)
+        with tracer.span("ap_mode"):
+            start_ap_mode(pifi_conf_settings, ApModeDevice, ClientModeDevice)
+        tracer.decide("ap_mode")
+        save_trace(tracer, stats)
@@ -0,0 +1,190 @@
+"""
+This module renders empy templates like /etc/pifi/default_ap.em without
+importing empy for the ones that only use @(expression) and @@.
+
+A template is parsed once into literal text and compiled expressions, and
+kept by the digest of its text, so rendering it again only evaluates the
+expressions. The expressions that don't use a volatile variable (one that
+changes every time, like a new UUID) are only evaluated once per value of
+the other variables.
+
+Templates that use any other empy markup are rendered by empy, like before.
+"""
+
+import hashlib
+import collections
+
+# Number of compiled templates, and of sets of variables per template, kept
+cache_size = 8
+
+
+class NeedsEmpy(ValueError):
+    """
+    The template uses empy markup this module does not render.
+    """
+
+
+class Template(object):
+    """
+    A template that only uses @(expression) and @@, see the module docstring.
+
+    Raises NeedsEmpy for other templates.
+    """
+
+    def __init__(self, text, name="<template>"):
+        self.name = name
+        # Literal strings, and code objects of the expressions
+        self.parts = []
+        # Literal text parts merged, the expressions evaluated, by variables
+        self._bound = collections.OrderedDict()
+        self._parse(text)
+
+    def _literal(self, text):
+        if len(self.parts) > 0 and isinstance(self.parts[-1], str):
+            self.parts[-1] += text
+        elif text != "":
+            self.parts.append(text)
+
+    def _parse(self, text):
+        position = 0
+        while True:
+            at = text.find("@", position)
+            if at < 0:
+                self._literal(text[position:])
+                return
+            self._literal(text[position:at])
+            markup = text[at + 1 : at + 2]
+            if markup == "@":
+                self._literal("@")
+                position = at + 2
+            elif markup == "(":
+                end = _closing_paren(text, at + 1)
+                try:
+                    code = compile(text[at + 2 : end].strip(), self.name, "eval")
+                except SyntaxError:
+                    # Empy extensions like @(condition ? yes ! no)
+                    raise NeedsEmpy("%s uses @(...) that is not Python" % self.name)
+                self.parts.append(code)
+                position = end + 1
+            else:
+                raise NeedsEmpy("%s uses @%s" % (self.name, markup))
+
+    def render(self, variables, volatile=()):
+        """
+        Returns the text of the template with the expressions evaluated over
+        variables (a dict of name -> value). Expressions that return None
+        render as nothing, like in empy.
+
+        The expressions that don't use any of the volatile variable names are
+        cached for the values of the other variables, when they are hashable.
+        """
+        key = tuple(
+            sorted(
+                (name, value)
+                for name, value in variables.items()
+                if name not in volatile
+            )
+        )
+        try:
+            parts = self._bound.get(key)
+        except TypeError:
+            # Not hashable, can't be cached
+            parts = key = None
+        if parts is None:
+            parts = self._bind(variables, set(volatile))
+            if key is not None:
+                self._bound[key] = parts
+                if len(self._bound) > cache_size:
+                    self._bound.popitem(last=False)
+
+        namespace = None
+        rendered = []
+        for part in parts:
+            if isinstance(part, str):
+                rendered.append(part)
+            else:
+                if namespace is None:
+                    namespace = dict(variables)
+                rendered.append(_evaluate(part, namespace))
+        return "".join(rendered)
+
+    def _bind(self, variables, volatile):
+        namespace = dict(variables)
+        parts = []
+        for part in self.parts:
+            if not isinstance(part, str) and volatile.isdisjoint(part.co_names):
+                part = _evaluate(part, namespace)
+            if len(parts) > 0 and isinstance(part, str) and isinstance(parts[-1], str):
+                parts[-1] += part
+            else:
+                parts.append(part)
+        return parts
+
+
+def _evaluate(code, namespace):
+    value = eval(code, namespace)
+    return "" if value is None else str(value)
+
+
+def _closing_paren(text, start):
+    """
+    Returns the position of the parenthesis closing the one at start, skipping
+    the ones in string literals.
+    """
+    depth = 0
+    quote = None
+    position = start
+    while position < len(text):
+        char = text[position]
+        if quote is not None:
+            if char == "\\":
+                position += 1
+            elif char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif char in "([{":
+            depth += 1
+        elif char in ")]}":
+            depth -= 1
+            if depth == 0:
+                return position
+        position += 1
+    raise NeedsEmpy("Unterminated @( at %d" % start)
+
+
+# Digest of the text -> Template, or None if it needs empy
+_templates = collections.OrderedDict()
+
+
+def compiled(text, name="<template>"):
+    """
+    Returns the Template for text, parsed once and kept while it is one of
+    the cache_size last used, or None if it needs empy.
+    """
+    digest = hashlib.sha1(text.encode("utf-8")).digest()
+    if digest in _templates:
+        _templates.move_to_end(digest)
+        return _templates[digest]
+    try:
+        template = Template(text, name)
+    except NeedsEmpy:
+        template = None
+    _templates[digest] = template
+    if len(_templates) > cache_size:
+        _templates.popitem(last=False)
+    return template
+
+
+def expand(text, variables, volatile=(), name="<template>"):
+    """
+    Returns text rendered with variables, like em.expand(text, variables).
+
+    Only imports and runs empy if the template needs it.
+    """
+    template = compiled(text, name)
+    if template is not None:
+        return template.render(variables, volatile)
+    import em
+
+    return em.expand(text, variables)
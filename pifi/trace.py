@@ -0,0 +1,112 @@
+"""
+This module records where the time goes while pifi_startup runs.
+
+A Tracer times each phase of a boot (a span), and remembers the decision
+that was taken at the end (connected, AP mode, ...). The record of every
+boot is saved by var_io.appendBootTrace, `pifi boot-trace` summarizes them.
+"""
+
+import time
+import contextlib
+
+
+class Tracer(object):
+    """
+    Records spans for one boot, times are in seconds from the tracer's creation.
+    """
+
+    def __init__(self, clock=time.monotonic, wall_clock=time.time):
+        self._clock = clock
+        self._start = clock()
+        self.started_at = wall_clock()
+        self.spans = []
+        self.decision = None
+        # Name of the innermost span that is running
+        self.current = None
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """
+        Context manager that records how long its body takes, as the phase name.
+        """
+        start = self._clock()
+        outer, self.current = self.current, name
+        try:
+            yield
+        finally:
+            self.current = outer
+            self.spans.append(
+                {
+                    "name": name,
+                    "start": start - self._start,
+                    "duration": self._clock() - start,
+                }
+            )
+
+    def decide(self, decision):
+        """
+        Record the outcome of the boot
+        """
+        self.decision = decision
+
+    def record(self):
+        """
+        Returns a json serializable dict of everything recorded so far.
+        """
+        return {
+            "started_at": self.started_at,
+            "decision": self.decision,
+            "total": self._clock() - self._start,
+            "spans": list(self.spans),
+        }
+
+
+def phase_durations(record):
+    """
+    Returns a dict of phase name to the total time spent in it during a boot.
+    """
+    durations = {}
+    for span in record.get("spans", []):
+        durations[span["name"]] = durations.get(span["name"], 0.0) + span["duration"]
+    return durations
+
+
+def percentile(values, p):
+    """
+    Returns the p-th (0-100) percentile of values, interpolating between the
+    closest ranks, or None if there are no values.
+    """
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    rank = (len(values) - 1) * p / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def summarize(records, percentiles=(50, 90, 99)):
+    """
+    Returns a list of (phase, [percentile values], max) over records, phases
+    in the order they first appear, with the boot total last.
+    """
+    phases = []
+    durations = {}
+    for record in records:
+        for name, duration in phase_durations(record).items():
+            if name not in durations:
+                phases.append(name)
+                durations[name] = []
+            durations[name].append(duration)
+
+    phases.append("total")
+    durations["total"] = [record.get("total", 0.0) for record in records]
+
+    return [
+        (
+            phase,
+            [percentile(durations[phase], p) for p in percentiles],
+            max(durations[phase]) if durations[phase] else None,
+        )
+        for phase in phases
+    ]
@@ -1,21 +1,64 @@
 """
 This module handles all of the pifi files in /var
 
-The files in /var are the pending connections file, and the seen SSIDs file
+The files in /var are the pending connections file (and its journal, see
+pifi.pending), the seen SSIDs file,
+the scan table file with what was seen of each SSID, the devices file that
+remembers which devices were used on the last boot,
+the last network file that remembers the last network pifi connected to,
+the connection history file that counts how often connecting to each SSID
+worked,
+the AP profile file that remembers which AP mode connection pifi created,
+the boot trace file with the timing of the last boots, the scan history
+file with what was seen in the scans of the last boots, and the conf cache
+file with the settings last read from /etc/pifi/pifi.conf
 """
 
 # This file requires python3, due to better more detailed exceptions
 
 
 seen_SSIDs_path = "/var/lib/pifi/seen_ssids"
+scan_table_path = "/var/lib/pifi/scan_table"
 pending_path = "/var/lib/pifi/pending"
+pending_journal_path = "/var/lib/pifi/pending.journal"
+pending_lock_path = "/var/lib/pifi/pending.lock"
+devices_path = "/var/lib/pifi/devices"
+last_network_path = "/var/lib/pifi/last_network"
+connection_history_path = "/var/lib/pifi/connection_history"
+ap_profile_path = "/var/lib/pifi/ap_profile"
+boot_trace_path = "/var/lib/pifi/boot_trace"
+scan_history_path = "/var/lib/pifi/scan_history"
+conf_cache_path = "/var/lib/pifi/conf_cache"
 
 # Used for debugging
 # seen_SSIDs_path = "/tmp/pifi/seen_ssids"
+# scan_table_path = "/tmp/pifi/scan_table"
 # pending_path = "/tmp/pifi/pending"
+# pending_journal_path = "/tmp/pifi/pending.journal"
+# pending_lock_path = "/tmp/pifi/pending.lock"
+# devices_path = "/tmp/pifi/devices"
+# last_network_path = "/tmp/pifi/last_network"
+# connection_history_path = "/tmp/pifi/connection_history"
+# ap_profile_path = "/tmp/pifi/ap_profile"
+# boot_trace_path = "/tmp/pifi/boot_trace"
+# scan_history_path = "/tmp/pifi/scan_history"
+# conf_cache_path = "/tmp/pifi/conf_cache"
+
+# How many operations the pending journal holds before it is folded into pending_path
+pending_journal_keep = 64
+
+# How many boots to keep in boot_trace_path
+boot_trace_keep = 200
+
+# How many records (one per scan, and one per SSID seen in it) to keep in
+# scan_history_path, the file takes 64 bytes per record
+scan_history_size = 4096
 
 import os
 import json
+import fcntl
+import struct
+import contextlib
 
 
 def ensureDir(file_path):
@@ -29,6 +72,41 @@ def ensureDir(file_path):
         pass
 
 
+def writeFile(
+    path, contents, open=open, ensureDir=ensureDir, fsync=os.fsync, replace=os.replace
+):
+    """
+    Takes a string and writes it to path, unless path already has exactly
+    that in it. Returns True if the file was written, False if not.
+
+    The contents go to a temporary file next to path first, which is synced
+    and renamed over path, so that path has either the old or the new
+    contents, even after a power cut.
+    """
+    try:
+        with open(path, "r") as existing_file:
+            if existing_file.read() == contents:
+                return False
+    except (FileNotFoundError, UnicodeDecodeError):
+        pass
+
+    ensureDir(path)
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(temp_path, "w") as temp_file:
+            temp_file.write(contents)
+            temp_file.flush()
+            fsync(temp_file.fileno())
+        replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    return True
+
+
 def readSeenSSIDs(open=open):
     """
     Returns a list of strings containg the ssids in seen_SSIDs_path.
@@ -52,13 +130,44 @@ def writeSeenSSIDs(ssids, open=open, ensureDir=ensureDir):
     Takes a list of ssids and writes them to seen_SSIDs_path.
     One ssid per line.
 
-    If the file already exists, this overwrites it.
+    If the file already exists, this replaces it (see writeFile).
+    """
+    writeFile(
+        seen_SSIDs_path,
+        "".join("%s\n" % (ssid) for ssid in ssids),
+        open=open,
+        ensureDir=ensureDir,
+    )
+
+
+def readScanTable(open=open):
+    """
+    Returns the dict parsed from the json in the file scan_table_path, see
+    pifi.scan_table.ScanTable.to_json.
+
+    If the file does not exist, or does not have a valid json dict then return None.
+    """
+    try:
+        with open(scan_table_path, "r") as scan_table_file:
+            try:
+                table = json.load(scan_table_file)
+            except ValueError:
+                print("WARN failed to decode json in %s, ignoring" % scan_table_path)
+                return None
+            if not isinstance(table, dict):
+                return None
+            return table
+    except FileNotFoundError:
+        return None
+
+
+def writeScanTable(table, open=open, ensureDir=ensureDir):
     """
-    ensureDir(seen_SSIDs_path)
-    with open(seen_SSIDs_path, "w+") as seen_file:
-        seen_file.truncate()
-        for ssid in ssids:
-            seen_file.write("%s\n" % (ssid))
+    Takes a dict and writes the json representation to scan_table_path.
+
+    If the file already exists, this replaces it (see writeFile).
+    """
+    writeFile(scan_table_path, json.dumps(table), open=open, ensureDir=ensureDir)
 
 
 def readPendingConnections(open=open):
@@ -86,13 +195,410 @@ def writePendingConnections(pending, open=open, ensureDir=ensureDir):
     """
     Takes a list of dicts and writes the json representation to pending_path.
 
-    If the file already exists, this overwrites it.
+    If the file already exists, this replaces it (see writeFile).
+    """
+    if pending is None:
+        pending = list()
+    writeFile(pending_path, json.dumps(pending), open=open, ensureDir=ensureDir)
+
+
+def readPendingStore(open=open):
+    """
+    Returns a pifi.pending.PendingStore of the connections in pending_path,
+    with the operations in pending_journal_path applied.
+
+    One line of the journal is the json of one operation, lines that are not
+    valid json (an operation that was cut off while writing) are skipped.
+    """
+    import pifi.pending as pending
+
+    journal = []
+    try:
+        with open(pending_journal_path, "r") as journal_file:
+            for line in journal_file:
+                try:
+                    journal.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return pending.PendingStore(readPendingConnections(open=open), journal)
+
+
+def writePendingStore(
+    store, open=open, ensureDir=ensureDir, fsync=os.fsync, compact=False, sync=True
+):
+    """
+    Takes a pifi.pending.PendingStore and saves the operations not saved yet,
+    by appending them to pending_journal_path. With sync False, the journal is
+    not synced (see pendingTransaction).
+
+    With compact (or once the journal holds pending_journal_keep operations),
+    writes all the connections to pending_path instead, and removes the journal.
+
+    Returns the size of the journal after appending, 0 if it was removed, or
+    None if there was nothing to save.
+
+    Don't use this when other processes may change the pending connections
+    at the same time, use pendingTransaction.
+    """
+    journaled = store.journaled + len(store.unsaved)
+    if journaled == 0 or (len(store.unsaved) == 0 and not compact):
+        return None
+    if compact or journaled >= pending_journal_keep:
+        writePendingConnections(store.connections(), open=open, ensureDir=ensureDir)
+        # Cut off before this, the journal is applied again, which changes nothing
+        try:
+            os.remove(pending_journal_path)
+        except FileNotFoundError:
+            pass
+        store.journaled = 0
+        store.unsaved = []
+        return 0
+
+    ensureDir(pending_journal_path)
+    with open(pending_journal_path, "a+") as journal_file:
+        journal_file.seek(0)
+        lines = journal_file.readlines()
+        if len(lines) > 0 and not lines[-1].endswith("\n"):
+            journal_file.write("\n")  # Don't join a cut off operation with these
+        journal_file.write("".join("%s\n" % json.dumps(op) for op in store.unsaved))
+        journal_file.flush()
+        if sync:
+            fsync(journal_file.fileno())
+        size = journal_file.tell()
+    store.journaled = journaled
+    store.unsaved = []
+    return size
+
+
+# Kept in pending_lock_path: the generation of the journal (one more every
+# time it is folded into pending_path), and how much of it is known to be synced
+_journal_state = struct.Struct("<QQ")
+
+
+@contextlib.contextmanager
+def _locked(fd, byte):
+    """
+    Context manager that holds an advisory lock on one byte of the file fd.
+    """
+    fcntl.lockf(fd, fcntl.LOCK_EX, 1, byte)
+    try:
+        yield
+    finally:
+        fcntl.lockf(fd, fcntl.LOCK_UN, 1, byte)
+
+
+def _readJournalState(fd):
+    data = os.pread(fd, _journal_state.size, 0)
+    if len(data) < _journal_state.size:
+        return (0, 0)
+    return _journal_state.unpack(data)
+
+
+@contextlib.contextmanager
+def pendingTransaction(open=open, ensureDir=ensureDir, fsync=os.fsync, compact=False):
+    """
+    Context manager for changing the pending connections while other processes
+    may do the same. Yields the pifi.pending.PendingStore, and saves the
+    changes made to it when the block ends (see writePendingStore), unless
+    the block raises.
+
+    A transaction holds a lock (on pending_lock_path) from reading the store
+    to appending to the journal, so that no change is lost. The journal is
+    synced after that lock is released: all the transactions that appended
+    while another one was syncing are synced together by the next one, with
+    a single fsync for the whole batch.
+    """
+    ensureDir(pending_lock_path)
+    lock_fd = os.open(pending_lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        # Byte 0 locks the pending connections, byte 1 the journal state
+        with _locked(lock_fd, 0):
+            store = readPendingStore(open=open)
+            yield store
+            journaled = store.journaled + len(store.unsaved)
+            if journaled > 0 and (compact or journaled >= pending_journal_keep):
+                # A new generation before the journal is removed, so that the
+                # transactions still to sync it know it is gone
+                with _locked(lock_fd, 1):
+                    generation, synced = _readJournalState(lock_fd)
+                    os.pwrite(lock_fd, _journal_state.pack(generation + 1, 0), 0)
+                    # Folded into pending_path, which is synced by writeFile
+                    writePendingStore(
+                        store, open=open, ensureDir=ensureDir, compact=True
+                    )
+                return
+            size = writePendingStore(store, open=open, ensureDir=ensureDir, sync=False)
+            if size is None:
+                return
+            with _locked(lock_fd, 1):
+                generation, synced = _readJournalState(lock_fd)
+
+        with _locked(lock_fd, 1):
+            current, synced = _readJournalState(lock_fd)
+            if current != generation or synced >= size:
+                # Folded into pending_path since, or synced by another transaction
+                return
+            try:
+                journal_fd = os.open(pending_journal_path, os.O_RDONLY)
+            except FileNotFoundError:
+                # Removed by a program that doesn't use transactions
+                return
+            try:
+                synced = os.fstat(journal_fd).st_size
+                fsync(journal_fd)
+            finally:
+                os.close(journal_fd)
+            os.pwrite(lock_fd, _journal_state.pack(generation, synced), 0)
+    finally:
+        os.close(lock_fd)
+
+
+def readDeviceSelection(open=open):
+    """
+    Returns the dict parsed from the json in the file devices_path.
+
+    If the file does not exist, or does not have a valid json dict then return None.
+    """
+    try:
+        with open(devices_path, "r") as devices_file:
+            try:
+                selection = json.load(devices_file)
+            except ValueError:
+                print("WARN failed to decode json in %s, ignoring" % devices_path)
+                return None
+            if not isinstance(selection, dict):
+                return None
+            return selection
+    except FileNotFoundError:
+        return None
+
+
+def writeDeviceSelection(selection, open=open, ensureDir=ensureDir):
+    """
+    Takes a dict and writes the json representation to devices_path.
+
+    If the file already exists, this replaces it (see writeFile).
+    """
+    writeFile(devices_path, json.dumps(selection), open=open, ensureDir=ensureDir)
+
+
+def readConfCache(path, key, open=open):
+    """
+    Returns the dict of settings cached in conf_cache_path for the config
+    file at path, if it was cached with the same key (see
+    etc_io.get_conf). Returns None otherwise.
+    """
+    try:
+        with open(conf_cache_path, "r") as cache_file:
+            cache = json.load(cache_file)
+    except (FileNotFoundError, ValueError):
+        return None
+    if (
+        not isinstance(cache, dict)
+        or cache.get("path") != path
+        or cache.get("key") != list(key)
+        or not isinstance(cache.get("conf"), dict)
+    ):
+        return None
+    return cache["conf"]
+
+
+def writeConfCache(path, key, conf, open=open, ensureDir=ensureDir):
+    """
+    Takes the dict of settings read from the config file at path, and the
+    key of that file, and writes them to conf_cache_path (see writeFile).
+    """
+    writeFile(
+        conf_cache_path,
+        json.dumps({"path": path, "key": list(key), "conf": conf}),
+        open=open,
+        ensureDir=ensureDir,
+    )
+
+
+def readLastNetwork(open=open):
+    """
+    Returns the dict parsed from the json in the file last_network_path.
+
+    If the file does not exist, or does not have a valid json dict then return None.
+    """
+    try:
+        with open(last_network_path, "r") as last_network_file:
+            try:
+                network = json.load(last_network_file)
+            except ValueError:
+                print("WARN failed to decode json in %s, ignoring" % last_network_path)
+                return None
+            if not isinstance(network, dict):
+                return None
+            return network
+    except FileNotFoundError:
+        return None
+
+
+def writeLastNetwork(network, open=open, ensureDir=ensureDir):
+    """
+    Takes a dict and writes the json representation to last_network_path.
+
+    If the file already exists, this replaces it (see writeFile).
+    """
+    writeFile(last_network_path, json.dumps(network), open=open, ensureDir=ensureDir)
+
+
+def readConnectionHistory(open=open):
+    """
+    Returns a dict of SSID -> (successes, failures) connecting to it, parsed
+    from the json in the file connection_history_path.
+
+    If the file does not exist, or does not have a valid json dict then
+    return an empty dict.
+    """
+    try:
+        with open(connection_history_path, "r") as history_file:
+            try:
+                history = json.load(history_file)
+            except ValueError:
+                print(
+                    "WARN failed to decode json in %s, ignoring"
+                    % connection_history_path
+                )
+                return {}
+    except FileNotFoundError:
+        return {}
+    if not isinstance(history, dict):
+        return {}
+    return {
+        ssid: tuple(counts)
+        for ssid, counts in history.items()
+        if isinstance(counts, list) and len(counts) == 2
+    }
+
+
+def recordConnectionResult(ssid, success, open=open, ensureDir=ensureDir):
+    """
+    Counts one success (or failure if success is False) connecting to ssid
+    in the file connection_history_path.
+    """
+    history = readConnectionHistory(open=open)
+    successes, failures = history.get(ssid, (0, 0))
+    if success:
+        successes += 1
+    else:
+        failures += 1
+    history[ssid] = (successes, failures)
+    writeFile(
+        connection_history_path,
+        json.dumps({ssid: list(counts) for ssid, counts in sorted(history.items())}),
+        open=open,
+        ensureDir=ensureDir,
+    )
+
+
+def readAPProfile(open=open):
     """
-    ensureDir(pending_path)
-    with open(pending_path, "w+") as pending_file:
-        pending_file.seek(0)  # rewind
-        if pending is not None:
-            json.dump(pending, pending_file)
-        else:
-            json.dump(list(), pending_file)
-        pending_file.truncate()
+    Returns the dict parsed from the json in the file ap_profile_path.
+
+    If the file does not exist, or does not have a valid json dict then return None.
+    """
+    try:
+        with open(ap_profile_path, "r") as ap_profile_file:
+            try:
+                profile = json.load(ap_profile_file)
+            except ValueError:
+                print("WARN failed to decode json in %s, ignoring" % ap_profile_path)
+                return None
+            if not isinstance(profile, dict):
+                return None
+            return profile
+    except FileNotFoundError:
+        return None
+
+
+def writeAPProfile(profile, open=open, ensureDir=ensureDir):
+    """
+    Takes a dict and writes the json representation to ap_profile_path.
+
+    If the file already exists, this replaces it (see writeFile).
+    """
+    writeFile(ap_profile_path, json.dumps(profile), open=open, ensureDir=ensureDir)
+
+
+def readBootTraces(open=open):
+    """
+    Returns the list of boot records in boot_trace_path, oldest first.
+    One line of the file is the json of one record.
+
+    If the file does not exist then return a empty list, lines that are not
+    valid json (a boot that was cut off while writing) are skipped.
+    """
+    try:
+        with open(boot_trace_path, "r") as trace_file:
+            records = []
+            for line in trace_file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+            return records
+    except FileNotFoundError:
+        return list()
+
+
+def appendBootTrace(record, open=open, ensureDir=ensureDir, keep=None):
+    """
+    Takes a dict and appends its json representation to boot_trace_path.
+
+    Only the last keep records (default boot_trace_keep) are kept.
+    """
+    if keep is None:
+        keep = boot_trace_keep
+    ensureDir(boot_trace_path)
+    with open(boot_trace_path, "a+") as trace_file:
+        trace_file.seek(0)
+        lines = trace_file.readlines()
+        if len(lines) < keep:
+            if len(lines) > 0 and not lines[-1].endswith("\n"):
+                trace_file.write("\n")  # Don't join a cut off record with this one
+            trace_file.write("%s\n" % json.dumps(record))
+            return
+
+        lines = lines[len(lines) - keep + 1 :] if keep > 1 else []
+        lines.append("%s\n" % json.dumps(record))
+        trace_file.seek(0)
+        trace_file.truncate()
+        trace_file.writelines(lines)
+
+
+def readScanHistory():
+    """
+    Returns the pifi.scan_history.ScanHistory in scan_history_path, opened
+    readonly, close it when done.
+
+    If the file does not exist, or is not a scan history then return None.
+    """
+    import pifi.scan_history as scan_history
+
+    try:
+        return scan_history.ScanHistory(scan_history_path, readonly=True)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        print("WARN %s is not a scan history, ignoring" % scan_history_path)
+        return None
+
+
+def appendScanHistory(table, ensureDir=ensureDir, size=None):
+    """
+    Takes a pifi.scan_table.ScanTable and saves it in scan_history_path,
+    overwriting the oldest scans once the file holds size records (default
+    scan_history_size).
+    """
+    import pifi.scan_history as scan_history
+
+    if size is None:
+        size = scan_history_size
+    ensureDir(scan_history_path)
+    with scan_history.ScanHistory(scan_history_path, capacity=size) as history:
+        history.append(table)
@@ -0,0 +1,122 @@
+import unittest
+from unittest import mock
+import os
+import tempfile
+import threading
+import struct
+import pifi.button as button
+
+KEY_CONFIG = 171
+EV_KEY = 1
+
+class FakeInputDevice:
+    """Input device backed by a pipe, events are queued by press()"""
+    instances = {}
+
+    def __init__(self, path):
+        with open(path) as f:
+            self.name = f.read().strip()
+        self.path = path
+        self.fd, self._write_fd = os.pipe()
+        self.events = []
+        self.grabbed = False
+        self.closed = False
+        FakeInputDevice.instances[path] = self
+
+    def press(self, code=KEY_CONFIG):
+        self.events.append(mock.MagicMock(type=EV_KEY, code=code))
+        os.write(self._write_fd, b'x')
+
+    def read(self):
+        os.read(self.fd, 1024)
+        events, self.events = self.events, []
+        return events
+
+    def grab(self):
+        self.grabbed = True
+
+    def close(self):
+        self.closed = True
+        os.close(self.fd)
+        os.close(self._write_fd)
+
+def list_devices(input_dir):
+    return [os.path.join(input_dir, name) for name in sorted(os.listdir(input_dir))]
+
+class ButtonTests(unittest.TestCase):
+
+    def setUp(self):
+        FakeInputDevice.instances = {}
+        self.input_dir = tempfile.mkdtemp()
+        self.addCleanup(self.cleanup)
+
+    def cleanup(self):
+        for name in os.listdir(self.input_dir):
+            os.remove(os.path.join(self.input_dir, name))
+        os.rmdir(self.input_dir)
+
+    def add_device(self, name, device_name):
+        path = os.path.join(self.input_dir, name)
+        with open(path, 'w') as f:
+            f.write(device_name)
+        # Like udev setting permissions after the kernel created the node
+        os.chmod(path, 0o640)
+        return path
+
+    def make_watcher(self, close=True):
+        watcher = button.ButtonWatcher('Pifi Button', key=KEY_CONFIG,
+                                       input_dir=self.input_dir,
+                                       InputDevice=FakeInputDevice,
+                                       list_devices=list_devices)
+        if close:
+            self.addCleanup(watcher.close)
+        return watcher
+
+    def test_parse_inotify_events(self):
+        buf = (struct.pack('iIII', 1, button.IN_CREATE, 0, 8) + b'event3\0\0' +
+               struct.pack('iIII', 1, button.IN_ATTRIB, 0, 0))
+        self.assertEqual(button.parse_inotify_events(buf),
+                         [(button.IN_CREATE, 'event3'), (button.IN_ATTRIB, '')])
+
+    def test_only_matching_devices_kept(self):
+        keyboard = self.add_device('event0', 'Keyboard')
+        pifi_button = self.add_device('event1', 'Pifi Button')
+
+        watcher = self.make_watcher()
+        self.assertEqual(list(watcher.devices), [pifi_button])
+        self.assertTrue(FakeInputDevice.instances[keyboard].closed)
+        self.assertTrue(FakeInputDevice.instances[pifi_button].grabbed)
+
+        FakeInputDevice.instances[pifi_button].press(code=1)
+        FakeInputDevice.instances[pifi_button].press()
+        watcher.wait()
+
+    def test_hotplugged_button(self):
+        watcher = self.make_watcher()
+        self.assertEqual(watcher.devices, {})
+
+        def plug_in_and_press():
+            path = self.add_device('event4', 'Pifi Button')
+            self.add_device('mouse0', 'Pifi Button')
+            while path not in watcher.devices:
+                threading.Event().wait(0.01)
+            watcher.devices[path].press()
+
+        thread = threading.Thread(target=plug_in_and_press)
+        thread.start()
+        watcher.wait()
+        thread.join()
+        self.assertEqual(list(watcher.devices), [os.path.join(self.input_dir, 'event4')])
+
+    def test_close(self):
+        pifi_button = self.add_device('event1', 'Pifi Button')
+        watcher = self.make_watcher(close=False)
+        watcher.close()
+        self.assertTrue(FakeInputDevice.instances[pifi_button].closed)
+        self.assertEqual(watcher.devices, {})
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
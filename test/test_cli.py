@@ -2,20 +2,42 @@ import unittest
 from unittest import mock
 from io import StringIO
 import os, sys
+import subprocess
+import json
 
 sys.modules['NetworkManager'] = mock.MagicMock()
 import pifi.pifi as pifi
+from pifi.pending import PendingStore
+
+# Longest a cold `pifi --version` may spend importing and dispatching (seconds)
+cold_start_budget = 0.5
+
+# Only the commands that need these may import them
+slow_modules = ['NetworkManager', 'dbus', 'em', 'yaml', 'evdev', 'pifi.startup',
+                'pifi.nm_helper', 'pifi.etc_io']
+
+cold_start_script = """
+import sys, time, json
+start = time.monotonic()
+import pifi.pifi
+try:
+    pifi.pifi.main(['--version'])
+except SystemExit:
+    pass
+print(json.dumps({'elapsed' : time.monotonic() - start,
+                  'modules' : [m for m in %r if m in sys.modules]}))
+"""
 
 class pifiCommandlineTests(unittest.TestCase):
 
     def test_add_one_insecure_connection_empty_list(self):
-        var = mock.MagicMock()
-        var.configure_mock(**{'readPendingConnections.return_value': list()})
+        store = PendingStore()
+        var = mock.MagicMock(**{'pendingTransaction.return_value.__enter__.return_value': store})
 
         pifi.add(['Foo'], var_io=var)
 
-        var.readPendingConnections.assert_called_once_with()
-        written_connection = var.writePendingConnections.call_args[0][0][0]
+        var.pendingTransaction.assert_called_once_with()
+        written_connection = store.connections()[0]
         del written_connection['connection']['uuid']
 
         expected_connection = {
@@ -37,13 +59,13 @@ class pifiCommandlineTests(unittest.TestCase):
         self.assertEqual(written_connection, expected_connection)
 
     def test_add_one_secure_connection_empty_list(self):
-        var = mock.MagicMock()
-        var.configure_mock(**{'readPendingConnections.return_value': list()})
+        store = PendingStore()
+        var = mock.MagicMock(**{'pendingTransaction.return_value.__enter__.return_value': store})
 
         pifi.add(['Foo', 'bar'], var_io=var)
 
-        var.readPendingConnections.assert_called_once_with()
-        written_connection = var.writePendingConnections.call_args[0][0][0]
+        var.pendingTransaction.assert_called_once_with()
+        written_connection = store.connections()[0]
         del written_connection['connection']['uuid']
 
         expected_connection = {
@@ -72,20 +94,20 @@ class pifiCommandlineTests(unittest.TestCase):
 
     def test_add_one_secure_connection_permission_denied(self):
         var = mock.MagicMock()
-        var.configure_mock(**{'writePendingConnections.side_effect': PermissionError})
+        var.configure_mock(**{'pendingTransaction.side_effect': PermissionError})
 
         pifi.add(['Foo', 'bar'], var_io=var) # Only checking for no exceptions
 
     def test_add_one_secure_connection_existing_list(self):
         existing_connection = {'Baz' : 'qux'}
 
-        var = mock.MagicMock()
-        var.configure_mock(**{'readPendingConnections.return_value': [existing_connection]})
+        store = PendingStore([existing_connection])
+        var = mock.MagicMock(**{'pendingTransaction.return_value.__enter__.return_value': store})
 
         pifi.add(['Foo', 'bar'], var_io=var)
 
-        var.readPendingConnections.assert_called_once_with()
-        written_connections = var.writePendingConnections.call_args[0][0]
+        var.pendingTransaction.assert_called_once_with()
+        written_connections = store.connections()
         del written_connections[1]['connection']['uuid']
 
         expected_connection = {
@@ -112,6 +134,109 @@ class pifiCommandlineTests(unittest.TestCase):
         
         self.assertEqual(written_connections, [existing_connection, expected_connection])
 
+    def test_add_existing_ssid_replaces(self):
+        old = {'connection' : {'id' : 'Foo', 'uuid' : 'uuid-old'},
+               '802-11-wireless' : {'ssid' : 'Foo'}}
+        other = {'connection' : {'id' : 'Bar', 'uuid' : 'uuid-bar'},
+                 '802-11-wireless' : {'ssid' : 'Bar'}}
+        store = PendingStore([old, other])
+        var = mock.MagicMock(**{'pendingTransaction.return_value.__enter__.return_value': store})
+
+        with mock.patch('sys.stdout', new_callable=StringIO) as output:
+            pifi.add(['--priority', '5', 'Foo', 'newpass'], var_io=var)
+
+        self.assertIn('Updated connection Foo', output.getvalue())
+        written = store.connections()
+        self.assertEqual([con['connection']['id'] for con in written], ['Foo', 'Bar'])
+        self.assertEqual(written[0]['802-11-wireless-security']['psk'], 'newpass')
+        self.assertEqual(written[0]['connection']['autoconnect-priority'], 5)
+
+    def test_import(self):
+        same = {'connection' : {'id' : 'Same', 'uuid' : 'uuid-same'},
+                '802-11-wireless' : {'ssid' : 'Same'},
+                '802-11-wireless-security' : {'psk' : 'secret'}}
+        old = {'connection' : {'id' : 'Old', 'uuid' : 'uuid-old'},
+               '802-11-wireless' : {'ssid' : 'Old'}}
+        store = PendingStore([same, old])
+        var = mock.MagicMock(**{'pendingTransaction.return_value.__enter__.return_value': store})
+        saved = mock.MagicMock()
+        saved.by_ssid.side_effect = lambda ssid, ap: [('con', {})] if ssid == 'Saved' else []
+        nm = mock.MagicMock(**{'saved_connections.return_value' : saved})
+        stdin = StringIO('ssid,password,priority\n'
+                         'New,pass,\nOld,newpass,2\nSame,secret,\nSaved,x,\nNew,pass2,1\n')
+
+        with mock.patch('sys.stdout', new_callable=StringIO) as output:
+            pifi.import_command(['--format', 'csv'], var_io=var, nm=nm, stdin=stdin)
+
+        var.pendingTransaction.assert_called_once_with()
+        self.assertIn('Added 1, updated 1 and kept 1', output.getvalue())
+        self.assertIn('Skipped 1 networks already saved in NetworkManager', output.getvalue())
+        self.assertEqual([con['connection']['id'] for con in store.connections()],
+                         ['Old', 'New', 'Same'])
+        self.assertEqual(store.by_ssid('New')['802-11-wireless-security']['psk'], 'pass2')
+        self.assertIs(store.by_ssid('Same'), same)
+        self.assertEqual(len(store.unsaved), 2)
+
+        # Nothing is changed when the file can't be read
+        var.reset_mock()
+        stdin = StringIO('[{"ssid": "Foo"}, {"password": "bar"}]')
+        with mock.patch('sys.stdout', new_callable=StringIO) as output:
+            pifi.import_command(['--force'], var_io=var, nm=nm, stdin=stdin)
+        self.assertIn('Error reading -', output.getvalue())
+        var.pendingTransaction.assert_not_called()
+
+    def test_export(self):
+        store = PendingStore([{'connection' : {'id' : 'Foo', 'uuid' : 'uuid-foo'},
+                               '802-11-wireless' : {'ssid' : 'Foo'},
+                               '802-11-wireless-security' : {'psk' : 'bar'}}])
+        var = mock.MagicMock(**{'readPendingStore.return_value' : store})
+        saved_con = mock.MagicMock(**{'GetSecrets.return_value' :
+                                      {'802-11-wireless-security' : {'psk' : 'qux'}}})
+        saved = mock.MagicMock(**{'wireless.return_value' : [
+            (saved_con, {'802-11-wireless' : {'ssid' : [b'B', b'a', b'z']},
+                         '802-11-wireless-security' : {'key-mgmt' : 'wpa-psk'}}),
+            (mock.MagicMock(), {'802-11-wireless' : {'ssid' : [b'F', b'o', b'o']}})]})
+        nm = mock.MagicMock(**{'saved_connections.return_value' : saved})
+
+        stdout = StringIO()
+        pifi.export_command([], var_io=var, nm=nm, stdout=stdout)
+        self.assertEqual(json.loads(stdout.getvalue()), [{'ssid' : 'Foo', 'password' : 'bar'}])
+
+        stdout = StringIO()
+        pifi.export_command(['--saved', '--format', 'csv'], var_io=var, nm=nm, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'ssid,password,priority\nFoo,bar,\nBaz,qux,\n')
+        saved_con.GetSecrets.assert_called_once_with('802-11-wireless-security')
+
+        # Not root, the networks are written without their passwords
+        import pifi.nm_events as nm_events
+        saved_con.GetSecrets.side_effect = nm_events.DBusException('Not authorized')
+        stdout = StringIO()
+        pifi.export_command(['--saved', '--format', 'csv'], var_io=var, nm=nm, stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'ssid,password,priority\nFoo,bar,\nBaz,,\n')
+
+    def test_remove_several(self):
+        store = PendingStore([{'connection' : {'id' : ssid, 'uuid' : 'uuid-%s' % ssid},
+                               '802-11-wireless' : {'ssid' : ssid}}
+                              for ssid in ['Foo', 'Site-1', 'Site-2', 'Other']])
+        var = mock.MagicMock(**{'pendingTransaction.return_value.__enter__.return_value': store})
+        foo, site, other = mock.MagicMock(), mock.MagicMock(), mock.MagicMock()
+        saved = mock.MagicMock(**{'wireless.return_value' : [
+            (foo, {'802-11-wireless' : {'ssid' : [b'F', b'o', b'o']}}),
+            (site, {'802-11-wireless' : {'ssid' : [b'S', b'i', b't', b'e', b'-', b'3']}}),
+            (other, {'802-11-wireless' : {'ssid' : [b'O', b't', b'h', b'e', b'r']}})]})
+        nm = mock.MagicMock(**{'saved_connections.return_value' : saved,
+                               'managedWifiDevices.return_value' : []})
+
+        with mock.patch('sys.stdout', new_callable=StringIO):
+            pifi.remove(['-y', 'Foo', '--pattern', 'Site-*'], var_io=var, nm=nm)
+
+        self.assertEqual([con['connection']['id'] for con in store.connections()], ['Other'])
+        saved.wireless.assert_called_once_with(ap=False)
+        foo.Delete.assert_called_once_with()
+        site.Delete.assert_called_once_with()
+        other.Delete.assert_not_called()
+        self.assertEqual(saved.forget.call_args_list, [mock.call(foo), mock.call(site)])
+
     def test_status_no_devices_exit(self):
         managedAPCapableDevices = mock.MagicMock(side_effect=StopIteration)
         nm_mock = mock.MagicMock(**{'managedAPCapableDevices()' : managedAPCapableDevices})
@@ -187,6 +312,114 @@ class pifiCommandlineTests(unittest.TestCase):
         tmp_pifi.main(argv=['add', 'bar'])
         self.assertIn(mock.call(['bar']), a.mock_calls)
 
+    def test_boot_trace(self):
+        var = mock.MagicMock()
+        var.readBootTraces.return_value = [
+            {'started_at' : 0, 'decision' : 'ap_mode', 'total' : 40.0,
+             'spans' : [{'name' : 'scan', 'start' : 1.0, 'duration' : 30.0}]},
+            {'started_at' : 60, 'decision' : 'connected', 'total' : 4.0,
+             'spans' : [{'name' : 'scan', 'start' : 1.0, 'duration' : 2.5}]}]
+
+        with mock.patch('sys.stdout', new_callable=StringIO) as output:
+            pifi.boot_trace(['-n', '1'], var_io=var)
+        lines = output.getvalue().splitlines()
+        self.assertIn('connected', lines[0])
+        self.assertIn('scan 2.50s', lines[0])
+        self.assertNotIn('ap_mode', output.getvalue())
+        self.assertTrue(lines[-1].startswith('total'))
+
+        var.readBootTraces.return_value = []
+        with mock.patch('sys.stdout', new_callable=StringIO) as output:
+            pifi.boot_trace([], var_io=var)
+        self.assertIn('No boots', output.getvalue())
+
+    def test_list_seen(self):
+        table = {'hidden' : 1, 'entries' : [
+            {'ssid' : 'Foo', 'bssids' : ['aa', 'bb'], 'max_strength' : 80, 'mean_strength' : 60,
+             'frequencies' : [2412, 5180], 'secured' : True, 'last_seen' : 9},
+            {'ssid' : 'Bar', 'bssids' : ['cc'], 'max_strength' : None, 'mean_strength' : None,
+             'frequencies' : [], 'secured' : None, 'last_seen' : None}]}
+        with mock.patch.object(pifi, 'var_io') as var:
+            var.readScanTable.return_value = table
+            var.readScanHistory.return_value = None
+            with mock.patch('sys.stdout', new_callable=StringIO) as output:
+                pifi.list_command(['seen'])
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[1].split(), ['Foo', '2', '80', '2.4GHz,5GHz', 'secured'])
+        self.assertEqual(lines[2].split(), ['Bar', '1', '-', '-', '-'])
+        self.assertIn('1 access points of hidden networks', lines[3])
+
+        # Saved without strengths, they come from the last scan in the history
+        import tempfile, shutil
+        import pifi.scan_history as scan_history
+        import pifi.scan_table as scan_table
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'scan_history')
+        scanned = scan_table.ScanTable()
+        scanned.add('Foo', 'aa', strength=30)
+        scanned.add('Bar', 'cc', strength=70)
+        with scan_history.ScanHistory(path) as history:
+            history.append(scanned)
+        with mock.patch.object(pifi, 'var_io') as var:
+            var.readScanTable.return_value = scanned.to_json(volatile=False)
+            var.readScanHistory.side_effect = lambda: scan_history.ScanHistory(path, readonly=True)
+            with mock.patch('sys.stdout', new_callable=StringIO) as output:
+                pifi.list_command(['seen'])
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[1].split()[:3], ['Bar', '1', '70'])
+        self.assertEqual(lines[2].split()[:3], ['Foo', '1', '30'])
+
+        with mock.patch.object(pifi, 'var_io') as var:
+            var.readScanTable.return_value = None
+            var.readSeenSSIDs.return_value = ['Foo', 'Bar']
+            with mock.patch('sys.stdout', new_callable=StringIO) as output:
+                pifi.list_command(['seen'])
+        self.assertEqual(output.getvalue(), 'Foo\nBar\n')
+
+    def test_scan_history(self):
+        import tempfile, shutil
+        import pifi.scan_history as scan_history
+        import pifi.scan_table as scan_table
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'scan_history')
+        with scan_history.ScanHistory(path) as history:
+            for strength in [40, 60, None]:
+                table = scan_table.ScanTable()
+                table.add('Foo', 'aa', strength=strength)
+                if strength is None:
+                    table.add('Bar', 'bb', strength=30)
+                history.append(table)
+
+        var = mock.MagicMock(scan_history_path=path)
+        var.readScanHistory.side_effect = lambda: scan_history.ScanHistory(path, readonly=True)
+        with mock.patch('sys.stdout', new_callable=StringIO) as output:
+            pifi.scan_history([], var_io=var)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], 'Seen in the last 3 boots')
+        self.assertEqual(lines[2].split()[:5], ['Foo', '3', '100%', '50', '40-60'])
+        self.assertEqual(lines[3].split()[:5], ['Bar', '1', '33%', '30', '30-30'])
+
+        with mock.patch('sys.stdout', new_callable=StringIO) as output:
+            pifi.scan_history(['-n', '1', 'Foo'], var_io=var)
+        self.assertEqual(output.getvalue().splitlines()[2].split()[:5], ['Foo', '1', '100%', '-', '-'])
+
+        var.readScanHistory.side_effect = None
+        var.readScanHistory.return_value = None
+        with mock.patch('sys.stdout', new_callable=StringIO) as output:
+            pifi.scan_history([], var_io=var)
+        self.assertIn('No scans', output.getvalue())
+
+    def test_version_cold_start(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output(
+            [sys.executable, '-c', cold_start_script % slow_modules], cwd=root)
+        result = json.loads(output.decode('utf-8').splitlines()[-1])
+
+        self.assertEqual(result['modules'], [])
+        self.assertLess(result['elapsed'], cold_start_budget)
+
 
 def main():
     unittest.main()
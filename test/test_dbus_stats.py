@@ -0,0 +1,94 @@
+import unittest
+from unittest import mock
+import pifi.dbus_stats as dbus_stats
+
+class FakeProxyMethod:
+    """Stands in for dbus.proxies._ProxyMethod"""
+    def __init__(self, name, interface=None):
+        self._method_name = name
+        self._dbus_interface = interface
+
+    def __call__(self, *args, **keywords):
+        return (self._method_name, args)
+
+class DBusStatsTests(unittest.TestCase):
+
+    def test_enabled(self):
+        self.assertFalse(dbus_stats.enabled({}))
+        self.assertFalse(dbus_stats.enabled({'PIFI_DBUS_STATS' : '0'}))
+        self.assertTrue(dbus_stats.enabled({'PIFI_DBUS_STATS' : '1'}))
+
+    def test_wrap_counts(self):
+        ap = mock.MagicMock(**{'Ssid' : 'Foo', 'Strength' : 50})
+        device = mock.MagicMock(**{'State' : 100, 'GetAccessPoints.return_value' : [ap]})
+        device.SpecificDevice.return_value = device
+        nm = mock.MagicMock(**{'NetworkManager.GetDevices.return_value' : [device],
+                               'NM_DEVICE_STATE_ACTIVATED' : 100})
+
+        stats = dbus_stats.Stats()
+        wrapped = stats.wrap(nm)
+        devices = wrapped.NetworkManager.GetDevices()
+        self.assertEqual(devices, [device])
+        self.assertEqual(devices[0].State, wrapped.NM_DEVICE_STATE_ACTIVATED)
+        for ap in devices[0].SpecificDevice().GetAccessPoints():
+            self.assertEqual(ap.Ssid, 'Foo')
+
+        self.assertEqual(stats.count('call'), 2)
+        self.assertEqual(stats.count('call', 'GetDevices'), 1)
+        self.assertEqual(stats.count('property'), 2)
+        self.assertIn('2 calls, 2 property reads', stats.report())
+
+    def test_wrap_identity(self):
+        connection = mock.MagicMock()
+        nm = mock.MagicMock(**{'Settings.ListConnections.return_value' : [connection]})
+        stats = dbus_stats.Stats()
+        wrapped = stats.wrap(nm)
+
+        first = wrapped.Settings.ListConnections()[0]
+        self.assertIs(first, wrapped.Settings.ListConnections()[0])
+        self.assertEqual(first, connection)
+        self.assertEqual(len(set([first, connection])), 1)
+
+        # Wrapped objects are unwrapped when passed back in
+        wrapped.NetworkManager.ActivateConnection(first, None, '/')
+        nm.NetworkManager.ActivateConnection.assert_called_once_with(connection, None, '/')
+
+    def test_phases(self):
+        phase = {'name' : 'scan'}
+        stats = dbus_stats.Stats(phase=lambda: phase['name'])
+        stats.record('call', 'RequestScan', 0.002)
+        phase['name'] = None
+        stats.record('call', 'RequestScan', 0.0005)
+
+        self.assertEqual(stats.count(phase='scan'), 1)
+        self.assertEqual(stats.count(phase='main'), 1)
+        summary = stats.summary()
+        self.assertEqual(summary[0]['buckets'], {'2' : 1})
+        self.assertEqual(summary[1]['buckets'], {'1' : 1})
+
+    def test_install(self):
+        proxies = mock.MagicMock(_ProxyMethod=FakeProxyMethod)
+        dbus = mock.MagicMock(proxies=proxies)
+        original = FakeProxyMethod.__call__
+        stats = dbus_stats.Stats()
+
+        uninstall = stats.install(dbus=dbus)
+        try:
+            get = FakeProxyMethod('Get')
+            self.assertEqual(get('org.freedesktop.NetworkManager.Device', 'State',
+                                 dbus_interface=dbus_stats.PROPERTIES_INTERFACE),
+                             ('Get', ('org.freedesktop.NetworkManager.Device', 'State')))
+            FakeProxyMethod('GetDevices', 'org.freedesktop.NetworkManager')()
+        finally:
+            uninstall()
+        FakeProxyMethod('GetDevices')()
+
+        self.assertIs(FakeProxyMethod.__call__, original)
+        self.assertEqual(stats.count('property', 'Get(State)'), 1)
+        self.assertEqual(stats.count('call', 'GetDevices'), 1)
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,10 @@
 import unittest
 from unittest import mock
 import pifi.etc_io as etc_io
-import os
+import pifi.var_io as var_io
+from pifi.config import Config
+import os, io, signal
+import shutil, tempfile
 import json, yaml
 
 class EtcIOTests(unittest.TestCase):
@@ -115,41 +118,118 @@ class EtcIOTests(unittest.TestCase):
         self.assertIsInstance(conf, dict)   
     
 
+    def test_ap_conf_digest(self):
+        f = mock.mock_open(read_data='{"Foo" : "@(mac)", "connection" : {"autoconnect" : false, "uuid" : "@(uuid_str)"}}')
+        first = etc_io.get_default_ap_conf('AF:BF:CF:0F:1F:2F', open=f)
+        second = etc_io.get_default_ap_conf('AF:BF:CF:0F:1F:2F', open=f)
+        self.assertNotEqual(first['connection']['uuid'], second['connection']['uuid'])
+        self.assertEqual(etc_io.ap_conf_digest(first), etc_io.ap_conf_digest(second))
+        self.assertIn('uuid', first['connection'])
+
+        other = etc_io.get_default_ap_conf('AF:BF:CF:0F:1F:30', open=f)
+        self.assertNotEqual(etc_io.ap_conf_digest(first), etc_io.ap_conf_digest(other))
+
+    def get_conf(self, f):
+        # As if the file could not be checked for changes, so it is always read
+        return etc_io.get_conf(open=f, stat=mock.Mock(side_effect=FileNotFoundError('foo')))
+
     def test_nonexistant_conf(self):
         f = mock.Mock(side_effect=FileNotFoundError('foo'))
-        conf = etc_io.get_conf(open=f)
-        self.assertIsInstance(conf, dict)
+        conf = self.get_conf(f)
+        self.assertIsInstance(conf, Config)
+        self.assertEqual(conf, etc_io.default_conf)
 
     def test_good_conf(self):
-        f = mock.mock_open(read_data=yaml.dump({'delete_existing_ap_connections' : True}))
-        conf = etc_io.get_conf(open=f)
-        self.assertIsInstance(conf, dict)
-        expected = etc_io.default_conf
-        expected.update({'delete_existing_ap_connections' : True})
+        f = mock.mock_open(read_data=yaml.dump({'delete_existing_ap_connections' : False,
+                                                'scan_timeout' : 10}))
+        conf = self.get_conf(f)
+        self.assertIsInstance(conf, Config)
+        expected = dict(etc_io.default_conf)
+        expected.update({'delete_existing_ap_connections' : False, 'scan_timeout' : 10})
         self.assertEqual(conf, expected)
+        self.assertEqual(conf.scan_timeout, 10)
 
     def test_incomplete_conf(self):
         f = mock.mock_open(read_data=yaml.dump({'Foo' : 'Bar'}))
-        conf = etc_io.get_conf(open=f)
-        self.assertIsInstance(conf, dict)
-        expected = etc_io.default_conf
+        conf = self.get_conf(f)
+        self.assertIsInstance(conf, Config)
+        expected = dict(etc_io.default_conf)
         expected.update({'Foo': 'Bar'})
         self.assertEqual(conf, expected)
 
     def test_empty_conf(self):
         f = mock.mock_open(read_data='')
-        conf = etc_io.get_conf(open=f)
+        conf = self.get_conf(f)
         self.assertIsNot(conf, None)
-        self.assertIsInstance(conf, dict)
+        self.assertIsInstance(conf, Config)
         self.assertEqual(conf, etc_io.default_conf)
 
     def test_bad_conf(self):
         f = mock.mock_open(read_data=': fd')
-        conf = etc_io.get_conf(open=f)
+        conf = self.get_conf(f)
         self.assertIsNot(conf, None)
-        self.assertIsInstance(conf, dict)
+        self.assertIsInstance(conf, Config)
         self.assertEqual(conf, etc_io.default_conf)
 
+    def test_invalid_settings(self):
+        f = mock.mock_open(read_data='scan_timeout: soon\nconnect_timeout: 5\n'
+                                     'delete_existing_ap_connections: "false"\nstatus_led: None\n')
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as output:
+            conf = self.get_conf(f)
+        self.assertIn('scan_timeout', output.getvalue())
+        self.assertEqual((conf['scan_timeout'], conf['connect_timeout']), (30, 5))
+        self.assertIs(conf['delete_existing_ap_connections'], False)
+        self.assertIsNone(conf['status_led'])
+
+    def test_conf_is_immutable(self):
+        conf = etc_io.default_conf
+        with self.assertRaises(AttributeError):
+            conf.scan_timeout = 5
+        with self.assertRaises(TypeError):
+            conf['scan_timeout'] = 5
+        with self.assertRaises(TypeError):
+            Config({'Foo' : 'Bar'})._extra['Foo'] = 'Baz'
+        self.assertEqual(conf['scan_timeout'], 30)
+
+    def test_conf_cached(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        conf_path = os.path.join(directory, 'pifi.conf')
+        with open(conf_path, 'w') as f:
+            f.write('scan_timeout: 10\n')
+        self.addCleanup(setattr, etc_io, '_conf_cache', None)
+
+        with mock.patch.object(etc_io, 'conf_path', conf_path), \
+             mock.patch.object(var_io, 'conf_cache_path', os.path.join(directory, 'conf_cache')):
+            etc_io._conf_cache = None
+            first = etc_io.get_conf()
+            self.assertEqual(first['scan_timeout'], 10)
+            self.assertIs(etc_io.get_conf(), first)
+
+            # Another process finds it in conf_cache_path, and does not parse the file
+            etc_io._conf_cache = None
+            f = mock.Mock(side_effect=AssertionError('parsed again'))
+            self.assertEqual(etc_io.get_conf(open=f), first)
+
+            # Changed, read again
+            with open(conf_path, 'w') as f:
+                f.write('scan_timeout: 200\n')
+            self.assertEqual(etc_io.get_conf()['scan_timeout'], 200)
+
+            # Reloaded by SIGHUP
+            with open(conf_path, 'w') as f:
+                f.write('scan_timeout: 5\n')
+            live = etc_io.LiveConf()
+            self.assertEqual(live['scan_timeout'], 5)
+            with open(conf_path, 'w') as f:
+                f.write('scan_timeout: 7000\n')
+            previous = signal.getsignal(signal.SIGHUP)
+            self.addCleanup(signal.signal, signal.SIGHUP, previous)
+            live.watch()
+            with mock.patch('sys.stdout', new_callable=io.StringIO):
+                os.kill(os.getpid(), signal.SIGHUP)
+            self.assertEqual(live['scan_timeout'], 7000)
+
     def test_setcountry(self):
         input_data = """# Set REGDOMAIN to a ISO/IEC 3166-1 alpha2 country code so that iw(8) may set
 # the initial regulatory domain setting for IEEE 802.11 devices which operate
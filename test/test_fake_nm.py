@@ -0,0 +1,156 @@
+import unittest
+from unittest import mock
+import sys
+
+sys.modules['NetworkManager'] = mock.MagicMock()
+import pifi.fake_nm as fake_nm
+import pifi.nm_helper as nm
+import pifi.startup as startup
+from pifi.pending import PendingStore
+
+def wifi_connection(ssid, psk=None, uuid=None):
+    con = {'connection' : {'id' : ssid, 'type' : '802-11-wireless', 'uuid' : uuid or 'uuid-' + ssid},
+           '802-11-wireless' : {'ssid' : ssid, 'mode' : 'infrastructure'}}
+    if psk is not None:
+        con['802-11-wireless-security'] = {'key-mgmt' : 'wpa-psk', 'psk' : psk}
+    return con
+
+class FakeNetworkManagerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0.0]
+        self.world = fake_nm.World(scan_time=2, activation_time=1,
+                                   clock=lambda: self.now[0], sleep=self.sleep)
+        self.wlan0 = self.world.add_device('wlan0')
+        self.wlan1 = self.world.add_device('wlan1', ap_capable=False)
+        self.world.add_access_point(self.wlan1, 'Home', psk='secret', strength=40, found_at=0.5)
+        self.world.add_access_point(self.wlan1, 'Cafe', strength=90, found_at=1.5)
+
+        fake_nm.install(self.world)
+        self.addCleanup(fake_nm.uninstall)
+
+    def sleep(self, seconds):
+        self.now[0] += seconds
+
+    def test_installed(self):
+        import NetworkManager
+        self.assertIs(NetworkManager.world, self.world)
+        self.assertIs(nm.NetworkManager, NetworkManager)
+        self.assertIs(startup.NetworkManager, NetworkManager)
+
+    def test_select_devices(self):
+        conf = {'ap_device' : 'any', 'client_device' : 'any'}
+        self.assertEqual(nm.select_devices(conf), (self.wlan0, self.wlan1))
+
+    def test_scan(self):
+        self.assertEqual(self.wlan1.GetAccessPoints(), [])
+        self.now[0] = 1
+        self.assertEqual([ap.Ssid for ap in self.wlan1.GetAccessPoints()], ['Home'])
+
+        self.assertTrue(nm.wait_for_scan(self.wlan1, timeout=10))
+        self.assertEqual(self.now[0], 2)
+        self.assertEqual(sorted(nm.seenSSIDs([self.wlan1])), ['Cafe', 'Home'])
+
+    def test_connect_to_pending(self):
+        self.now[0] = 2
+        pending = [wifi_connection('Cafe', psk='wrong'),
+                   wifi_connection('Home', psk='wrong'),
+                   wifi_connection('Home', psk='secret')]
+        with mock.patch.object(startup, 'var_io'):
+            connected = startup.connect_to_pending({'connect_timeout' : 5}, self.wlan1, pending)
+
+        self.assertIs(connected, pending[2])
+        self.assertEqual(self.wlan1.State, fake_nm.NM_DEVICE_STATE_ACTIVATED)
+        self.assertEqual(nm.active_network(self.wlan1)['ssid'], 'Home')
+        # The pending connections that failed are deleted again
+        self.assertEqual([con.settings for con in self.world.connections.values()],
+                         [pending[2]])
+
+    def test_last_network_during_scan(self):
+        self.world.activation_time = 10
+        home = self.world.add_connection(wifi_connection('Home', psk='secret'))
+        gone = self.world.add_connection(wifi_connection('Gone', psk='secret'))
+        conf = {'connect_timeout' : 30}
+        var_io = mock.MagicMock()
+
+        # Not around, given up on when the scan is done, not at connect_timeout
+        var_io.readLastNetwork.return_value = {'ssid' : 'Gone', 'bssid' : None, 'frequency' : None,
+                                               'uuid' : gone.settings['connection']['uuid']}
+        with mock.patch.object(startup, 'var_io', var_io):
+            self.assertFalse(startup.connect_to_last_network(conf, self.wlan1))
+        self.assertEqual(self.now[0], 2)
+        var_io.recordConnectionResult.assert_not_called()
+
+        # Seen in the scan, waited on until it is activated
+        var_io.readLastNetwork.return_value = {'ssid' : 'Home', 'bssid' : None, 'frequency' : None,
+                                               'uuid' : home.settings['connection']['uuid']}
+        with mock.patch.object(startup, 'var_io', var_io):
+            self.assertTrue(startup.connect_to_last_network(conf, self.wlan1))
+        self.assertEqual(self.now[0], 12)
+        var_io.recordConnectionResult.assert_called_once_with('Home', True)
+
+    def test_vanished_access_point(self):
+        self.now[0] = 2
+        home = self.wlan1.GetAccessPoints()[0]
+        self.world.remove_access_point(self.wlan1, home)
+        with self.assertRaises(fake_nm.ObjectVanished):
+            home.Strength
+        # The proxy is below python-networkmanager, it raises the D-Bus error
+        with self.assertRaises(fake_nm.DBusException) as raised:
+            home.proxy.GetAll(home.interface_names[0],
+                              dbus_interface=fake_nm.PROPERTIES_INTERFACE)
+        self.assertEqual(raised.exception.get_dbus_name(), 'org.freedesktop.DBus.Error.UnknownMethod')
+
+    def test_saved_connections_follow_changes(self):
+        home = self.world.add_connection(wifi_connection('Home', psk='secret'))
+        self.assertEqual(list(nm.existingConnections()), [home])
+        home.Delete()
+        self.assertRaises(fake_nm.ObjectVanished, home.GetSettings)
+
+    def test_signals(self):
+        states = []
+        self.world.bus.add_signal_receiver(
+            lambda state, reason: states.append(state), signal_name='StateChanged',
+            dbus_interface=fake_nm.ACTIVE_CONNECTION_INTERFACE)
+        self.now[0] = 2
+        con = self.world.add_connection(wifi_connection('Cafe'))
+        active = self.world.NetworkManager.ActivateConnection(con, self.wlan1, '/')
+
+        self.assertTrue(nm.wait_for_activation(active, timeout=5))
+        self.assertEqual(states, [fake_nm.NM_ACTIVE_CONNECTION_STATE_ACTIVATED])
+
+    def test_main_ap_mode(self):
+        self.now[0] = 2
+        var_io = mock.MagicMock(**{'readDeviceSelection.return_value' : None,
+                                   'readLastNetwork.return_value' : None,
+                                   'readAPProfile.return_value' : None,
+                                   'readPendingStore.return_value' : PendingStore()})
+        conf = dict(startup.etc_io.default_conf)
+        with mock.patch.object(startup, 'var_io', var_io), \
+             mock.patch.object(startup, 'wait_for_boot'), \
+             mock.patch.object(startup.etc_io, 'get_conf', return_value=conf), \
+             mock.patch.object(startup.etc_io, 'default_ap_path', '/nonexistent/default_ap.em'):
+            startup.main()
+
+        self.assertEqual(self.wlan0.ActiveConnection.Connection.settings['802-11-wireless']['mode'], 'ap')
+        self.assertEqual(var_io.appendBootTrace.call_args[0][0]['decision'], 'ap_mode')
+        self.assertGreater(self.world.calls['AddAndActivateConnection'], 0)
+
+    def test_export_saved_passwords(self):
+        import json
+        from io import StringIO
+        import pifi.pifi as pifi
+        self.world.add_connection(wifi_connection('Home', psk='secret'))
+        self.world.add_connection(wifi_connection('Cafe'))
+        var_io = mock.MagicMock(**{'readPendingStore.return_value' : PendingStore()})
+
+        stdout = StringIO()
+        pifi.export_command(['--saved'], var_io=var_io, stdout=stdout)
+        self.assertEqual(json.loads(stdout.getvalue()),
+                         [{'ssid' : 'Home', 'password' : 'secret'}, {'ssid' : 'Cafe'}])
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
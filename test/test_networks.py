@@ -0,0 +1,88 @@
+import unittest
+import json
+from io import StringIO
+
+import pifi.networks as networks
+import pifi.pending as pending
+
+class NetworksTests(unittest.TestCase):
+
+    def read(self, text, format):
+        return [networks.from_connection(con)
+                for con in networks.read_networks(StringIO(text), format)]
+
+    def test_read_json(self):
+        expected = [{'ssid' : 'Foo', 'password' : 'bar', 'priority' : 5}, {'ssid' : 'Baz'}]
+        self.assertEqual(self.read('[{"ssid": "Foo", "password": "bar", "priority": 5},\n'
+                                   ' {"ssid": "Baz"}]', 'json'), expected)
+        self.assertEqual(self.read('{"ssid": "Foo", "password": "bar", "priority": "5"}\n'
+                                   '{"ssid": "Baz"}\n', 'json'), expected)
+        self.assertEqual(self.read('[]', 'json'), [])
+        with self.assertRaises(ValueError):
+            self.read('[{"ssid": "Foo"}, {"ssid": ', 'json')
+        with self.assertRaises(ValueError):
+            self.read('[{"password": "bar"}]', 'json')
+
+    def test_read_json_in_chunks(self):
+        text = '[%s]' % ', '.join('{"ssid": "network %d", "password": "secret"}' % n
+                                  for n in range(200))
+        original = networks.json_chunk_size
+        networks.json_chunk_size = 7
+        try:
+            read = self.read(text, 'json')
+        finally:
+            networks.json_chunk_size = original
+        self.assertEqual(len(read), 200)
+        self.assertEqual(read[-1], {'ssid' : 'network 199', 'password' : 'secret'})
+
+    def test_read_yaml_and_csv(self):
+        self.assertEqual(self.read('- ssid: Foo\n  password: bar\n---\nssid: Baz\n', 'yaml'),
+                         [{'ssid' : 'Foo', 'password' : 'bar'}, {'ssid' : 'Baz'}])
+        self.assertEqual(self.read('SSID,password,priority\nFoo,bar,3\n,,\nBaz,,\n', 'csv'),
+                         [{'ssid' : 'Foo', 'password' : 'bar', 'priority' : 3}, {'ssid' : 'Baz'}])
+        with self.assertRaises(ValueError):
+            self.read('name,password\nFoo,bar\n', 'csv')
+
+    def test_numeric_password(self):
+        self.assertEqual(self.read('ssid: Lab\npassword: "12345678"\n', 'yaml'),
+                         [{'ssid' : 'Lab', 'password' : '12345678'}])
+        self.assertEqual(self.read('ssid,password\nLab,12345678\n', 'csv'),
+                         [{'ssid' : 'Lab', 'password' : '12345678'}])
+        for text in ['ssid: Lab\npassword: 12345678\n', 'ssid: Lab\npassword: 01234567\n']:
+            with self.assertRaises(ValueError):
+                self.read(text, 'yaml')
+
+    def test_whole_connections(self):
+        con = {'connection' : {'id' : 'Foo'}, '802-11-wireless' : {'ssid' : 'Foo'}}
+        read = list(networks.read_networks(StringIO(json.dumps([con])), 'json'))
+        self.assertEqual(pending.connection_ssid(read[0]), 'Foo')
+        self.assertIsNotNone(pending.connection_uuid(read[0]))
+
+    def test_write_round_trip(self):
+        connections = [pending.wifi_connection('Foo', 'bar', 5), pending.wifi_connection('Baz')]
+        for format in networks.formats:
+            stream = StringIO()
+            self.assertEqual(networks.write_networks(connections, stream, format), 2)
+            self.assertEqual(self.read(stream.getvalue(), format),
+                             [{'ssid' : 'Foo', 'password' : 'bar', 'priority' : 5}, {'ssid' : 'Baz'}])
+
+        stream = StringIO()
+        self.assertEqual(networks.write_networks([], stream, 'json'), 0)
+        self.assertEqual(self.read(stream.getvalue(), 'json'), [])
+
+    def test_guess_format_and_matcher(self):
+        self.assertEqual(networks.guess_format('sites.YML'), 'yaml')
+        self.assertEqual(networks.guess_format('sites.csv'), 'csv')
+        self.assertEqual(networks.guess_format('-'), 'json')
+
+        matches = networks.ssid_matcher(['Foo'], ['Site-*'])
+        self.assertTrue(matches('Foo'))
+        self.assertTrue(matches('Site-12'))
+        self.assertFalse(matches('site-12'))
+        self.assertFalse(matches(None))
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import unittest
+from unittest import mock
+import pifi.nm_events as nm_events
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+class FakeLoop:
+    """Stands in for GLib.MainLoop, fires the queued signal callbacks on run()"""
+    def __init__(self, glib):
+        self.glib = glib
+        self.running = False
+
+    def run(self):
+        self.running = True
+        for fire in self.glib.pending:
+            if not self.running:
+                break
+            fire()
+        if self.running and self.glib.timer is not None:
+            self.glib.timer()
+
+    def quit(self):
+        self.running = False
+
+class FakeGLib:
+    def __init__(self):
+        self.pending = []
+        self.timer = None
+        self.removed = []
+
+    def MainLoop(self):
+        return FakeLoop(self)
+
+    def timeout_add(self, ms, func):
+        self.timer = func
+        return 42
+
+    def source_remove(self, source):
+        self.removed.append(source)
+
+class NMEventsTests(unittest.TestCase):
+
+    def test_poll_condition_already_true(self):
+        clock = FakeClock()
+        condition = mock.MagicMock(return_value=True)
+        self.assertTrue(nm_events.wait_until(condition, timeout=10, GLib=None,
+                                             clock=clock, sleep=clock.sleep))
+        self.assertEqual(clock.now, 0)
+
+    def test_poll_condition_becomes_true(self):
+        clock = FakeClock()
+        condition = mock.MagicMock(side_effect=[False, False, True])
+        self.assertTrue(nm_events.wait_until(condition, timeout=10, GLib=None,
+                                             clock=clock, sleep=clock.sleep))
+        self.assertEqual(condition.call_count, 3)
+        self.assertLess(clock.now, 10)
+
+    def test_poll_timeout(self):
+        clock = FakeClock()
+        condition = mock.MagicMock(return_value=False)
+        self.assertFalse(nm_events.wait_until(condition, timeout=3, GLib=None,
+                                              clock=clock, sleep=clock.sleep))
+        self.assertAlmostEqual(clock.now, 3)
+
+    def test_signal_wakes_up_wait(self):
+        glib = FakeGLib()
+        match = mock.MagicMock()
+        callbacks = []
+
+        def subscribe(callback):
+            callbacks.append(callback)
+            glib.pending.append(callback)
+            return match
+
+        condition = mock.MagicMock(side_effect=[False, True])
+        self.assertTrue(nm_events.wait_until(condition, subscribe=[subscribe],
+                                             timeout=30, GLib=glib))
+        match.remove.assert_called_once_with()
+        self.assertEqual(glib.removed, [42])
+
+        # Late signals are ignored once the wait is over
+        callbacks[0]()
+        self.assertEqual(condition.call_count, 2)
+
+    def test_signal_wait_timeout(self):
+        glib = FakeGLib()
+        match = mock.MagicMock()
+        subscribe = mock.MagicMock(return_value=match)
+
+        condition = mock.MagicMock(return_value=False)
+        self.assertFalse(nm_events.wait_until(condition, subscribe=[subscribe],
+                                              timeout=30, GLib=glib))
+        match.remove.assert_called_once_with()
+        self.assertEqual(glib.removed, [])
+
+    def test_signal_condition_already_true(self):
+        glib = FakeGLib()
+        match = mock.MagicMock()
+        subscribe = mock.MagicMock(return_value=match)
+
+        self.assertTrue(nm_events.wait_until(lambda: True, subscribe=[subscribe],
+                                             timeout=30, GLib=glib))
+        self.assertIsNone(glib.timer)
+        match.remove.assert_called_once_with()
+
+    def test_no_glib_mainloop(self):
+        self.assertFalse(nm_events.use_glib_mainloop(GLib=None))
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
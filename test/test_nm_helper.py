@@ -5,6 +5,7 @@ import os, sys
 
 sys.modules['NetworkManager'] = mock.MagicMock()
 import pifi.nm_helper as nm_helper
+import pifi.dbus_stats as dbus_stats
 
 class NMHelperTests(unittest.TestCase):
 
@@ -229,6 +230,42 @@ class NMHelperTests(unittest.TestCase):
         self.assertEqual(ret_ap, ap_strong)
         self.assertEqual(con, 3)
 
+    def test_select_connection_zero_strength(self):
+        ap = mock.MagicMock(**{'Strength' : 0})
+        ret_ap, con = nm_helper.selectConnection([(ap, 1)])
+
+        self.assertEqual(ret_ap, ap)
+
+    def test_rank_connections(self):
+        nm = mock.MagicMock(**{'NM_802_11_AP_FLAGS_PRIVACY' : 1})
+        ap_2ghz = mock.MagicMock(**{'Strength' : 70, 'Frequency' : 2412, 'MaxBitrate' : 54000,
+                                    'Flags' : 1, 'WpaFlags' : 0, 'RsnFlags' : 0})
+        ap_5ghz = mock.MagicMock(**{'Strength' : 60, 'Frequency' : 5180, 'MaxBitrate' : 270000,
+                                    'Flags' : 1, 'WpaFlags' : 0, 'RsnFlags' : 392})
+        ap_open = mock.MagicMock(**{'Strength' : 90, 'Frequency' : 2412, 'MaxBitrate' : 54000,
+                                    'Flags' : 0, 'WpaFlags' : 0, 'RsnFlags' : 0})
+        secure = {'802-11-wireless': {'ssid' : 'Foo'},
+                  '802-11-wireless-security': {'key-mgmt' : 'wpa-psk'}}
+
+        ranked = nm_helper.rankConnections([(ap_2ghz, secure), (ap_open, secure),
+                                            (ap_5ghz, secure)], NetworkManager=nm)
+        self.assertEqual(ranked, [(ap_5ghz, secure), (ap_2ghz, secure), (ap_open, secure)])
+
+    def test_rank_connections_priority_and_history(self):
+        nm = mock.MagicMock(**{'NM_802_11_AP_FLAGS_PRIVACY' : 1})
+        ap1 = mock.MagicMock(**{'Strength' : 80})
+        ap2 = mock.MagicMock(**{'Strength' : 50})
+        con1 = {'802-11-wireless': {'ssid' : 'Foo'}}
+        con2 = {'connection': {'autoconnect-priority' : 5}, '802-11-wireless': {'ssid' : 'Bar'}}
+
+        ranked = nm_helper.rankConnections([(ap1, con1), (ap2, con2)], NetworkManager=nm)
+        self.assertEqual(ranked, [(ap2, con2), (ap1, con1)])
+
+        con2 = {'802-11-wireless': {'ssid' : 'Bar'}}
+        ranked = nm_helper.rankConnections([(ap1, con1), (ap2, con2)],
+                                           history={b'Bar' : (10, 0), b'Foo' : (0, 10)},
+                                           NetworkManager=nm)
+        self.assertEqual(ranked, [(ap2, con2), (ap1, con1)])
 
     def test_availible_connections_no_aps(self):
         wi_dev = mock.MagicMock(**{'GetAccessPoints.return_value': list()})
@@ -285,6 +322,85 @@ class NMHelperTests(unittest.TestCase):
         self.assertIn((ap1, cons[1]), output)
         self.assertEqual(len(output), 2)
 
+    def test_availible_connections_reads_each_ssid_once(self):
+        aps = []
+        ssid_reads = []
+        for ssid in ['Foo', 'Bar', 'Foo', 'Baz']:
+            ssid_prop = mock.PropertyMock(return_value=ssid)
+            ap = mock.MagicMock()
+            type(ap).Ssid = ssid_prop
+            ssid_reads.append(ssid_prop)
+            aps.append(ap)
+        wi_dev = mock.MagicMock(**{'GetAccessPoints.return_value': aps})
+        dev = mock.MagicMock(**{'SpecificDevice.return_value': wi_dev})
+        cons = [{'802-11-wireless': {'ssid' : 'Foo'}},
+                {'802-11-wireless': {'ssid' : 'Qux'}},
+                {'802-11-wireless': {'ssid' : 'Foo'}}]
+
+        output = list(nm_helper.availibleConnections(dev, cons))
+        self.assertEqual(output, [(aps[0], cons[0]), (aps[0], cons[2]),
+                                  (aps[2], cons[0]), (aps[2], cons[2])])
+        for ssid_prop in ssid_reads:
+            ssid_prop.assert_called_once_with()
+
+    def test_availible_connections_bytes_ssid(self):
+        ap = mock.MagicMock(**{'Ssid': 'Caf\u00e9'})
+        wi_dev = mock.MagicMock(**{'GetAccessPoints.return_value': [ap]})
+        dev = mock.MagicMock(**{'SpecificDevice.return_value': wi_dev})
+        cons = [{'802-11-wireless': {'ssid' : 'Caf\u00e9'.encode('utf-8')}},
+                {'connection': {'id' : 'wired'}}]
+
+        self.assertEqual(list(nm_helper.availibleConnections(dev, cons)), [(ap, cons[0])])
+
+    def test_availible_connections_from_scan_table(self):
+        ap1 = mock.MagicMock(**{'Ssid': 'Foo', 'Strength' : 40})
+        ap2 = mock.MagicMock(**{'Ssid': 'Foo', 'Strength' : 80})
+        ap3 = mock.MagicMock(**{'Ssid': 'Bar', 'Strength' : 60})
+        dev = mock.MagicMock()
+        table = nm_helper.ScanTable()
+        for n, ap in enumerate([ap1, ap2, ap3]):
+            table.add(ap.Ssid, 'bssid%d' % n, strength=ap.Strength, ap=ap)
+        cons = [{'802-11-wireless': {'ssid' : 'Foo'}}, {'802-11-wireless': {'ssid' : 'Qux'}}]
+
+        output = list(nm_helper.availibleConnections(dev, cons, table=table))
+        self.assertEqual(output, [(ap1, cons[0]), (ap2, cons[0])])
+        dev.SpecificDevice.assert_not_called()
+
+    def test_scan_table(self):
+        nm = mock.MagicMock(**{'NM_802_11_AP_FLAGS_PRIVACY' : 1})
+        nm.ObjectVanished = type('ObjectVanished', (Exception,), {})
+        ap1 = mock.MagicMock(**{'Ssid' : 'Foo', 'HwAddress' : 'aa', 'Strength' : 40,
+                                'Frequency' : 2412, 'Flags' : 1, 'WpaFlags' : 0,
+                                'RsnFlags' : 0, 'LastSeen' : 7})
+        ap2 = mock.MagicMock(**{'Ssid' : 'Foo', 'HwAddress' : 'bb', 'Strength' : 80,
+                                'Frequency' : 5180, 'Flags' : 1, 'WpaFlags' : 0,
+                                'RsnFlags' : 0, 'LastSeen' : 9})
+        hidden = mock.MagicMock(**{'Ssid' : '', 'HwAddress' : 'cc', 'Strength' : 90})
+        gone = mock.MagicMock()
+        type(gone).Strength = mock.PropertyMock(side_effect=nm.ObjectVanished())
+        wi_dev1 = mock.MagicMock(**{'GetAccessPoints.return_value': [ap1, hidden, gone]})
+        wi_dev2 = mock.MagicMock(**{'GetAccessPoints.return_value': [ap2]})
+        devs = [mock.MagicMock(**{'SpecificDevice.return_value': wi_dev1}),
+                mock.MagicMock(**{'SpecificDevice.return_value': wi_dev2})]
+
+        table = nm_helper.scan_table(devs, NetworkManager=nm)
+        self.assertEqual(table.ssids(), ['Foo'])
+        self.assertEqual(table.hidden, 1)
+        entry = table.get('Foo')
+        self.assertEqual(entry.bssids, ['aa', 'bb'])
+        self.assertEqual(entry.access_points, [ap1, ap2])
+        self.assertEqual(entry.max_strength, 80)
+        self.assertEqual(entry.bands(), ['2.4GHz', '5GHz'])
+        self.assertTrue(entry.secured)
+        self.assertEqual(entry.last_seen, 9)
+
+    def test_ssid_index(self):
+        cons = [{'802-11-wireless': {'ssid' : 'Foo'}},
+                {'connection': {'id' : 'wired'}},
+                {'802-11-wireless': {'ssid' : [b'F', b'o', b'o']}}]
+
+        self.assertEqual(nm_helper.ssid_index(cons), {b'Foo' : [cons[0], cons[2]]})
+
     def test_select_devices_no_devices(self):
         nm = mock.MagicMock(**{'NetworkManager.GetDevices.return_value': list()})
 
@@ -501,6 +617,498 @@ class NMHelperTests(unittest.TestCase):
         with self.assertRaises(KeyError):
             nm_helper.select_devices(conf, NetworkManager=nm)
 
+    def test_scan_done_activated(self):
+        wi_dev = mock.MagicMock(**{'LastScan' : -1})
+        dev = mock.MagicMock(**{'State' : 100, 'SpecificDevice.return_value': wi_dev})
+        nm = mock.MagicMock(**{'NM_DEVICE_STATE_ACTIVATED' : 100})
+
+        self.assertTrue(nm_helper.scan_done(dev, NetworkManager=nm)())
+
+    def test_scan_done_last_scan(self):
+        wi_dev = mock.MagicMock(**{'LastScan' : -1})
+        dev = mock.MagicMock(**{'State' : 30, 'SpecificDevice.return_value': wi_dev})
+        nm = mock.MagicMock(**{'NM_DEVICE_STATE_ACTIVATED' : 100})
+
+        done = nm_helper.scan_done(dev, NetworkManager=nm)
+        self.assertFalse(done())
+        wi_dev.LastScan = 1234
+        self.assertTrue(done())
+
+        done = nm_helper.scan_done(dev, since=1234, NetworkManager=nm)
+        self.assertFalse(done())
+        wi_dev.LastScan = 5678
+        self.assertTrue(done())
+
+    def test_access_points_settled(self):
+        now = [0]
+        wi_dev = mock.MagicMock(**{'GetAccessPoints.return_value' : []})
+        dev = mock.MagicMock(**{'State' : 30, 'SpecificDevice.return_value': wi_dev})
+        nm = mock.MagicMock(**{'NM_DEVICE_STATE_ACTIVATED' : 100})
+
+        settled = nm_helper.access_points_settled(dev, settle_time=3,
+                                                  clock=lambda: now[0],
+                                                  NetworkManager=nm)
+        self.assertFalse(settled())
+        now[0] = 5
+        self.assertFalse(settled()) # No access points yet
+
+        wi_dev.GetAccessPoints.return_value = ['ap1']
+        now[0] = 6
+        self.assertFalse(settled())
+        now[0] = 8
+        self.assertFalse(settled())
+        now[0] = 9
+        self.assertTrue(settled())
+
+    def test_wait_for_scan_uses_signals(self):
+        wi_dev = mock.MagicMock(**{'LastScan' : 10})
+        dev = mock.MagicMock(**{'State' : 30, 'SpecificDevice.return_value': wi_dev})
+        events = mock.MagicMock(**{'wait_until.return_value' : True})
+
+        self.assertTrue(nm_helper.wait_for_scan(dev, 30, NetworkManager=mock.MagicMock(),
+                                                nm_events=events))
+        kwargs = events.wait_until.call_args[1]
+        self.assertEqual(kwargs['timeout'], 30)
+        self.assertEqual(len(kwargs['subscribe']), 3)
+
+    def test_wait_for_scan_old_network_manager(self):
+        wi_dev = mock.MagicMock(spec=['GetAccessPoints'])
+        dev = mock.MagicMock(**{'State' : 30, 'SpecificDevice.return_value': wi_dev})
+        events = mock.MagicMock(**{'wait_until.return_value' : False})
+
+        self.assertFalse(nm_helper.wait_for_scan(dev, 30, NetworkManager=mock.MagicMock(),
+                                                 nm_events=events))
+        self.assertNotIn('subscribe', events.wait_until.call_args[1])
+
+    def test_report_new_access_points(self):
+        ap1 = mock.MagicMock(**{'object_path' : '/ap/1'})
+        ap2 = mock.MagicMock(**{'object_path' : '/ap/2'})
+        wi_dev = mock.MagicMock(**{'GetAccessPoints.return_value' : [ap1]})
+        dev = mock.MagicMock(**{'SpecificDevice.return_value': wi_dev})
+        condition = mock.MagicMock(side_effect=[False, False, True])
+        reported = []
+
+        check = nm_helper.report_new_access_points(dev, condition, reported.append)
+        self.assertFalse(check())
+        self.assertEqual(reported, [ap1])
+
+        wi_dev.GetAccessPoints.return_value = [ap1, ap2]
+        self.assertFalse(check())
+        self.assertEqual(reported, [ap1, ap2])
+
+        self.assertTrue(check())
+        self.assertEqual(reported, [ap1, ap2])
+
+    def test_scan_table_access_point_vanishes(self):
+        nm = mock.MagicMock(**{'NM_802_11_AP_FLAGS_PRIVACY' : 1,
+                               'fixups.to_python.side_effect' : lambda k, m, n, v, s: v})
+        nm.ObjectVanished = type('ObjectVanished', (Exception,), {})
+        here = self.make_dbus_object('/ap/1', {
+            'iface.Specific' : {'Ssid' : 'Foo', 'HwAddress' : 'aa', 'Strength' : 40,
+                                'Frequency' : 2412, 'Flags' : 0, 'WpaFlags' : 0,
+                                'RsnFlags' : 0, 'LastSeen' : 7},
+            'iface' : {}})
+        # Went out of range after it was listed, the proxy says so like dbus does
+        gone = self.make_dbus_object('/ap/2', {})
+        gone.proxy.GetAll.side_effect = nm_helper.nm_events.DBusException(
+            "No such interface 'org.freedesktop.DBus.Properties' on object at path /ap/2",
+            name='org.freedesktop.DBus.Error.UnknownMethod')
+        wi_dev = mock.MagicMock(**{'GetAccessPoints.return_value': [gone, here]})
+        dev = mock.MagicMock(**{'SpecificDevice.return_value': wi_dev})
+
+        with mock.patch.object(nm_helper, 'properties', nm_helper.PropertyCache(NetworkManager=nm)):
+            table = nm_helper.scan_table([dev], NetworkManager=nm)
+        self.assertEqual(table.ssids(), ['Foo'])
+        self.assertEqual(table.get('Foo').bssids, ['aa'])
+
+    def test_request_scan(self):
+        wi_dev = mock.MagicMock(**{'LastScan' : 1234})
+        dev = mock.MagicMock(**{'SpecificDevice.return_value': wi_dev})
+
+        self.assertEqual(nm_helper.request_scan(dev), 1234)
+        wi_dev.RequestScan.assert_called_once_with({})
+
+    def make_dbus_object(self, path, values):
+        obj = mock.MagicMock(**{'object_path' : path,
+                                'interface_names' : ['iface.Specific', 'iface'],
+                                'proxy.GetAll.side_effect' : lambda iface, **kw: values[iface]
+                               })
+        return obj
+
+    def test_property_cache_one_get_all_per_interface(self):
+        nm = mock.MagicMock(**{'fixups.to_python.side_effect' : lambda k, m, n, v, s: v})
+        cache = nm_helper.PropertyCache(NetworkManager=nm)
+        obj = self.make_dbus_object('/dev/1', {'iface.Specific' : {'WirelessCapabilities' : 100},
+                                               'iface' : {'DeviceType' : 2, 'Interface' : 'wlan0'}})
+
+        self.assertEqual(cache.get(obj, 'DeviceType'), 2)
+        self.assertEqual(cache.get(obj, 'Interface'), 'wlan0')
+        self.assertEqual(cache.get(obj, 'WirelessCapabilities'), 100)
+        self.assertEqual(obj.proxy.GetAll.call_count, 2)
+
+    def test_property_cache_properties_changed(self):
+        nm = mock.MagicMock(**{'fixups.to_python.side_effect' : lambda k, m, n, v, s: v})
+        cache = nm_helper.PropertyCache(NetworkManager=nm)
+        obj = self.make_dbus_object('/ap/1', {'iface.Specific' : {'Strength' : 50, 'Ssid' : 'Foo'},
+                                              'iface' : {}})
+
+        self.assertEqual(cache.get(obj, 'Strength'), 50)
+        cache._properties_changed('iface.Specific', {'Strength' : 70}, ['Ssid'], path='/ap/1')
+        self.assertEqual(cache.get(obj, 'Strength'), 70)
+        self.assertEqual(obj.proxy.GetAll.call_count, 2)
+
+        # Invalidated properties are read directly from the object
+        obj.Ssid = 'Bar'
+        self.assertEqual(cache.get(obj, 'Ssid'), 'Bar')
+
+    def test_property_cache_invalidate(self):
+        nm = mock.MagicMock(**{'fixups.to_python.side_effect' : lambda k, m, n, v, s: v})
+        cache = nm_helper.PropertyCache(NetworkManager=nm)
+        obj = self.make_dbus_object('/ap/1', {'iface.Specific' : {'Strength' : 50}, 'iface' : {}})
+
+        cache.get(obj, 'Strength')
+        cache.invalidate(obj)
+        cache.get(obj, 'Strength')
+        self.assertEqual(obj.proxy.GetAll.call_count, 4)
+
+    def test_property_cache_vanished(self):
+        nm = mock.MagicMock()
+        nm.ObjectVanished = type('ObjectVanished', (Exception,), {})
+        cache = nm_helper.PropertyCache(NetworkManager=nm)
+        obj = self.make_dbus_object('/ap/1', {})
+        for name in nm_helper.vanished_errors:
+            obj.proxy.GetAll.side_effect = nm_helper.nm_events.DBusException('Gone', name=name)
+            with self.assertRaises(nm.ObjectVanished):
+                cache.get(obj, 'Strength')
+
+        # Other errors are not about the object being gone
+        obj.proxy.GetAll.side_effect = nm_helper.nm_events.DBusException(
+            'Denied', name='org.freedesktop.DBus.Error.AccessDenied')
+        with self.assertRaises(nm_helper.nm_events.DBusException):
+            cache.get(obj, 'Strength')
+
+    def test_property_cache_passes_through_non_dbus_objects(self):
+        cache = nm_helper.PropertyCache(NetworkManager=mock.MagicMock())
+        obj = mock.MagicMock(**{'Strength' : 50})
+
+        self.assertEqual(cache.get(obj, 'Strength'), 50)
+        obj.proxy.GetAll.assert_not_called()
+
+    def test_property_cache_watch_without_glib(self):
+        events = mock.MagicMock(**{'GLib' : None})
+        cache = nm_helper.PropertyCache(NetworkManager=mock.MagicMock(), nm_events=events)
+
+        self.assertFalse(cache.watch())
+        self.assertFalse(cache.watching)
+
+    def test_wait_for_activation(self):
+        nm = mock.MagicMock(**{'NM_ACTIVE_CONNECTION_STATE_ACTIVATED' : 2,
+                               'NM_ACTIVE_CONNECTION_STATE_DEACTIVATED' : 4})
+        events = mock.MagicMock()
+        active = mock.MagicMock(**{'State' : 2})
+
+        self.assertTrue(nm_helper.wait_for_activation(active, 10, NetworkManager=nm,
+                                                      nm_events=events))
+        condition = events.wait_until.call_args[0][0]
+        self.assertTrue(condition())
+        self.assertEqual(events.wait_until.call_args[1]['timeout'], 10)
+
+        active.State = 1
+        self.assertFalse(condition())
+        self.assertFalse(nm_helper.wait_for_activation(active, 10, NetworkManager=nm,
+                                                       nm_events=events))
+
+    def test_wait_for_activation_vanished(self):
+        nm = mock.MagicMock(**{'NM_ACTIVE_CONNECTION_STATE_ACTIVATED' : 2,
+                               'NM_ACTIVE_CONNECTION_STATE_DEACTIVATED' : 4})
+        events = mock.MagicMock()
+        active = mock.MagicMock()
+        type(active).State = mock.PropertyMock(side_effect=Exception('Object vanished'))
+
+        self.assertFalse(nm_helper.wait_for_activation(active, 10, NetworkManager=nm,
+                                                       nm_events=events))
+        condition = events.wait_until.call_args[0][0]
+        self.assertTrue(condition())
+
+    def make_saved_connection(self, path, uuid, ssid=None, mode=None):
+        settings = {'connection' : {'uuid' : uuid}}
+        if ssid is not None:
+            settings['802-11-wireless'] = {'ssid' : ssid}
+            if mode is not None:
+                settings['802-11-wireless']['mode'] = mode
+        return mock.MagicMock(**{'object_path' : path, 'GetSettings.return_value' : settings})
+
+    def test_settings_index(self):
+        ap = self.make_saved_connection('/c/1', 'uuid-1', 'Robot', 'ap')
+        home = self.make_saved_connection('/c/2', 'uuid-2', 'Home', 'infrastructure')
+        office = self.make_saved_connection('/c/3', 'uuid-3', 'Office')
+        wired = self.make_saved_connection('/c/4', 'uuid-4')
+        nm = mock.MagicMock(**{'Settings.ListConnections.return_value' : [ap, home, office, wired]})
+
+        index = nm_helper.SettingsIndex(NetworkManager=nm)
+        self.assertEqual([c for c, s in index.wireless(ap=True)], [ap])
+        self.assertEqual([c for c, s in index.wireless(ap=False)], [home, office])
+        self.assertEqual(index.by_uuid('uuid-4')[0], wired)
+        self.assertIsNone(index.by_uuid('uuid-5'))
+        self.assertEqual([c for c, s in index.by_ssid('Home')], [home])
+        self.assertEqual([c for c, s in index.by_ssid(b'Office', ap=False)], [office])
+        self.assertEqual(index.by_ssid('Office', ap=True), [])
+        self.assertEqual([c for c, s in index.by_mode('infrastructure')], [home, office])
+        self.assertEqual(len(index.all()), 4)
+
+        # Only one pass over the saved connections
+        nm.Settings.ListConnections.assert_called_once_with()
+        for connection in [ap, home, office, wired]:
+            connection.GetSettings.assert_called_once_with()
+
+    def test_settings_index_signals(self):
+        home = self.make_saved_connection('/c/1', 'uuid-1', 'Home')
+        office = self.make_saved_connection('/c/2', 'uuid-2', 'Office')
+        nm = mock.MagicMock(**{'Settings.ListConnections.return_value' : [home],
+                               'Connection.return_value' : office})
+
+        index = nm_helper.SettingsIndex(NetworkManager=nm)
+        self.assertEqual(len(index.all()), 1)
+
+        index._connection_added('/c/2')
+        nm.Connection.assert_called_once_with('/c/2')
+        self.assertEqual([c for c, s in index.by_ssid('Office')], [office])
+
+        office.GetSettings.return_value = {'connection' : {'uuid' : 'uuid-2'},
+                                           '802-11-wireless' : {'ssid' : 'Lab'}}
+        index._connection_updated(path='/c/2')
+        self.assertEqual(index.by_ssid('Office'), [])
+        self.assertEqual([c for c, s in index.by_ssid('Lab')], [office])
+
+        index._connection_removed('/c/1')
+        self.assertEqual(index.by_ssid('Home'), [])
+        self.assertIsNone(index.by_uuid('uuid-1'))
+        self.assertEqual([c for c, s in index.all()], [office])
+
+    def test_existing_connections(self):
+        ap = self.make_saved_connection('/c/1', 'uuid-1', 'Robot', 'ap')
+        home = self.make_saved_connection('/c/2', 'uuid-2', 'Home', 'infrastructure')
+        nm = mock.MagicMock(**{'Settings.ListConnections.return_value' : [ap, home]})
+
+        self.assertEqual(list(nm_helper.existingAPConnections(NetworkManager=nm)), [ap])
+        self.assertEqual(list(nm_helper.existingConnections(NetworkManager=nm)), [home])
+        self.assertIs(nm_helper.saved_connections(nm), nm_helper.saved_connections(nm))
+
+    def test_device_inventory(self):
+        wlan0 = mock.MagicMock(**{'DeviceType' : 2, 'Interface' : 'wlan0', 'State' : 100,
+                                  'WirelessCapabilities' : 100, 'HwAddress' : 'AA:BB'})
+        wlan0.SpecificDevice.return_value = wlan0
+        p2p = mock.MagicMock(**{'DeviceType' : 30, 'Interface' : 'p2p-dev-wlan0'})
+        eth0 = mock.MagicMock(**{'DeviceType' : 1, 'Interface' : 'eth0'})
+        wlan1 = mock.MagicMock(**{'DeviceType' : 2, 'Interface' : 'wlan1', 'State' : 30,
+                                  'WirelessCapabilities' : 0, 'HwAddress' : 'CC:DD'})
+        wlan1.SpecificDevice.return_value = wlan1
+        nm = mock.MagicMock(**{
+            'NetworkManager.GetDevices.return_value': [wlan0, p2p, eth0, wlan1],
+            'NM_DEVICE_TYPE_WIFI' : 2,
+            'NM_WIFI_DEVICE_CAP_AP' : 100
+        })
+
+        inventory = nm_helper.DeviceInventory(NetworkManager=nm)
+        self.assertEqual([r.device for r in inventory.wifi()], [wlan0, wlan1])
+        self.assertEqual([r.device for r in inventory.ap_capable()], [wlan0])
+        self.assertEqual(inventory.find('wlan1').hw_address, 'CC:DD')
+        self.assertEqual(inventory.find('wlan1').state, 30)
+        self.assertFalse(inventory.find('eth0').is_wireless)
+        nm.NetworkManager.GetDeviceByIpIface.assert_not_called()
+
+    def test_select_devices_one_enumeration(self):
+        wlan0 = mock.MagicMock(**{'DeviceType' : 2, 'Interface' : 'wlan0',
+                                  'WirelessCapabilities' : 100})
+        wlan0.SpecificDevice.return_value = wlan0
+        wlan1 = mock.MagicMock(**{'DeviceType' : 2, 'Interface' : 'wlan1',
+                                  'WirelessCapabilities' : 0})
+        wlan1.SpecificDevice.return_value = wlan1
+        nm = mock.MagicMock(**{
+            'NetworkManager.GetDevices.return_value': [wlan0, wlan1],
+            'NM_DEVICE_TYPE_WIFI' : 2,
+            'NM_WIFI_DEVICE_CAP_AP' : 100
+        })
+
+        conf = {'ap_device' : 'any', 'client_device' : 'wlan1'}
+        self.assertEqual(nm_helper.select_devices(conf, NetworkManager=nm), (wlan0, wlan1))
+
+        conf = {'ap_device' : 'any', 'client_device' : 'any'}
+        self.assertEqual(nm_helper.select_devices(conf, NetworkManager=nm), (wlan0, wlan1))
+
+        conf = {'ap_device' : 'wlan1', 'client_device' : 'any'}
+        with self.assertRaisesRegex(AssertionError, 'not ap capable'):
+            nm_helper.select_devices(conf, NetworkManager=nm)
+
+        self.assertEqual(nm.NetworkManager.GetDevices.call_count, 3)
+        nm.NetworkManager.GetDeviceByIpIface.assert_not_called()
+
+    def test_active_network(self):
+        ap = mock.MagicMock(**{'Ssid' : 'Foo', 'HwAddress' : '00:11', 'Frequency' : 2412})
+        active_connection = mock.MagicMock(**{'Uuid' : 'uuid-1'})
+        device = mock.MagicMock(**{'ActiveConnection' : active_connection,
+                                   'ActiveAccessPoint' : ap})
+        device.SpecificDevice.return_value = device
+
+        self.assertEqual(nm_helper.active_network(device),
+                         {'ssid' : 'Foo', 'bssid' : '00:11', 'frequency' : 2412,
+                          'uuid' : 'uuid-1'})
+
+        device.ActiveAccessPoint = None
+        self.assertIsNone(nm_helper.active_network(device))
+
+    def test_activate_network(self):
+        home = self.make_saved_connection('/c/1', 'uuid-1', 'Home', 'infrastructure')
+        nm = mock.MagicMock(**{'Settings.ListConnections.return_value' : [home]})
+        other_ap = mock.MagicMock(**{'HwAddress' : '00:22'})
+        home_ap = mock.MagicMock(**{'HwAddress' : '00:11'})
+        device = mock.MagicMock(**{'ActiveConnection' : None,
+                                   'GetAccessPoints.return_value' : [other_ap, home_ap]})
+        device.SpecificDevice.return_value = device
+        network = {'ssid' : 'Home', 'bssid' : '00:11', 'frequency' : 2412, 'uuid' : 'uuid-1'}
+
+        active = nm_helper.activate_network(device, network, NetworkManager=nm)
+        self.assertIs(active, nm.NetworkManager.ActivateConnection.return_value)
+        nm.NetworkManager.ActivateConnection.assert_called_once_with(home, device, home_ap)
+
+        # Not seen yet, let NetworkManager find it
+        device.GetAccessPoints.return_value = [other_ap]
+        nm_helper.activate_network(device, network, NetworkManager=nm)
+        nm.NetworkManager.ActivateConnection.assert_called_with(home, device, '/')
+
+        # Already being activated
+        device.ActiveConnection = mock.MagicMock(**{'Uuid' : 'uuid-1'})
+        nm.NetworkManager.ActivateConnection.reset_mock()
+        self.assertIs(nm_helper.activate_network(device, network, NetworkManager=nm),
+                      device.ActiveConnection)
+        nm.NetworkManager.ActivateConnection.assert_not_called()
+
+        network['uuid'] = 'uuid-2'
+        self.assertIsNone(nm_helper.activate_network(device, network, NetworkManager=nm))
+
+    def make_wifi_device(self, interface, mac, ap_capable=True):
+        device = mock.MagicMock(**{'DeviceType' : 2, 'Interface' : interface,
+                                   'WirelessCapabilities' : 100 if ap_capable else 0,
+                                   'HwAddress' : mac, 'PermHwAddress' : mac})
+        device.SpecificDevice.return_value = device
+        return device
+
+    def make_device_nm(self, devices):
+        by_name = dict((d.Interface, d) for d in devices)
+        return mock.MagicMock(**{
+            'NetworkManager.GetDevices.return_value': devices,
+            'NetworkManager.GetDeviceByIpIface.side_effect': lambda name: by_name[name],
+            'NM_DEVICE_TYPE_WIFI' : 2,
+            'NM_WIFI_DEVICE_CAP_AP' : 100
+        })
+
+    def test_select_devices_cached_valid(self):
+        wlan0 = self.make_wifi_device('wlan0', 'AA:BB')
+        wlan1 = self.make_wifi_device('wlan1', 'CC:DD')
+        nm = self.make_device_nm([wlan0, wlan1])
+        conf = {'ap_device' : 'any', 'client_device' : 'any'}
+
+        ap, client, selection = nm_helper.select_devices_cached(conf, None, NetworkManager=nm)
+        self.assertEqual((ap, client), (wlan0, wlan1))
+        self.assertEqual(selection['ap'], {'mac' : 'AA:BB', 'interface' : 'wlan0'})
+
+        # Next boot, no enumeration needed
+        nm.NetworkManager.GetDevices.reset_mock()
+        self.assertEqual(nm_helper.select_devices_cached(conf, selection, NetworkManager=nm),
+                         (wlan0, wlan1, None))
+        nm.NetworkManager.GetDevices.assert_not_called()
+
+    def test_select_devices_cached_renamed(self):
+        wlan0 = self.make_wifi_device('wlan0', 'AA:BB')
+        wlan1 = self.make_wifi_device('wlan1', 'CC:DD')
+        nm = self.make_device_nm([wlan0, wlan1])
+        conf = {'ap_device' : 'any', 'client_device' : 'any'}
+        # The interfaces have been swapped since the last boot
+        selection = {'ap_device' : 'any', 'client_device' : 'any',
+                     'ap' : {'mac' : 'CC:DD', 'interface' : 'wlan0'},
+                     'client' : {'mac' : 'AA:BB', 'interface' : 'wlan1'}}
+
+        ap, client, selection = nm_helper.select_devices_cached(conf, selection, NetworkManager=nm)
+        self.assertEqual((ap, client), (wlan1, wlan0))
+        self.assertEqual(selection['ap'], {'mac' : 'CC:DD', 'interface' : 'wlan1'})
+
+    def test_select_devices_cached_renamed_configured(self):
+        wlan0 = self.make_wifi_device('wlan0', 'AA:BB')
+        wlan1 = self.make_wifi_device('wlan1', 'CC:DD')
+        nm = self.make_device_nm([wlan0, wlan1])
+        conf = {'ap_device' : 'wlan0', 'client_device' : 'any'}
+        # The device used for AP mode is wlan1 now, but the conf asks for wlan0
+        selection = {'ap_device' : 'wlan0', 'client_device' : 'any',
+                     'ap' : {'mac' : 'CC:DD', 'interface' : 'wlan0'},
+                     'client' : {'mac' : 'AA:BB', 'interface' : 'wlan1'}}
+
+        ap, client, selection = nm_helper.select_devices_cached(conf, selection, NetworkManager=nm)
+        self.assertIs(ap, wlan0)
+        self.assertEqual(selection['ap'], {'mac' : 'AA:BB', 'interface' : 'wlan0'})
+
+    def test_select_devices_cached_invalid(self):
+        wlan0 = self.make_wifi_device('wlan0', 'AA:BB', ap_capable=False)
+        wlan1 = self.make_wifi_device('wlan1', 'CC:DD')
+        nm = self.make_device_nm([wlan0, wlan1])
+        selection = {'ap_device' : 'any', 'client_device' : 'any',
+                     'ap' : {'mac' : 'AA:BB', 'interface' : 'wlan0'},
+                     'client' : {'mac' : 'AA:BB', 'interface' : 'wlan0'}}
+
+        # wlan0 can't do AP mode (anymore)
+        conf = {'ap_device' : 'any', 'client_device' : 'any'}
+        ap, client, new = nm_helper.select_devices_cached(conf, selection, NetworkManager=nm)
+        self.assertEqual((ap, client), (wlan1, wlan0))
+
+        # The conf changed, so the cache does not apply
+        conf = {'ap_device' : 'any', 'client_device' : 'wlan1'}
+        ap, client, new = nm_helper.select_devices_cached(conf, selection, NetworkManager=nm)
+        self.assertEqual((ap, client), (wlan1, wlan1))
+        self.assertEqual(new['client_device'], 'wlan1')
+
+        # The interface is gone
+        selection['ap']['interface'] = 'wlan5'
+        ap, client, new = nm_helper.select_devices_cached(conf, selection, NetworkManager=nm)
+        self.assertEqual((ap, client), (wlan1, wlan1))
+
+    def test_budget_select_devices(self):
+        devices = [self.make_wifi_device('wlan%d' % i, '00:%02d' % i) for i in range(4)]
+        stats = dbus_stats.Stats()
+        nm = stats.wrap(self.make_device_nm(devices))
+        conf = {'ap_device' : 'any', 'client_device' : 'wlan3'}
+
+        self.assertEqual(nm_helper.select_devices(conf, NetworkManager=nm),
+                         (devices[0], devices[3]))
+        # One enumeration, and each property of each device is read once
+        self.assertEqual(stats.count('call'), 1)
+        self.assertLessEqual(stats.count('property'), 6 * len(devices))
+        self.assertEqual(stats.count('property', 'Interface'), len(devices))
+
+    def test_budget_select_devices_cached(self):
+        devices = [self.make_wifi_device('wlan%d' % i, '00:%02d' % i) for i in range(4)]
+        conf = {'ap_device' : 'any', 'client_device' : 'any'}
+        selection = nm_helper.select_devices_cached(
+            conf, None, NetworkManager=self.make_device_nm(devices))[2]
+
+        stats = dbus_stats.Stats()
+        nm = stats.wrap(self.make_device_nm(devices))
+        nm_helper.select_devices_cached(conf, selection, NetworkManager=nm)
+        # Only the two cached devices are looked at
+        self.assertEqual(stats.count('call', 'GetDevices'), 0)
+        self.assertEqual(stats.count('call', 'GetDeviceByIpIface'), 2)
+        self.assertLessEqual(stats.count('property'), 12)
+
+    def test_budget_availible_connections(self):
+        aps = [mock.MagicMock(**{'Ssid' : 'Net%d' % i}) for i in range(50)]
+        wi_dev = mock.MagicMock(**{'GetAccessPoints.return_value': aps})
+        dev = mock.MagicMock(**{'SpecificDevice.return_value': wi_dev})
+        cons = [{'802-11-wireless': {'ssid' : 'Net%d' % i}} for i in range(0, 100, 2)]
+
+        stats = dbus_stats.Stats()
+        found = list(nm_helper.availibleConnections(stats.wrap(dev), cons))
+        self.assertEqual(len(found), 25)
+        self.assertEqual(stats.count('call', 'GetAccessPoints'), 1)
+        self.assertEqual(stats.count('property', 'Ssid'), len(aps))
+
 def main():
     unittest.main()
 
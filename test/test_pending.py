@@ -0,0 +1,70 @@
+import unittest
+from pifi.pending import PendingStore
+import pifi.pending as pending
+
+def wifi(ssid, uuid, priority=None):
+    con = {'connection' : {'id' : ssid, 'uuid' : uuid},
+           '802-11-wireless' : {'ssid' : ssid}}
+    if priority is not None:
+        con['connection']['autoconnect-priority'] = priority
+    return con
+
+class PendingStoreTests(unittest.TestCase):
+
+    def test_dedup_by_ssid_and_uuid(self):
+        foo, bar = wifi('Foo', 'uuid-1'), wifi('Bar', 'uuid-2')
+        store = PendingStore([foo, bar, wifi('Foo', 'uuid-3')])
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.by_ssid('Foo')['connection']['uuid'], 'uuid-3')
+        self.assertIsNone(store.by_uuid('uuid-1'))
+
+        # Same UUID, new SSID: the old SSID is gone too
+        renamed = wifi('Baz', 'uuid-2')
+        self.assertEqual(store.add(renamed), [bar])
+        self.assertIsNone(store.by_ssid('Bar'))
+        self.assertIs(store.by_uuid('uuid-2'), renamed)
+        self.assertIn(renamed, store)
+        self.assertNotIn(wifi('Bar', 'uuid-4'), store)
+
+    def test_remove(self):
+        foo, bar = wifi('Foo', 'uuid-1'), wifi('Bar', 'uuid-2')
+        store = PendingStore([foo, {'Baz' : 'qux'}, bar])
+        self.assertTrue(store.remove(foo))
+        self.assertFalse(store.remove(foo))
+        self.assertIs(store.remove_ssid('Bar'), bar)
+        self.assertIsNone(store.remove_ssid('Bar'))
+        self.assertEqual(store.connections(), [{'Baz' : 'qux'}])
+        self.assertEqual([op['op'] for op in store.unsaved], ['remove', 'remove'])
+
+    def test_priority_order(self):
+        store = PendingStore([wifi('A', 'a'), wifi('B', 'b', priority=5),
+                              wifi('C', 'c'), wifi('D', 'd', priority=-1)])
+        self.assertEqual([pending.connection_ssid(con) for con in store], ['B', 'A', 'C', 'D'])
+
+    def test_journal(self):
+        store = PendingStore([wifi('Foo', 'uuid-1')])
+        store.add(wifi('Bar', 'uuid-2'))
+        store.remove_ssid('Foo')
+
+        replayed = PendingStore([wifi('Foo', 'uuid-1')], store.unsaved)
+        self.assertEqual(replayed.connections(), store.connections())
+        self.assertEqual(replayed.journaled, 2)
+        self.assertEqual(replayed.unsaved, [])
+        # Applying the journal again changes nothing
+        again = PendingStore(replayed.connections(), store.unsaved)
+        self.assertEqual(again.connections(), store.connections())
+
+        with self.assertRaises(ValueError):
+            PendingStore([], [{'op' : 'bogus'}])
+
+    def test_ssid_types(self):
+        con = {'802-11-wireless' : {'ssid' : [b'F', b'o', b'o']}}
+        self.assertEqual(pending.connection_ssid(con), 'Foo')
+        self.assertEqual(pending.connection_ssid({'802-11-wireless' : {'ssid' : [70, 111]}}), 'Fo')
+        self.assertIsNone(pending.connection_ssid({'connection' : {'id' : 'wired'}}))
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
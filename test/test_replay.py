@@ -0,0 +1,154 @@
+import unittest
+from unittest import mock
+import sys
+import os
+import shutil
+import tempfile
+
+sys.modules['NetworkManager'] = mock.MagicMock()
+import pifi.fake_nm as fake_nm
+import pifi.record as record
+import pifi.replay as replay
+import pifi.startup as startup
+import pifi.var_io as var_io
+
+def wifi_connection(ssid, psk):
+    return {'connection' : {'id' : ssid, 'type' : '802-11-wireless', 'uuid' : 'uuid-' + ssid},
+            '802-11-wireless' : {'ssid' : ssid, 'mode' : 'infrastructure'},
+            '802-11-wireless-security' : {'key-mgmt' : 'wpa-psk', 'psk' : psk}}
+
+class RecordReplayTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0.0]
+        self.world = fake_nm.World(call_latency=0.01, scan_time=2, activation_time=1,
+                                   clock=lambda: self.now[0], sleep=self.sleep)
+        self.world.add_device('wlan0')
+        self.wlan1 = self.world.add_device('wlan1', ap_capable=False)
+        self.world.add_access_point(self.wlan1, 'Home', psk='secret', strength=40)
+        self.world.add_access_point(self.wlan1, 'Cafe', psk='latte', strength=90)
+        self.pending = [wifi_connection('Cafe', 'wrong'), wifi_connection('Home', 'secret')]
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.trace_path = os.path.join(self.directory, 'trace')
+
+    def sleep(self, seconds):
+        self.now[0] += seconds
+
+    def connect(self, NetworkManager):
+        """Run connect_to_pending against NetworkManager, returns the SSID it connected to"""
+        device = NetworkManager.NetworkManager.GetDeviceByIpIface('wlan1')
+        with mock.patch.object(startup, 'var_io'):
+            self.assertTrue(startup.nm.wait_for_scan(device, timeout=10))
+            connected = startup.connect_to_pending({'connect_timeout' : 5}, device, self.pending)
+        return connected['802-11-wireless']['ssid']
+
+    def record(self):
+        recorder = record.Recorder(clock=lambda: self.now[0], wall_clock=lambda: 1000.0)
+        stand_in = recorder.module(fake_nm.module(self.world))
+        fake_nm.install_module(stand_in, clock=self.world.clock, sleep=self.world.sleep)
+        try:
+            ssid = self.connect(stand_in)
+        finally:
+            fake_nm.uninstall()
+        recorder.save(self.trace_path, recorder.header(stand_in, [], {}))
+        return ssid, recorder
+
+    def replay(self, trace):
+        stand_in = trace.module()
+        fake_nm.install_module(stand_in, clock=trace.clock, sleep=trace.sleep)
+        try:
+            return self.connect(stand_in)
+        finally:
+            fake_nm.uninstall()
+
+    def test_encode(self):
+        device = self.wlan1
+        self.assertEqual(record.encode({'a' : (1, 2.5, b'\x01', None)}),
+                         {'a' : [1, 2.5, {'$bytes' : [1]}, None]})
+        self.assertEqual(record.encode(device),
+                         {'$object' : device.object_path, '$type' : 'Device'})
+        self.assertEqual(record.encode([device], with_types=False),
+                         [{'$object' : device.object_path}])
+
+    def test_record_and_replay(self):
+        ssid, recorder = self.record()
+        self.assertEqual(ssid, 'Home')
+
+        trace = replay.Replay.load(self.trace_path)
+        self.assertEqual(trace.header['constants']['NM_DEVICE_STATE_ACTIVATED'], 100)
+        self.assertEqual(self.replay(trace), 'Home')
+        self.assertEqual(trace.missing, [])
+        # Same calls, and the same (simulated) time
+        self.assertEqual(trace.calls['AddAndActivateConnection'], 2)
+        self.assertEqual(trace.calls['Delete'], 1)
+        self.assertAlmostEqual(trace.now, self.now[0], delta=0.5)
+
+        # The same trace always gives the same answers
+        again = replay.Replay.load(self.trace_path)
+        self.assertEqual(self.replay(again), 'Home')
+        self.assertEqual(again.calls, trace.calls)
+        self.assertEqual(again.now, trace.now)
+
+    def test_replies_follow_time(self):
+        path = '/org/freedesktop/NetworkManager/Devices/1'
+        events = [{'t' : t, 'kind' : 'property', 'path' : path, 'name' : 'State',
+                   'reply' : state, 'duration' : 0.0}
+                  for t, state in ((0, 30), (1, 50), (5, 100))]
+        trace = replay.Replay({'pifi_trace' : 1}, events)
+        device = trace.object(path)
+
+        self.assertEqual(device.State, 30)
+        self.assertEqual(device.State, 30)
+        trace.sleep(2)
+        self.assertEqual(device.State, 50)
+        trace.sleep(10)
+        self.assertEqual(device.State, 100)
+
+    def test_calls_take_turns(self):
+        path = '/org/freedesktop/NetworkManager'
+        events = [{'t' : t, 'kind' : 'call', 'path' : path, 'name' : 'AddAndActivateConnection',
+                   'args' : [], 'kwargs' : {}, 'reply' : reply, 'duration' : 0.5}
+                  for t, reply in ((1, 'first'), (2, 'second'), (3, 'third'))]
+        trace = replay.Replay({'pifi_trace' : 1}, events)
+        nm = trace.object(path, 'NetworkManager')
+
+        self.assertEqual(nm.AddAndActivateConnection({}, None, '/'), 'first')
+        trace.sleep(5)
+        self.assertEqual(nm.AddAndActivateConnection({}, None, '/'), 'third')
+        self.assertEqual(nm.AddAndActivateConnection({}, None, '/'), 'third')
+        self.assertEqual(trace.now, 6.5)
+
+    def test_properties_from_get_all(self):
+        path = '/org/freedesktop/NetworkManager/AccessPoint/3'
+        events = [{'t' : 0, 'kind' : 'call', 'path' : path, 'name' : 'GetAll',
+                   'args' : ['org.freedesktop.NetworkManager.AccessPoint'],
+                   'kwargs' : {'dbus_interface' : 'org.freedesktop.DBus.Properties'},
+                   'reply' : {'Ssid' : [72, 105], 'Strength' : 70}, 'duration' : 0.0}]
+        trace = replay.Replay({'pifi_trace' : 1}, events)
+        ap = trace.object(path)
+
+        self.assertEqual(ap.Ssid, 'Hi')
+        self.assertEqual(ap.Strength, 70)
+        self.assertRaises(AttributeError, getattr, ap, 'Frequency')
+        self.assertEqual(trace.missing, [(path, 'Frequency')])
+
+    def test_restore_files(self):
+        trace = replay.Replay({'pifi_trace' : 1, 'files' : {'var_io.pending_path' : '[{"a": 1}]',
+                                                             'var_io.devices_path' : None}}, [])
+        original = var_io.pending_path
+        unrestore = trace.restore_files(self.directory)
+        try:
+            self.assertEqual(var_io.readPendingConnections(), [{'a' : 1}])
+            self.assertIsNone(var_io.readDeviceSelection())
+            self.assertTrue(var_io.boot_trace_path.startswith(self.directory))
+        finally:
+            unrestore()
+        self.assertEqual(var_io.pending_path, original)
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
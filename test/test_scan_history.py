@@ -0,0 +1,108 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from pifi.scan_table import ScanTable
+import pifi.scan_history as scan_history
+
+class ScanHistoryTests(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'scan_history')
+        self.now = [1000.0]
+
+    def clock(self):
+        self.now[0] += 60
+        return self.now[0]
+
+    def open(self, capacity=16):
+        history = scan_history.ScanHistory(self.path, capacity=capacity, clock=self.clock)
+        self.addCleanup(history.close)
+        return history
+
+    def scan(self, history, *networks, hidden=0):
+        table = ScanTable()
+        for n, (ssid, strength) in enumerate(networks):
+            table.add(ssid, 'bssid%d' % n, strength=strength, frequency=2412, secured=True)
+        table.hidden = hidden
+        return history.append(table)
+
+    def test_record_round_trip(self):
+        record = scan_history.Record(3, 12.5, scan_history.SSID, 'Café', 80, 60.4, 2,
+                                     ['2.4GHz', '5GHz'], True)
+        data = record.pack()
+        self.assertEqual(len(data), scan_history.record_size)
+        loaded = scan_history.Record.unpack(data)
+        self.assertEqual((loaded.boot, loaded.time, loaded.ssid, loaded.max_strength,
+                          loaded.mean_strength, loaded.access_points, loaded.bands, loaded.secured),
+                         (3, 12.5, 'Café', 80, 60, 2, ['2.4GHz', '5GHz'], True))
+
+        unknown = scan_history.Record.unpack(scan_history.Record(1, 0, scan_history.SSID, 'x' * 40).pack())
+        self.assertEqual(unknown.ssid, 'x' * 32)
+        self.assertIsNone(unknown.max_strength)
+        self.assertIsNone(unknown.secured)
+
+    def test_snapshots_and_visibility(self):
+        history = self.open()
+        self.assertEqual(self.scan(history, ('Foo', 40), ('Bar', 70), hidden=2), 1)
+        self.scan(history, ('Foo', 60))
+        self.scan(history)
+
+        snapshots = history.snapshots()
+        self.assertEqual([snapshot.boot for snapshot in snapshots], [1, 2, 3])
+        self.assertEqual([record.ssid for record in snapshots[0].entries], ['Bar', 'Foo'])
+        self.assertEqual(snapshots[0].hidden, 2)
+
+        foo = history.visibility('Foo')
+        self.assertEqual((foo.seen, foo.boots), (2, 3))
+        self.assertEqual(foo.mean_strength, 50)
+        self.assertEqual((foo.min_strength, foo.max_strength), (40, 60))
+        self.assertEqual(foo.last_seen, snapshots[1].time)
+
+        self.assertEqual(history.visibility('Foo', last=1).seen, 0)
+        self.assertEqual(history.visibility('Nope').ratio, 0.0)
+        self.assertEqual(sorted(history.visibilities(last=2)), ['Foo'])
+
+    def test_oldest_records_are_overwritten(self):
+        history = self.open(capacity=7)
+        for boot in range(4):
+            self.scan(history, ('Foo', 50), ('Bar', 40))
+        self.assertEqual(len(history), 7)
+        self.assertEqual(os.path.getsize(self.path),
+                         scan_history.header_size + 7 * scan_history.record_size)
+        # Boot 2 lost its snapshot record, its SSID record is not part of any snapshot
+        self.assertEqual([snapshot.boot for snapshot in history.snapshots()], [3, 4])
+        self.assertEqual(history.visibility('Bar').seen, 2)
+
+    def test_reopen(self):
+        history = self.open()
+        self.scan(history, ('Foo', 50))
+        history.close()
+
+        readonly = scan_history.ScanHistory(self.path, readonly=True)
+        self.addCleanup(readonly.close)
+        self.assertEqual(readonly.boots, 1)
+        self.assertEqual(readonly.visibility('Foo').seen, 1)
+        with self.assertRaises(ValueError):
+            self.scan(readonly, ('Foo', 50))
+
+        # A smaller history keeps the newest records
+        smaller = self.open(capacity=2)
+        self.assertEqual(len(smaller), 2)
+        self.assertEqual(self.scan(smaller, ('Bar', 50)), 2)
+
+    def test_not_a_history(self):
+        with open(self.path, 'w') as f:
+            f.write('Foo\n' * 100)
+        with self.assertRaises(ValueError):
+            scan_history.ScanHistory(self.path, readonly=True)
+        self.assertEqual(len(self.open()), 0)
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import unittest
+from pifi.scan_table import ScanTable, ScanEntry
+
+class ScanTableTests(unittest.TestCase):
+
+    def make_table(self):
+        table = ScanTable()
+        table.add('Warehouse', '00:00:00:00:00:01', strength=40, frequency=2412, secured=True, last_seen=10)
+        table.add('Warehouse', '00:00:00:00:00:02', strength=80, frequency=5180, secured=True, last_seen=12)
+        table.add('Warehouse', '00:00:00:00:00:03', strength=60, frequency=2412, secured=True, last_seen=11)
+        table.add('', '00:00:00:00:00:04', strength=90)
+        table.add('Guest', '00:00:00:00:00:05', strength=30, frequency=2437, secured=False)
+        table.add('Lab', '00:00:00:00:00:06')
+        return table
+
+    def test_aggregates_per_ssid(self):
+        table = self.make_table()
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.hidden, 1)
+
+        warehouse = table.get('Warehouse')
+        self.assertEqual(warehouse.bssids, ['00:00:00:00:00:01', '00:00:00:00:00:02',
+                                            '00:00:00:00:00:03'])
+        self.assertEqual(warehouse.max_strength, 80)
+        self.assertEqual(warehouse.mean_strength, 60)
+        self.assertEqual(warehouse.frequencies, [2412, 5180])
+        self.assertEqual(warehouse.bands(), ['2.4GHz', '5GHz'])
+        self.assertTrue(warehouse.secured)
+        self.assertEqual(warehouse.last_seen, 12)
+
+        lab = table.get('Lab')
+        self.assertIsNone(lab.max_strength)
+        self.assertIsNone(lab.mean_strength)
+        self.assertIsNone(lab.secured)
+        self.assertIsNone(table.get('Nope'))
+
+    def test_strongest_first(self):
+        self.assertEqual(self.make_table().ssids(), ['Warehouse', 'Guest', 'Lab'])
+
+    def test_json_round_trip(self):
+        table = self.make_table()
+        loaded = ScanTable.from_json(table.to_json())
+        self.assertEqual(loaded.to_json(), table.to_json())
+        self.assertEqual(loaded.hidden, 1)
+        self.assertEqual(loaded.get('Warehouse').mean_strength, 60)
+
+    def test_json_without_volatile(self):
+        table = self.make_table()
+        saved = table.to_json(volatile=False)
+        self.assertEqual([entry['ssid'] for entry in saved['entries']], ['Guest', 'Lab', 'Warehouse'])
+        self.assertNotIn('max_strength', saved['entries'][0])
+        self.assertNotIn('last_seen', saved['entries'][0])
+
+        # The same access points at other strengths save the same
+        again = ScanTable()
+        for entry in reversed(table.entries()):
+            for bssid in reversed(entry.bssids):
+                again.add(entry.ssid, bssid, strength=5, frequency=entry.frequencies[0] if entry.frequencies else None,
+                          secured=entry.secured, last_seen=99)
+        again.hidden = table.hidden
+        self.assertEqual(again.to_json(volatile=False)['entries'][2]['bssids'],
+                         saved['entries'][2]['bssids'])
+        self.assertIsNone(ScanTable.from_json(saved).get('Lab').max_strength)
+
+    def test_slots(self):
+        with self.assertRaises(AttributeError):
+            ScanEntry('Foo').bogus = 1
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
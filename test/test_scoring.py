@@ -0,0 +1,76 @@
+import unittest
+import pifi.scoring as scoring
+from pifi.scoring import Candidate
+
+class ScoringTests(unittest.TestCase):
+
+    def test_rank_empty(self):
+        self.assertEqual(scoring.rank([]), [])
+
+    def test_rank_by_strength(self):
+        weak = Candidate('weak', None, strength=10)
+        strong = Candidate('strong', None, strength=90)
+        mid = Candidate('mid', None, strength=70)
+
+        ranked = scoring.rank([weak, strong, mid])
+        self.assertEqual([c.ap for c in ranked], ['strong', 'mid', 'weak'])
+
+    def test_rank_zero_strength(self):
+        silent = Candidate('silent', None, strength=0)
+        self.assertEqual(scoring.rank([silent])[0].ap, 'silent')
+
+    def test_rank_keeps_order_on_ties(self):
+        first = Candidate('first', None, strength=50)
+        second = Candidate('second', None, strength=50)
+        ranked = scoring.rank([first, second])
+        self.assertEqual([c.ap for c in ranked], ['first', 'second'])
+
+    def test_5ghz_beats_slightly_stronger_2ghz(self):
+        two = Candidate('2.4', None, strength=70, frequency=2412, max_bitrate=54000)
+        five = Candidate('5', None, strength=60, frequency=5180, max_bitrate=216000)
+
+        ranked = scoring.rank([two, five])
+        self.assertEqual([c.ap for c in ranked], ['5', '2.4'])
+
+    def test_much_stronger_2ghz_beats_5ghz(self):
+        two = Candidate('2.4', None, strength=90, frequency=2412, max_bitrate=54000)
+        five = Candidate('5', None, strength=15, frequency=5180, max_bitrate=216000)
+
+        ranked = scoring.rank([two, five])
+        self.assertEqual([c.ap for c in ranked], ['2.4', '5'])
+
+    def test_security_mismatch_ranks_last(self):
+        impostor = Candidate('open', None, strength=90, ap_secured=False, con_secured=True)
+        real = Candidate('secured', None, strength=40, ap_secured=True, con_secured=True)
+
+        ranked = scoring.rank([impostor, real])
+        self.assertEqual([c.ap for c in ranked], ['secured', 'open'])
+
+    def test_priority_beats_strength(self):
+        preferred = Candidate('preferred', None, strength=30, priority=10)
+        other = Candidate('other', None, strength=95, priority=0)
+
+        ranked = scoring.rank([other, preferred])
+        self.assertEqual([c.ap for c in ranked], ['preferred', 'other'])
+
+    def test_history(self):
+        flaky = Candidate('flaky', None, strength=60, history=(0, 5))
+        reliable = Candidate('reliable', None, strength=55, history=(5, 0))
+
+        ranked = scoring.rank([flaky, reliable])
+        self.assertEqual([c.ap for c in ranked], ['reliable', 'flaky'])
+
+    def test_custom_factors(self):
+        a = Candidate('a', None, strength=90, frequency=2412)
+        b = Candidate('b', None, strength=10, frequency=5180)
+
+        ranked = scoring.rank([a, b], factors=[(1.0, scoring.band_factor)])
+        self.assertEqual([c.ap for c in ranked], ['b', 'a'])
+        self.assertEqual(ranked[0].score, 1.0)
+        self.assertEqual(ranked[1].score, 0.0)
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
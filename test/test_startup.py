@@ -0,0 +1,238 @@
+import unittest
+from unittest import mock
+import sys, os, signal
+
+sys.modules['NetworkManager'] = mock.MagicMock()
+import pifi.startup as startup
+import pifi.etc_io as etc_io
+
+class StartupTests(unittest.TestCase):
+
+    def setUp(self):
+        self.conf = {'connect_timeout' : 5}
+        self.device = mock.MagicMock()
+        self.aps = [mock.MagicMock(), mock.MagicMock(), mock.MagicMock()]
+        self.cons = [{'802-11-wireless' : {'ssid' : 'Foo'}},
+                     {'802-11-wireless' : {'ssid' : 'Bar'}}]
+        self.network = {'ssid' : 'Foo', 'bssid' : '00:11:22:33:44:55',
+                        'frequency' : 5180, 'uuid' : 'uuid-1'}
+
+        self.nm = mock.MagicMock()
+        self.NetworkManager = mock.MagicMock()
+        self.var_io = mock.MagicMock(**{'readLastNetwork.return_value' : None})
+        self.connections = []
+
+        def add_and_activate(con, device, ap):
+            connection = mock.MagicMock()
+            self.connections.append((ap, connection))
+            return connection, mock.MagicMock(**{'ap' : ap})
+
+        self.NetworkManager.NetworkManager.AddAndActivateConnection.side_effect = add_and_activate
+        patchers = [mock.patch.object(startup, 'nm', self.nm),
+                    mock.patch.object(startup, 'NetworkManager', self.NetworkManager),
+                    mock.patch.object(startup, 'var_io', self.var_io)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_wait_for_boot(self):
+        sleep = mock.MagicMock()
+        startup.wait_for_boot(open=mock.mock_open(read_data='2.50 3.10\n'), sleep=sleep)
+        sleep.assert_called_once_with(3)
+
+        sleep = mock.MagicMock()
+        startup.wait_for_boot(open=mock.mock_open(read_data='350.12 1200.00\n'), sleep=sleep)
+        sleep.assert_not_called()
+
+    def test_main_ignores_sighup_while_waiting_for_boot(self):
+        previous = signal.getsignal(signal.SIGHUP)
+        self.addCleanup(signal.signal, signal.SIGHUP, previous)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        handlers = []
+
+        def wait_for_boot():
+            handlers.append(signal.getsignal(signal.SIGHUP))
+            os.kill(os.getpid(), signal.SIGHUP)
+            raise KeyboardInterrupt()
+
+        with mock.patch.object(startup, 'wait_for_boot', wait_for_boot):
+            with self.assertRaises(KeyboardInterrupt):
+                startup.main()
+        self.assertEqual(handlers, [signal.SIG_IGN])
+
+    def test_connect_to_pending_nothing_availible(self):
+        self.nm.rankConnections.return_value = []
+
+        self.assertIsNone(startup.connect_to_pending(self.conf, self.device, self.cons))
+        self.NetworkManager.NetworkManager.AddAndActivateConnection.assert_not_called()
+
+    def test_connect_to_pending_best_works(self):
+        self.nm.rankConnections.return_value = [(self.aps[0], self.cons[0]),
+                                                (self.aps[1], self.cons[1])]
+        self.nm.wait_for_activation.return_value = True
+
+        self.assertIs(startup.connect_to_pending(self.conf, self.device, self.cons),
+                      self.cons[0])
+        self.assertEqual(len(self.connections), 1)
+        self.connections[0][1].Delete.assert_not_called()
+        self.assertEqual(self.nm.wait_for_activation.call_args[0][1], 5)
+
+    def test_connect_to_pending_falls_back(self):
+        self.nm.rankConnections.return_value = [(self.aps[0], self.cons[0]),
+                                                (self.aps[1], self.cons[1])]
+        self.nm.wait_for_activation.side_effect = lambda active, timeout: active.ap is self.aps[1]
+
+        self.assertIs(startup.connect_to_pending(self.conf, self.device, self.cons),
+                      self.cons[1])
+        self.assertEqual(len(self.connections), 2)
+        self.connections[0][1].Delete.assert_called_once_with()
+        self.connections[1][1].Delete.assert_not_called()
+
+    def test_connect_to_pending_history(self):
+        self.var_io.readConnectionHistory.return_value = {'Foo' : (3, 1)}
+        self.nm.normalize_ssid.side_effect = lambda ssid: ssid.encode('utf-8')
+        self.nm.rankConnections.return_value = [(self.aps[0], self.cons[0]),
+                                                (self.aps[1], self.cons[1])]
+        self.nm.wait_for_activation.side_effect = lambda active, timeout: active.ap is self.aps[1]
+
+        startup.connect_to_pending(self.conf, self.device, self.cons)
+        self.assertEqual(self.nm.rankConnections.call_args[1]['history'], {b'Foo' : (3, 1)})
+        self.assertEqual(self.var_io.recordConnectionResult.call_args_list,
+                         [mock.call('Foo', False), mock.call('Bar', True)])
+
+    def test_connect_to_pending_all_fail(self):
+        # Three access points with the same network, only attempts_per_connection are tried
+        self.nm.rankConnections.return_value = [(ap, self.cons[0]) for ap in self.aps]
+        self.nm.wait_for_activation.return_value = False
+
+        self.assertIsNone(startup.connect_to_pending(self.conf, self.device, self.cons))
+        self.assertEqual(len(self.connections), startup.attempts_per_connection)
+        for ap, connection in self.connections:
+            connection.Delete.assert_called_once_with()
+
+    def test_connect_to_pending_add_fails(self):
+        self.nm.rankConnections.return_value = [(self.aps[0], self.cons[0]),
+                                                (self.aps[1], self.cons[1])]
+        self.NetworkManager.NetworkManager.AddAndActivateConnection.side_effect = [
+            Exception('Bad settings'), (mock.MagicMock(), mock.MagicMock())]
+        self.nm.wait_for_activation.return_value = True
+
+        self.assertIs(startup.connect_to_pending(self.conf, self.device, self.cons),
+                      self.cons[1])
+
+    def test_connect_to_pending_remembers_network(self):
+        self.nm.rankConnections.return_value = [(self.aps[0], self.cons[0])]
+        self.nm.wait_for_activation.return_value = True
+        self.nm.active_network.return_value = self.network
+
+        startup.connect_to_pending(self.conf, self.device, self.cons)
+        self.nm.active_network.assert_called_once_with(self.device)
+        self.var_io.writeLastNetwork.assert_called_once_with(self.network)
+
+    def test_remember_same_network(self):
+        self.nm.active_network.return_value = self.network
+        self.var_io.readLastNetwork.return_value = dict(self.network)
+
+        startup.remember_network(self.device)
+        self.var_io.writeLastNetwork.assert_not_called()
+
+    def test_remember_no_network(self):
+        self.nm.active_network.return_value = None
+
+        startup.remember_network(self.device)
+        self.var_io.writeLastNetwork.assert_not_called()
+
+    def test_connect_to_last_network(self):
+        self.var_io.readLastNetwork.return_value = self.network
+        active_connection = mock.MagicMock()
+        self.nm.activate_network.return_value = active_connection
+        self.nm.wait_for_network.return_value = True
+
+        self.assertTrue(startup.connect_to_last_network(self.conf, self.device))
+        self.nm.activate_network.assert_called_once_with(self.device, self.network)
+        self.nm.wait_for_network.assert_called_once_with(self.device, active_connection, 'Foo', 5)
+        self.var_io.recordConnectionResult.assert_called_once_with('Foo', True)
+
+    def test_connect_to_last_network_fails(self):
+        self.var_io.readLastNetwork.return_value = self.network
+        self.nm.wait_for_network.return_value = False
+        self.assertFalse(startup.connect_to_last_network(self.conf, self.device))
+        self.var_io.recordConnectionResult.assert_called_once_with('Foo', False)
+
+        # Not found in the scan, not a failure to connect
+        self.nm.wait_for_network.return_value = None
+        self.assertFalse(startup.connect_to_last_network(self.conf, self.device))
+        self.var_io.recordConnectionResult.assert_called_once_with('Foo', False)
+
+        # Deleted from NetworkManager since
+        self.nm.activate_network.return_value = None
+        self.assertFalse(startup.connect_to_last_network(self.conf, self.device))
+
+        self.nm.activate_network.side_effect = Exception('Unknown device')
+        self.assertFalse(startup.connect_to_last_network(self.conf, self.device))
+
+    def test_connect_to_last_network_none(self):
+        self.assertFalse(startup.connect_to_last_network(self.conf, self.device))
+        self.nm.activate_network.assert_not_called()
+
+    def start_ap_mode(self, profile, ap_connections, ap_conf=None):
+        conf = {'delete_existing_ap_connections' : True, 'status_led' : None}
+        if ap_conf is None:
+            ap_conf = {'connection' : {'id' : 'Pifi AP Mode', 'uuid' : 'new-uuid'},
+                       '802-11-wireless' : {'mode' : 'ap', 'ssid' : 'pifi1234'}}
+        if profile == 'same':
+            profile = {'uuid' : 'old-uuid', 'hash' : etc_io.ap_conf_digest(ap_conf)}
+        self.var_io.readAPProfile.return_value = profile
+
+        saved = self.nm.saved_connections.return_value
+        saved.wireless.return_value = list(ap_connections.values())
+        saved.by_uuid.side_effect = lambda uuid: ap_connections.get(uuid)
+        with mock.patch.object(startup, 'etc_io') as startup_etc_io, \
+             mock.patch.object(startup, 'leds') as self.leds:
+            startup_etc_io.get_default_ap_conf.return_value = ap_conf
+            startup_etc_io.ap_conf_digest = etc_io.ap_conf_digest
+            startup.start_ap_mode(conf, self.device, self.device)
+        return saved
+
+    def test_start_ap_mode_reuses_profile(self):
+        old = (mock.MagicMock(), {'802-11-wireless' : {'ssid' : 'pifi1234'}})
+        stale = (mock.MagicMock(), {'802-11-wireless' : {'ssid' : 'ubiquityrobot'}})
+        self.start_ap_mode('same', {'old-uuid' : old, 'stale-uuid' : stale})
+
+        self.NetworkManager.NetworkManager.ActivateConnection.assert_called_once_with(
+            old[0], self.device, '/')
+        self.NetworkManager.NetworkManager.AddAndActivateConnection.assert_not_called()
+        old[0].Delete.assert_not_called()
+        stale[0].Delete.assert_called_once_with()
+        self.var_io.writeAPProfile.assert_not_called()
+
+    def test_start_ap_mode_changed_profile(self):
+        old = (mock.MagicMock(), {'802-11-wireless' : {'ssid' : 'pifi1234'}})
+        self.start_ap_mode({'uuid' : 'old-uuid', 'hash' : 'outdated'}, {'old-uuid' : old})
+
+        old[0].Delete.assert_called_once_with()
+        self.NetworkManager.NetworkManager.ActivateConnection.assert_not_called()
+        self.assertEqual(self.NetworkManager.NetworkManager.AddAndActivateConnection.call_count, 1)
+        profile = self.var_io.writeAPProfile.call_args[0][0]
+        self.assertEqual(profile['uuid'], 'new-uuid')
+
+    def test_start_ap_mode_profile_deleted(self):
+        self.start_ap_mode('same', {})
+
+        self.NetworkManager.NetworkManager.ActivateConnection.assert_not_called()
+        self.assertEqual(self.NetworkManager.NetworkManager.AddAndActivateConnection.call_count, 1)
+
+    def test_start_ap_mode_without_uuid(self):
+        ap_conf = {'connection' : {'id' : 'Pifi AP Mode'},
+                   '802-11-wireless' : {'mode' : 'ap', 'ssid' : 'pifi1234'}}
+        self.start_ap_mode(None, {}, ap_conf=ap_conf)
+
+        self.assertEqual(self.NetworkManager.NetworkManager.AddAndActivateConnection.call_count, 1)
+        self.var_io.writeAPProfile.assert_not_called()
+        self.assertEqual(self.leds.try_blink.call_count, 1)
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+import unittest
+from unittest import mock
+import os
+import em
+
+import pifi.template as template
+
+default_ap_em = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'default_ap.em')
+
+class TemplateTests(unittest.TestCase):
+
+    def test_same_as_empy(self):
+        with open(default_ap_em) as f:
+            text = f.read()
+        variables = {'mac' : 'AF:BF:CF:0F:1F:2F', 'uuid_str' : 'foo-bar', 'hostname' : 'robot'}
+        self.assertIsNotNone(template.compiled(text))
+        self.assertEqual(template.expand(text, variables, volatile=('uuid_str',)),
+                         em.expand(text, variables))
+
+        for text in ['a@@b', '@(None)x', '@( ")(" )', '@(a, a + 1)', '@(d["a"])']:
+            variables = {'a' : 1, 'd' : {'a' : 'A'}}
+            self.assertEqual(template.expand(text, variables), em.expand(text, variables))
+
+    def test_other_markup_uses_empy(self):
+        for text in ['@{x = 1}@x', '@(a ? 1 ! 2)', '@[if True]yes@[end if]', '@(1', 'a@']:
+            self.assertIsNone(template.compiled(text), text)
+
+        fake_em = mock.MagicMock(**{'expand.return_value' : 'rendered'})
+        with mock.patch.dict('sys.modules', {'em' : fake_em}):
+            self.assertEqual(template.expand('@x', {'x' : 1}), 'rendered')
+            self.assertEqual(template.expand('@(x)', {'x' : 1}), '1')
+        fake_em.expand.assert_called_once_with('@x', {'x' : 1})
+
+    def test_cached(self):
+        calls = []
+        def count():
+            calls.append(1)
+            return len(calls)
+        text = '@(count()) @(uuid)'
+        self.assertIs(template.compiled(text), template.compiled(text))
+
+        self.assertEqual(template.expand(text, {'count' : count, 'uuid' : 'a'}, volatile=('uuid',)), '1 a')
+        self.assertEqual(template.expand(text, {'count' : count, 'uuid' : 'b'}, volatile=('uuid',)), '1 b')
+        self.assertEqual(len(calls), 1)
+        # Without volatile variables, a new value of any variable renders again
+        self.assertEqual(template.expand(text, {'count' : count, 'uuid' : 'c'}), '2 c')
+
+        with self.assertRaises(NameError):
+            template.expand('@(foo)', {})
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import unittest
+from unittest import mock
+import pifi.trace as trace
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+class TraceTests(unittest.TestCase):
+
+    def test_spans(self):
+        clock = FakeClock()
+        tracer = trace.Tracer(clock=clock, wall_clock=lambda: 1500000000.0)
+        with tracer.span('config'):
+            clock.now += 0.5
+        clock.now += 0.25
+        with self.assertRaises(RuntimeError):
+            with tracer.span('scan'):
+                clock.now += 2
+                raise RuntimeError('scan failed')
+        tracer.decide('ap_mode')
+
+        record = tracer.record()
+        self.assertEqual(record['started_at'], 1500000000.0)
+        self.assertEqual(record['decision'], 'ap_mode')
+        self.assertAlmostEqual(record['total'], 2.75)
+        self.assertEqual([s['name'] for s in record['spans']], ['config', 'scan'])
+        self.assertAlmostEqual(record['spans'][1]['start'], 0.75)
+        self.assertAlmostEqual(record['spans'][1]['duration'], 2)
+
+    def test_phase_durations(self):
+        record = {'spans' : [{'name' : 'scan', 'start' : 0, 'duration' : 1.0},
+                             {'name' : 'pending', 'start' : 1, 'duration' : 3.0},
+                             {'name' : 'scan', 'start' : 4, 'duration' : 0.5}]}
+        self.assertEqual(trace.phase_durations(record), {'scan' : 1.5, 'pending' : 3.0})
+
+    def test_percentile(self):
+        self.assertIsNone(trace.percentile([], 50))
+        self.assertEqual(trace.percentile([7], 90), 7)
+        self.assertEqual(trace.percentile([4, 1, 3, 2], 0), 1)
+        self.assertEqual(trace.percentile([4, 1, 3, 2], 100), 4)
+        self.assertAlmostEqual(trace.percentile([4, 1, 3, 2], 50), 2.5)
+        self.assertAlmostEqual(trace.percentile(range(11), 90), 9)
+
+    def test_summarize(self):
+        records = [{'total' : 1.0, 'spans' : [{'name' : 'scan', 'start' : 0, 'duration' : 1.0}]},
+                   {'total' : 5.0, 'spans' : [{'name' : 'scan', 'start' : 0, 'duration' : 2.0},
+                                              {'name' : 'ap_mode', 'start' : 2, 'duration' : 3.0}]}]
+        summary = trace.summarize(records, percentiles=(50,))
+        self.assertEqual([phase for phase, values, maximum in summary],
+                         ['scan', 'ap_mode', 'total'])
+        self.assertEqual(summary[0], ('scan', [1.5], 2.0))
+        self.assertEqual(summary[1], ('ap_mode', [3.0], 3.0))
+        self.assertEqual(summary[2], ('total', [3.0], 5.0))
+
+def main():
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
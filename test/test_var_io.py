@@ -3,8 +3,34 @@ from unittest import mock
 import pifi.var_io as var_io
 from io import StringIO
 import os
+import shutil
+import tempfile
+import multiprocessing
+import threading
+
+def add_pending(writer, count, paths):
+    for name, path in paths.items():
+        setattr(var_io, name, path)
+    for n in range(count):
+        ssid = 'writer%d-%d' % (writer, n)
+        with var_io.pendingTransaction() as store:
+            store.add({'connection' : {'uuid' : ssid}, '802-11-wireless' : {'ssid' : ssid}})
 
 class VarIOTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        os.mkdir(os.path.join(self.directory, 'pifi'))
+
+    def redirect(self, name):
+        """Point var_io.name at a file in a temporary directory"""
+        path = os.path.join(self.directory, 'pifi', os.path.basename(getattr(var_io, name)))
+        return mock.patch.object(var_io, name, path)
+
+    def contents(self, path):
+        with open(path) as f:
+            return f.read()
     
     def test_good_seen_SSIDs(self):
         f = mock.mock_open(read_data='Foo    \nBar    \n')
@@ -40,51 +66,71 @@ class VarIOTests(unittest.TestCase):
         self.assertIsInstance(var_io.readSeenSSIDs(open=f)[2], str)
 
     def test_write_one_SSID(self):
-        f = mock.mock_open()
-        ed = mock.MagicMock()
-        var_io.writeSeenSSIDs(['Foo'], open=f, ensureDir=ed)
-        ed.assert_called_once_with(var_io.seen_SSIDs_path)
-        self.assertIn(mock.call().write('Foo\n'), f.mock_calls)
+        ed = mock.MagicMock(side_effect=var_io.ensureDir)
+        with self.redirect('seen_SSIDs_path') as path:
+            var_io.writeSeenSSIDs(['Foo'], ensureDir=ed)
+        ed.assert_called_once_with(path)
+        self.assertEqual(self.contents(path), 'Foo\n')
 
     def test_write_empty_SSIDs(self):
-        f = mock.mock_open()
-        ed = mock.MagicMock()
-        var_io.writeSeenSSIDs([], open=f, ensureDir=ed)
-        ed.assert_called_once_with(var_io.seen_SSIDs_path)
-        self.assertIn(mock.call().truncate(), f.mock_calls)
+        with self.redirect('seen_SSIDs_path') as path:
+            var_io.writeSeenSSIDs([])
+        self.assertEqual(self.contents(path), '')
 
     def test_write_multiple_SSIDs(self):
-        f = mock.mock_open()
-        ed = mock.MagicMock()
-        var_io.writeSeenSSIDs(['Foo', 'Bar', 'Baz'], open=f, ensureDir=ed)
-        ed.assert_called_once_with(var_io.seen_SSIDs_path)
-        self.assertIn(mock.call().write('Foo\n'), f.mock_calls)
-        self.assertIn(mock.call().write('Bar\n'), f.mock_calls)
-        self.assertIn(mock.call().write('Baz\n'), f.mock_calls)
+        with self.redirect('seen_SSIDs_path') as path:
+            var_io.writeSeenSSIDs(['Foo', 'Bar', 'Baz'])
+        self.assertEqual(self.contents(path), 'Foo\nBar\nBaz\n')
+
+    def test_scan_history(self):
+        import tempfile, shutil
+        from pifi.scan_table import ScanTable
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'scan_history')
+        table = ScanTable()
+        table.add('Foo', 'aa', strength=50)
+
+        with mock.patch.object(var_io, 'scan_history_path', path):
+            self.assertIsNone(var_io.readScanHistory())
+            for n in range(3):
+                var_io.appendScanHistory(table, size=4)
+            history = var_io.readScanHistory()
+        with history:
+            self.assertEqual(len(history), 4)
+            self.assertEqual(history.visibility('Foo').seen, 2)
+
+    def test_read_scan_table(self):
+        f = mock.mock_open(read_data='{"hidden": 2, "entries": [{"ssid": "Foo"}]}')
+        self.assertEqual(var_io.readScanTable(open=f), {'hidden' : 2, 'entries' : [{'ssid' : 'Foo'}]})
+
+    def test_read_scan_table_bad(self):
+        f = mock.Mock(side_effect=FileNotFoundError('foo'))
+        self.assertIsNone(var_io.readScanTable(open=f))
+        f = mock.mock_open(read_data='[1, 2]')
+        self.assertIsNone(var_io.readScanTable(open=f))
+        f = mock.mock_open(read_data='{not json')
+        with mock.patch('sys.stdout', new=StringIO()):
+            self.assertIsNone(var_io.readScanTable(open=f))
+
+    def test_write_scan_table(self):
+        with self.redirect('scan_table_path'):
+            var_io.writeScanTable({'hidden' : 0, 'entries' : []})
+            self.assertEqual(var_io.readScanTable(), {'hidden' : 0, 'entries' : []})
 
     def test_write_multiple_existing_file_SSIDs(self):
-        output = StringIO("Cats\n")
-        ed = mock.MagicMock()
-        f = mock.Mock(return_value=output)
-        output.close = mock.MagicMock()
-
-        var_io.writeSeenSSIDs(['Foo', 'Bar', 'Baz'], open=f, ensureDir=ed)
-        ed.assert_called_once_with(var_io.seen_SSIDs_path)
-
-        self.assertNotEqual("Cats\nFoo\nBar\nBaz\n", output.getvalue())
-        self.assertEqual("Foo\nBar\nBaz\n", output.getvalue())
+        with self.redirect('seen_SSIDs_path') as path:
+            with open(path, 'w') as f:
+                f.write('Cats\n')
+            var_io.writeSeenSSIDs(['Foo', 'Bar', 'Baz'])
+        self.assertEqual(self.contents(path), 'Foo\nBar\nBaz\n')
 
     def test_write_multiple_existing_longer_SSIDs(self):
-        output = StringIO("Foo\nBar\nBaz\n")
-        ed = mock.MagicMock()
-        f = mock.Mock(return_value=output)
-        output.close = mock.MagicMock()
-
-        var_io.writeSeenSSIDs(['Cats'], open=f, ensureDir=ed)
-        ed.assert_called_once_with(var_io.seen_SSIDs_path)
-
-        self.assertNotEqual("Foo\nBar\nBaz\nCats\n", output.getvalue())
-        self.assertEqual("Cats\n", output.getvalue())
+        with self.redirect('seen_SSIDs_path') as path:
+            with open(path, 'w') as f:
+                f.write('Foo\nBar\nBaz\n')
+            var_io.writeSeenSSIDs(['Cats'])
+        self.assertEqual(self.contents(path), 'Cats\n')
 
     def test_non_existant_pending(self):
         f = mock.Mock(side_effect=FileNotFoundError('foo'))
@@ -108,57 +154,228 @@ class VarIOTests(unittest.TestCase):
         self.assertEqual([{ 'foo' : 'bar' }], var_io.readPendingConnections(open=f))
 
     def test_empty_write_pending(self):
-        output = StringIO()
-        ed = mock.MagicMock()
-        f = mock.Mock(return_value=output)
-        output.close = mock.MagicMock()
-
-        var_io.writePendingConnections([],  open=f, ensureDir=ed)
-        ed.assert_called_once_with(var_io.pending_path)
-        self.assertEqual('[]', output.getvalue().strip())
+        ed = mock.MagicMock(side_effect=var_io.ensureDir)
+        with self.redirect('pending_path') as path:
+            var_io.writePendingConnections([], ensureDir=ed)
+        ed.assert_called_once_with(path)
+        self.assertEqual('[]', self.contents(path).strip())
 
     def test_none_write_pending(self):
-        output = StringIO()
-        ed = mock.MagicMock()
-        f = mock.Mock(return_value=output)
-        output.close = mock.MagicMock()
-
-        var_io.writePendingConnections(None,  open=f, ensureDir=ed)
-        ed.assert_called_once_with(var_io.pending_path)
-        self.assertEqual('[]', output.getvalue().strip())
+        with self.redirect('pending_path') as path:
+            var_io.writePendingConnections(None)
+        self.assertEqual('[]', self.contents(path).strip())
 
     def test_one_write_pending(self):
-        output = StringIO()
-        ed = mock.MagicMock()
-        f = mock.Mock(return_value=output)
-        output.close = mock.MagicMock()
-
-        var_io.writePendingConnections([{ 'foo' : 'bar' }],  open=f, ensureDir=ed)
-        ed.assert_called_once_with(var_io.pending_path)
-        self.assertEqual('[{ "foo" : "bar" }]'.replace(" ", ""), 
-                         output.getvalue().replace(" ", ""))
+        with self.redirect('pending_path') as path:
+            var_io.writePendingConnections([{ 'foo' : 'bar' }])
+        self.assertEqual('[{ "foo" : "bar" }]'.replace(" ", ""),
+                         self.contents(path).replace(" ", ""))
 
     def test_one_write_existing_pending(self):
-        output = StringIO('[{ "foo" : "baz" }]')
-        ed = mock.MagicMock()
-        f = mock.Mock(return_value=output)
-        output.close = mock.MagicMock()
-
-        var_io.writePendingConnections([{ 'foo' : 'bar' }],  open=f, ensureDir=ed)
-        ed.assert_called_once_with(var_io.pending_path)
-        self.assertEqual('[{ "foo" : "bar" }]'.replace(" ", ""), 
-                         output.getvalue().replace(" ", ""))
+        with self.redirect('pending_path') as path:
+            with open(path, 'w') as f:
+                f.write('[{ "foo" : "baz" }]')
+            var_io.writePendingConnections([{ 'foo' : 'bar' }])
+        self.assertEqual('[{ "foo" : "bar" }]'.replace(" ", ""),
+                         self.contents(path).replace(" ", ""))
 
     def test_one_write_existing_longer_pending(self):
-        output = StringIO('[{ "foo" : "long words" }, { "bar" : "longer words" }]')
-        ed = mock.MagicMock()
-        f = mock.Mock(return_value=output)
-        output.close = mock.MagicMock()
-
-        var_io.writePendingConnections([{ 'foo' : 'bar' }],  open=f, ensureDir=ed)
-        ed.assert_called_once_with(var_io.pending_path)
-        self.assertEqual('[{ "foo" : "bar" }]'.replace(" ", ""), 
-                         output.getvalue().replace(" ", ""))
+        with self.redirect('pending_path') as path:
+            with open(path, 'w') as f:
+                f.write('[{ "foo" : "long words" }, { "bar" : "longer words" }]')
+            var_io.writePendingConnections([{ 'foo' : 'bar' }])
+        self.assertEqual('[{ "foo" : "bar" }]'.replace(" ", ""),
+                         self.contents(path).replace(" ", ""))
+
+    def test_pending_store_journal(self):
+        with self.redirect('pending_path') as path, \
+             self.redirect('pending_journal_path') as journal_path, \
+             mock.patch.object(var_io, 'pending_journal_keep', 3):
+            var_io.writePendingConnections([{'connection' : {'uuid' : 'uuid-1'},
+                                             '802-11-wireless' : {'ssid' : 'Foo'}}])
+            store = var_io.readPendingStore()
+            store.add({'connection' : {'uuid' : 'uuid-2'}, '802-11-wireless' : {'ssid' : 'Bar'}})
+            var_io.writePendingStore(store)
+            # Appended to the journal, the pending file is left as it was
+            self.assertEqual(len(var_io.readPendingConnections()), 1)
+            with open(journal_path, 'a') as f:
+                f.write('{"op": "add", "conn')
+
+            store = var_io.readPendingStore()
+            self.assertEqual(len(store), 2)
+            self.assertEqual(store.journaled, 1)
+            store.remove_ssid('Foo')
+            var_io.writePendingStore(store)
+            self.assertEqual(len(var_io.readPendingStore()), 1)
+
+            # The third operation folds the journal into the pending file
+            store.remove_ssid('Bar')
+            var_io.writePendingStore(store)
+            self.assertFalse(os.path.exists(journal_path))
+            self.assertEqual(var_io.readPendingConnections(), [])
+
+            var_io.writePendingStore(store, compact=True)
+            self.assertFalse(os.path.exists(journal_path))
+
+    def test_pending_transaction(self):
+        fsync = mock.MagicMock(side_effect=os.fsync)
+        with self.redirect('pending_path'), self.redirect('pending_journal_path') as journal_path, \
+             self.redirect('pending_lock_path'):
+            with var_io.pendingTransaction(fsync=fsync) as store:
+                store.add({'connection' : {'uuid' : 'uuid-1'}, '802-11-wireless' : {'ssid' : 'Foo'}})
+            self.assertEqual(fsync.call_count, 1)
+            self.assertEqual(len(var_io.readPendingStore()), 1)
+
+            with self.assertRaises(KeyError):
+                with var_io.pendingTransaction(fsync=fsync) as store:
+                    store.remove_ssid('Foo')
+                    raise KeyError('Foo')
+            self.assertEqual(len(var_io.readPendingStore()), 1)
+
+            # Nothing to save, nothing synced
+            with var_io.pendingTransaction(fsync=fsync) as store:
+                pass
+            self.assertEqual(fsync.call_count, 1)
+
+            with var_io.pendingTransaction(fsync=fsync, compact=True) as store:
+                pass
+            self.assertFalse(os.path.exists(journal_path))
+            self.assertEqual(len(var_io.readPendingConnections()), 1)
+            with open(var_io.pending_lock_path, 'rb') as lock_file:
+                self.assertEqual(var_io._journal_state.unpack(lock_file.read(16)), (1, 0))
+
+    def test_pending_transaction_compacted_before_sync(self):
+        # A transaction appends, another one folds the journal into the
+        # pending file and removes it, and only then does the first one sync
+        locked, remove = var_io._locked, os.remove
+        syncing, removed, synced = threading.Event(), threading.Event(), threading.Event()
+        errors = []
+        state_locks = []
+
+        def first_locked(fd, byte):
+            if threading.current_thread() is writer and byte == 1:
+                state_locks.append(fd)
+                if len(state_locks) == 2:
+                    syncing.set()
+                    removed.wait(5)
+            return locked(fd, byte)
+
+        def folding_remove(path):
+            remove(path)
+            if path == var_io.pending_journal_path:
+                removed.set()
+                synced.wait(5)
+
+        def append():
+            try:
+                with var_io.pendingTransaction() as store:
+                    store.add({'connection' : {'uuid' : 'uuid-1'}, '802-11-wireless' : {'ssid' : 'Foo'}})
+            except Exception as e:
+                errors.append(e)
+            finally:
+                synced.set()
+
+        with self.redirect('pending_path'), self.redirect('pending_journal_path') as journal_path, \
+             self.redirect('pending_lock_path'), \
+             mock.patch.object(var_io, '_locked', side_effect=first_locked):
+            writer = threading.Thread(target=append)
+            writer.start()
+            self.assertTrue(syncing.wait(5))
+            with mock.patch.object(var_io.os, 'remove', side_effect=folding_remove):
+                with var_io.pendingTransaction(compact=True) as store:
+                    store.add({'connection' : {'uuid' : 'uuid-2'}, '802-11-wireless' : {'ssid' : 'Bar'}})
+            writer.join(5)
+
+            self.assertEqual(errors, [])
+            self.assertFalse(os.path.exists(journal_path))
+            self.assertEqual(sorted(con['connection']['uuid'] for con in var_io.readPendingConnections()),
+                             ['uuid-1', 'uuid-2'])
+
+    def test_pending_transaction_processes(self):
+        with self.redirect('pending_path'), self.redirect('pending_journal_path'), \
+             self.redirect('pending_lock_path'):
+            paths = dict((name, getattr(var_io, name)) for name in
+                         ['pending_path', 'pending_journal_path', 'pending_lock_path'])
+            processes = [multiprocessing.Process(target=add_pending, args=(writer, 10, paths))
+                         for writer in range(4)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            self.assertEqual(len(var_io.readPendingStore()), 40)
+
+    def test_non_existant_device_selection(self):
+        f = mock.Mock(side_effect=FileNotFoundError('foo'))
+        self.assertIsNone(var_io.readDeviceSelection(open=f))
+
+    def test_bad_device_selection(self):
+        f = mock.mock_open(read_data='')
+        self.assertIsNone(var_io.readDeviceSelection(open=f))
+        f = mock.mock_open(read_data='[]')
+        self.assertIsNone(var_io.readDeviceSelection(open=f))
+
+    def test_write_read_device_selection(self):
+        selection = {'ap' : {'mac' : 'AA:BB', 'interface' : 'wlan0'}}
+        with self.redirect('devices_path') as path:
+            with open(path, 'w') as f:
+                f.write('{ "ap" : { "mac" : "long long words" } }')
+            var_io.writeDeviceSelection(selection)
+            self.assertEqual(selection, var_io.readDeviceSelection())
+
+    def test_write_read_last_network(self):
+        network = {'ssid' : 'Foo', 'bssid' : '00:11:22:33:44:55',
+                   'frequency' : 2412, 'uuid' : 'uuid-1'}
+        with self.redirect('last_network_path'):
+            self.assertIsNone(var_io.readLastNetwork())
+            var_io.writeLastNetwork(network)
+            self.assertEqual(network, var_io.readLastNetwork())
+
+    def test_connection_history(self):
+        with self.redirect('connection_history_path') as path:
+            self.assertEqual(var_io.readConnectionHistory(), {})
+            var_io.recordConnectionResult('Foo', True)
+            var_io.recordConnectionResult('Foo', False)
+            var_io.recordConnectionResult('Foo', True)
+            var_io.recordConnectionResult('Bar', False)
+            self.assertEqual(var_io.readConnectionHistory(), {'Foo' : (2, 1), 'Bar' : (0, 1)})
+
+            with open(path, 'w') as f:
+                f.write('{"Foo": [1')
+            self.assertEqual(var_io.readConnectionHistory(), {})
+
+    def test_write_file_unchanged(self):
+        fsync = mock.MagicMock()
+        with self.redirect('pending_path') as path:
+            self.assertTrue(var_io.writeFile(path, '[1]', fsync=fsync))
+            self.assertFalse(var_io.writeFile(path, '[1]', fsync=fsync))
+            self.assertTrue(var_io.writeFile(path, '[2]', fsync=fsync))
+        self.assertEqual(fsync.call_count, 2)
+        self.assertEqual(self.contents(path), '[2]')
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['pending'])
+
+    def test_write_file_power_cut(self):
+        replace = mock.MagicMock(side_effect=OSError('power cut'))
+        with self.redirect('pending_path') as path:
+            var_io.writePendingConnections([{ 'foo' : 'bar' }])
+            with self.assertRaises(OSError):
+                var_io.writeFile(path, '[', replace=replace)
+            # The old contents are still there, and no temporary file is left
+            self.assertEqual(var_io.readPendingConnections(), [{ 'foo' : 'bar' }])
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['pending'])
+
+    def test_boot_traces(self):
+        with self.redirect('boot_trace_path'):
+            self.assertEqual(var_io.readBootTraces(), [])
+            for boot in range(5):
+                var_io.appendBootTrace({'boot' : boot}, keep=3)
+                self.assertEqual(var_io.readBootTraces()[-1], {'boot' : boot})
+            self.assertEqual(var_io.readBootTraces(), [{'boot' : 2}, {'boot' : 3}, {'boot' : 4}])
+
+            # A boot that was cut off while writing does not take the next one with it
+            with open(var_io.boot_trace_path, 'w') as trace_file:
+                trace_file.write('{"boot" : 4}\n{"bo')
+            var_io.appendBootTrace({'boot' : 5}, keep=3)
+            self.assertEqual(var_io.readBootTraces(), [{'boot' : 4}, {'boot' : 5}])
 
     def test_ensure_dir(self):
         var_io.ensureDir('/tmp/pifi/test/foo')